@@ -2,7 +2,8 @@
 biometall
 Software to predict feasible metal binding areas into proteins
 """
-from .biometall import run
+from .biometall import run, run_many, search, results_sink, Site
+from .biometall import search_ensemble, ensemble_results_sink, EnsembleSite
 
 # Handle versioneer
 from ._version import get_versions
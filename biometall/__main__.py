@@ -1,12 +1,26 @@
 import argparse
 import multiprocessing
-from biometall import run
+import shlex
+import copy
+import os
+from biometall import run, run_many
+from biometall.modules.data import ENGINES, KERNELS, QUERY_OPTIONS, ALLOWED_FILE_TYPES
+from biometall.modules.pdb import _split_extension
 import sys
 
 def parse_cli():
-    p = argparse.ArgumentParser()
-    p.add_argument('inputfile', type=str,
-        help='Molecule pdb file to be analysed')
+    #`biometall batch` analyses several structures with the same options
+    batch = len(sys.argv) > 1 and sys.argv[1] == 'batch'
+    if batch:
+        p = argparse.ArgumentParser(prog='biometall batch')
+        p.add_argument('inputs', type=str, nargs='+',
+            help='Molecule pdb files to be analysed, directories containing them, or text files listing a pdb file (or PDB code) per line')
+        p.add_argument('--summary', type=str, dest='summary_file', default='results_biometall_summary.txt',
+            help='File where the number of sites and the most populated site of every structure are saved. Default: results_biometall_summary.txt')
+    else:
+        p = argparse.ArgumentParser()
+        p.add_argument('inputfile', type=str,
+            help='Molecule file to be analysed (.pdb or .cif, optionally compressed as .pdb.gz or .cif.gz) or its 4-character PDB code')
     p.add_argument('--min_coordinators', type=int, default=3,
         help='Minimum number of coordinating residues of a given grid probe for that probe to be considered as potentially coordinating. Default: 3')
     p.add_argument('--residues', type=str, default='[ASP,HIS,GLU,CYS]',
@@ -23,6 +37,12 @@ def parse_cli():
         help='Radius of the search sphere. Only if you want to scan a restricted zone of the molecule. Default: None')
     p.add_argument('--cutoff', type=float, dest='cluster_cutoff', default=0,
         help='Cluster density cutoff. The possible binding site will only be printed if the cluster has more probes than the cutoff*most populated cluster. It should be between 0 and 1.0. Default: 0')
+    p.add_argument('--maximal', dest='maximal_only', action='store_true', default=False,
+        help='Only add every probe to the site formed by all its coordinating residues, instead of to every site formed by a subset of them fulfilling --min_coordinators and --min_sidechain. Keeps the calculation bounded when probes have many coordinators (e.g. with --backbone ALL). Default: False')
+    p.add_argument('--max_subset_size', type=int, default=None,
+        help='Maximum number of coordinating residues of a site. Larger subsets of the coordinators of a probe are not considered. Can not be combined with --maximal. Default: None (no limit)')
+    p.add_argument('--approximate_center', type=int, default=None,
+        help='Number of probes above which the center of a site is approximated, instead of comparing the distances between all its probes. The radius is always the exact distance from the center to its farthest probe. Default: None (always exact)')
     p.add_argument('--pdb', action='store_true', default=False,
         help='Output a probes.pdb file with all possible binding zones. Default: False')
     p.add_argument('--cores', type=int, dest='cores_number', default=0,
@@ -37,13 +57,81 @@ def parse_cli():
     p.add_argument('--sidechain_clashes', type=float,
         dest='sidechain_clashes_threshold', default=0.0,
         help='Distance from a grid probe to a sidechain atom that defines a clash. The probes at less distance from any sidechain atom will be discarded. For example, if set to 1.0, all probes nearer than 1.0 Angstroms from any sidechain atom of the protein will be discarded. Default: 0.0')
+    p.add_argument('--max_memory', '--max-memory', type=float, dest='max_memory', default=None,
+        help='Maximum memory, in MB, used by the parts of the grid being tested at the same time. The grid is split in smaller parts if needed, and never uses more than half of the memory available in the system. Default: None (only limited by the available memory)')
+    p.add_argument('--engine', type=str, default='dense', choices=ENGINES,
+        help='Engine used to evaluate the coordinations. "dense" computes the distances from every probe to every residue, while "cells" uses a cell list to only consider the residues near each probe (faster for large proteins, same results). Default: dense')
+    p.add_argument('--kernel', type=str, default='squared', choices=KERNELS,
+        help='Kernel used to compare the distances and angles of the probes with the coordination ranges. "squared" compares squared distances and squared cosines (faster), while "sqrt" compares the actual distances and angles. Both give the same coordinations. Default: squared')
+    p.add_argument('--coarse', type=float, dest='coarse_step', default=None,
+        help='Distance between two probes of a coarse grid used to find the coordinating sites before testing the grid defined by --grid. Only the zones around the probes of those sites are tested with the fine grid, which grows around them until containing all their probes. Default: None (the whole fine grid is tested)')
+    p.add_argument('--shell', action='store_true', default=False,
+        help='Only test the probes near a potentially coordinating residue (i.e. within the largest Metal-Alpha carbon distance of its residue type, or the Metal-Oxygen distance for backbone coordinations). Probes far from the protein are discarded before the calculation, with the same results. Default: False')
+    p.add_argument('--cache_dir', type=str, default=None,
+        help='Directory where the parsed structures and the results are cached, to reuse them in further calculations of the same file. Default: $BIOMETALL_CACHE_DIR or ~/.cache/biometall')
+    p.add_argument('--no-cache', dest='use_cache', action='store_false', default=True,
+        help='Always parse the input file and search the sites, without reading nor writing the cache.')
+    p.add_argument('--cache_size', type=float, default=1024,
+        help='Maximum size of the cache, in MB. The least recently used structures and results are removed when it is exceeded. Default: 1024')
+    if not batch:
+        p.add_argument('--ensemble', action='store_true', default=False,
+            help='Search every model (MODEL records, or model numbers in mmCIF files) of the input file, e.g. the conformers of an NMR structure or the snapshots of a trajectory, and report the fraction of models where every site is found. Default: False')
+        p.add_argument('--frames', type=str, default=None,
+            help='Models searched with --ensemble, as a Python-like slice of their indices starting at 0 (e.g. 0:100:10). Default: all the models')
+    p.add_argument('--queries', type=str, default=None,
+        help='File with several queries to be searched in the same grid, computing the coordinations only once. Each line contains the options of a query (any of --residues, --motif, --mutations, --min_coordinators, --min_sidechain, --backbone, --cutoff, --maximal and --max_subset_size), and the options not given are taken from the command line. Lines starting with # are ignored. Default: None')
     cmd_str = "*****biometall " + " ".join(sys.argv[1:])
 
-    return p.parse_args(), cmd_str
+    if batch:
+        args = p.parse_args(sys.argv[2:])
+        positionals = args.inputs
+    else:
+        args = p.parse_args()
+        positionals = [args.inputfile]
+    if args.queries:
+        args.queries = _parse_queries(p, args, positionals)
+    if getattr(args, 'frames', None):
+        args.frames = slice(*[int(index) if index else None for index in args.frames.split(':')])
+    return args, cmd_str
+
+def _parse_queries(p, args, positionals):
+    """
+    Reads the queries of the file given in the --queries option.
+    """
+    queries = []
+    with open(args.queries) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            query = p.parse_args(shlex.split(line) + positionals, namespace=copy.copy(args))
+            queries.append({option: getattr(query, option) for option in QUERY_OPTIONS})
+    return queries
+
+def _batch_inputs(inputs):
+    """
+    Lists the structures given to `biometall batch`.
+    """
+    inputfiles = []
+    for item in inputs:
+        if os.path.isdir(item):
+            inputfiles += sorted(os.path.join(item, name) for name in os.listdir(item)
+                                    if _split_extension(name)[1] in ALLOWED_FILE_TYPES)
+        elif _split_extension(item)[1] in ALLOWED_FILE_TYPES or not os.path.isfile(item):
+            inputfiles.append(item)
+        else:
+            with open(item) as f:
+                inputfiles += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    return inputfiles
 
 def main():
     args, cmd_str = parse_cli()
-    run(**vars(args), cmd_str=cmd_str)
+    if hasattr(args, 'inputs'):
+        inputfiles = _batch_inputs(args.inputs)
+        del args.inputs
+        run_many(inputfiles, **vars(args), cmd_str=cmd_str)
+    else:
+        run(**vars(args), cmd_str=cmd_str)
 
 if __name__ == '__main__':
     multiprocessing.freeze_support()
@@ -6,7 +6,6 @@ Handles the primary functions
 """
 
 import numpy as np
-import sys
 import time
 import math
 import os
@@ -14,25 +13,54 @@ import re
 import multiprocessing
 import psutil
 import itertools
-import copy
 import urllib.request
 from functools import partial
+from collections import Counter, namedtuple
 from ._version import get_versions
 
 # BioMetAll modules
 from .modules.data import DIST_PROBE_ALPHA, DIST_PROBE_BETA, ANGLE_PAB
 from .modules.data import DIST_PROBE_OXYGEN, ANGLE_POC
-from .modules.data import ALLOWED_FILE_TYPES
-from .modules.grid import _chunk_size, _calculate_center_and_radius, _grid
-from .modules.pdb import _parse_molecule, _print_pdb
-from .modules.motif import _check_actual_motif, _check_possible_mutations
+from .modules.data import ALLOWED_FILE_TYPES, ENGINES, KERNELS, QUERY_OPTIONS
+from .modules.data import COORDINATION_TYPES
+from .modules.grid import _chunk_size, _calculate_center_and_radius, _grid, _refined_grid, _shell
+from .modules.pdb import _print_pdb, _split_models, _parse_ensemble
+from .modules.pdb import _split_extension, _open_structure
+from .modules.cache import _load_structure, _default_cache_dir
+from .modules.cache import _result_key, _load_results, _store_results
+from .modules.motif import _compile_motif, _motif_combinations, _check_actual_motif, _check_possible_mutations
+from .modules.neighbors import _backbone_cells, _sidechain_cells, _query_cell_list, _clash_mask
+from .modules.geometry import _residue_thresholds, _sidechain_mask
+from .modules.shared import _share_arrays, _attach_arrays, _release_arrays, _imap_bounded
+from .modules.shared import _prepare_workers
+from .modules.geometry import _sq_distance_matrix, _sq_distances
+from .modules.geometry import _distance_feature, _angle_feature
+from .modules.geometry import _distance_limits, _angle_limits
+
+# Binding site found by BioMetAll. `residues` are the number:chain of the
+# coordinating residues (with a `_BCK` suffix for backbone coordinations),
+# `names` their residue names, and `mutations` the proposed mutations of every
+# residue with the number of probes proposing them
+Site = namedtuple('Site', ['residues', 'center', 'num_probes', 'radius',
+                            'probes', 'names', 'mutations'])
+
+# Binding site found in the models of an ensemble. `frames` are the indices of
+# the models where it is found, `occupancy` their fraction of all the models,
+# `num_probes` and `center` the mean of those models, and `sites` the Site
+# found in each of them
+EnsembleSite = namedtuple('EnsembleSite', ['residues', 'names', 'frames',
+                            'occupancy', 'num_probes', 'center', 'sites'])
 
 def run(inputfile, min_coordinators=3, min_sidechain=2,
         residues='[ASP,HIS,GLU,CYS]', motif='', grid_step=1.0,
         consider_backbone_residues='[]', cluster_cutoff=0.0, pdb=False,
         propose_mutations_to='', custom_radius=None, custom_center=None,
         cores_number=None, backbone_clashes_threshold=1.0,
-        sidechain_clashes_threshold=0.0, cmd_str="", **kwargs):
+        sidechain_clashes_threshold=0.0, engine='dense', kernel='squared',
+        shell=False, coarse_step=None, cache_dir=None, use_cache=True,
+        cache_size=1024, maximal_only=False, max_subset_size=None, queries=None,
+        pool=None, approximate_center=None, max_memory=None, ensemble=False,
+        frames=None, cmd_str="", **kwargs):
     # Print header
     versions = get_versions()
     __version__ = versions['version']
@@ -41,8 +69,795 @@ def run(inputfile, min_coordinators=3, min_sidechain=2,
     print("*" * len(str_header))
     print("")
 
-    filename, file_extension = os.path.splitext(inputfile)
+    #Every model of the input file is searched, and the sites reported with
+    #their occupancy
+    if ensemble:
+        if queries is not None:
+            raise Exception("Several queries can not be searched in an ensemble")
+        return search_ensemble(inputfile, min_coordinators, min_sidechain, residues,
+                    motif, grid_step, consider_backbone_residues, cluster_cutoff,
+                    propose_mutations_to, custom_radius, custom_center,
+                    cores_number, backbone_clashes_threshold,
+                    sidechain_clashes_threshold, engine, kernel, shell,
+                    coarse_step, maximal_only, max_subset_size, frames, pool,
+                    sinks=[ensemble_results_sink(pdb, cmd_str)], verbose=True,
+                    approximate_center=approximate_center, max_memory=max_memory,
+                    cache_dir=cache_dir, use_cache=use_cache, cache_size=cache_size)
+
+    return search(inputfile, min_coordinators, min_sidechain, residues, motif,
+                    grid_step, consider_backbone_residues, cluster_cutoff,
+                    propose_mutations_to, custom_radius, custom_center,
+                    cores_number, backbone_clashes_threshold,
+                    sidechain_clashes_threshold, engine, kernel, shell,
+                    coarse_step, cache_dir, use_cache, cache_size,
+                    maximal_only, max_subset_size, queries, pool,
+                    sinks=[results_sink(pdb, cmd_str)], verbose=True,
+                    approximate_center=approximate_center, max_memory=max_memory)
+
+def results_sink(pdb=False, cmd_str=""):
+    """
+    Creates a sink of `search` printing the sites and saving them in the
+    results files, as `run` does.
+
+    Parameters
+    ----------
+    pdb : bool, optional
+        Whether to save the probes of every site in a `.pdb` file
+    cmd_str : str, optional
+        Command line of the calculation, written in the results files
+
+    Returns
+    -------
+    callable
+        Sink receiving the input file, the sites, the options of the query
+        and its number
+    """
+    __version__ = get_versions()['version']
+    t0 = time.time()
+    def write_sites(inputfile, sites, query, number):
+        if not sites:
+            print("None possible coordinating sites have been found. Try again with other parameters or check/change the input file.")
+            return
+        #Results files of every query are numbered
+        suffix = "_query%d" % number if number else ""
+        #Sites formed by the subsets of the coordinators of the maximal sites
+        if query.get('maximal_only'):
+            parsed_query = _parse_query(**query)
+            subsites = _subsite_counts(sites, parsed_query['min_coordinators'],
+                                        parsed_query['min_sidechain'])
+        else:
+            subsites = None
+        _write_results(sites, inputfile, query['motif'], query['propose_mutations_to'],
+                        pdb, cmd_str, __version__, t0, suffix, subsites)
+    return write_sites
+
+def ensemble_results_sink(pdb=False, cmd_str=""):
+    """
+    Creates a sink of `search_ensemble` printing the sites and saving them in
+    the results file, as `run` does with `ensemble`.
+
+    Parameters
+    ----------
+    pdb : bool, optional
+        Whether to save the probes of every site (in all the models) in a
+        `.pdb` file
+    cmd_str : str, optional
+        Command line of the calculation, written in the results file
+
+    Returns
+    -------
+    callable
+        Sink receiving the input file, the ensemble sites, the options of the
+        query and the number of models searched
+    """
+    __version__ = get_versions()['version']
+    t0 = time.time()
+    def write_sites(inputfile, sites, query, n_frames):
+        if not sites:
+            print("None possible coordinating sites have been found in any model. Try again with other parameters or check/change the input file.")
+            return
+        if not isinstance(inputfile, str):
+            inputfile = inputfile[0]
+        _write_ensemble_results(sites, inputfile, query['motif'], n_frames, pdb,
+                                cmd_str, __version__, t0)
+    return write_sites
+
+def search(inputfile, min_coordinators=3, min_sidechain=2,
+            residues='[ASP,HIS,GLU,CYS]', motif='', grid_step=1.0,
+            consider_backbone_residues='[]', cluster_cutoff=0.0,
+            propose_mutations_to='', custom_radius=None, custom_center=None,
+            cores_number=None, backbone_clashes_threshold=1.0,
+            sidechain_clashes_threshold=0.0, engine='dense', kernel='squared',
+            shell=False, coarse_step=None, cache_dir=None, use_cache=False,
+            cache_size=1024, maximal_only=False, max_subset_size=None,
+            queries=None, pool=None, sinks=(), verbose=False,
+            approximate_center=None, max_memory=None):
+    """
+    Searches the binding sites of a structure, without printing nor writing
+    any result.
+
+    Takes the same options than `run`. The sites of every query are passed
+    to the `sinks`, callables receiving the input file, the list of sites,
+    the options of the query and its number (None if a single query is
+    searched), e.g. `results_sink` to save them in the results files. Unlike
+    `run`, the cache is not used unless `use_cache` is set.
+
+    Parameters
+    ----------
+    inputfile : str
+        Path of the structure file, or PDB code to download
+    cache_dir : str, optional
+        Directory of the cache. If None, the default one (see
+        `_default_cache_dir`)
+    use_cache : bool, optional
+        Whether to reuse (and store) the parsed structure and the results of
+        previous calculations in `cache_dir`
+    queries : list of dict, optional
+        Options (any of `QUERY_OPTIONS`) of several queries searched in the
+        same grid. Options not given are the ones of the calculation
+    pool : multiprocessing.Pool, optional
+        Pool of workers used for the calculation. If None, a new one is
+        created
+    sinks : iterable of callables, optional
+        Receive the sites found for every query
+    verbose : bool, optional
+        Whether to print the adjustments of the options of the queries
+    approximate_center : int, optional
+        Number of probes above which the center of a site is approximated
+        (see `_calculate_center_and_radius`). If None, it is always exact
+    max_memory : float, optional
+        Maximum memory, in MB, used by the chunks of the grid being tested at
+        the same time (see `_chunk_size`). If None, only limited by the
+        available memory
+
+    Returns
+    -------
+    list of Site
+        Sites found, sorted by number of probes. If `queries` is given, a
+        list with the sites of every query
+    """
+    __version__ = get_versions()['version']
+    filename, file_extension = _split_extension(inputfile)
+
+    #Every query searches the sites of a motif (or residues) in the same grid.
+    #Options not given in a query are the ones of the calculation
+    calculation_query = {'residues': residues, 'motif': motif,
+                            'propose_mutations_to': propose_mutations_to,
+                            'min_coordinators': min_coordinators,
+                            'min_sidechain': min_sidechain,
+                            'consider_backbone_residues': consider_backbone_residues,
+                            'cluster_cutoff': cluster_cutoff,
+                            'maximal_only': maximal_only,
+                            'max_subset_size': max_subset_size}
+    single_query = queries is None
+    if single_query:
+        queries = [{}]
+    for query in queries:
+        for option in query:
+            if option not in QUERY_OPTIONS:
+                raise Exception("The options of a query should be any of: " + str(QUERY_OPTIONS))
+    #Options that may change the results, to identify them in the cache
+    parameters = dict(calculation_query, queries=[sorted(query.items()) for query in queries],
+                        grid_step=grid_step, custom_radius=custom_radius,
+                        custom_center=custom_center,
+                        backbone_clashes_threshold=backbone_clashes_threshold,
+                        sidechain_clashes_threshold=sidechain_clashes_threshold,
+                        engine=engine, kernel=kernel, shell=shell, coarse_step=coarse_step,
+                        approximate_center=approximate_center)
+    query_options = [dict(calculation_query, **query) for query in queries]
+    queries = [_parse_query(**options, verbose=verbose) for options in query_options]
+    if coarse_step and len(queries) > 1:
+        raise Exception("Adaptive grids (coarse_step) can not be used with several queries")
+
+    #The coordinations are tested with the residues (and backbones) of all the queries
+    residues, propose_mutations_to, consider_backbone_residues = _merge_queries(queries)
+
+    if engine not in ENGINES:
+        raise Exception("The engine should be one of: " + str(ENGINES))
+    if kernel not in KERNELS:
+        raise Exception("The kernel should be one of: " + str(KERNELS))
+
+    if not cores_number:
+        cores_number = psutil.cpu_count(logical=False)
+
+    #Parse inputfile to obtain atom coords
+    if file_extension in ALLOWED_FILE_TYPES:
+        pass
+    elif file_extension == "":
+        try:
+            response = urllib.request.urlretrieve('http://files.rcsb.org/download/%s.pdb' % (filename), '%s.pdb' % (filename))
+            file_extension = ".pdb"
+            inputfile = filename + file_extension
+        except:
+            raise Exception("The input should be a valid PDB code or a file of a valid type: " + str(ALLOWED_FILE_TYPES))
+    else:
+        raise Exception("The input should be a valid PDB code or a file of a valid type: " + str(ALLOWED_FILE_TYPES))
+
+    #Parsed structures are reused between calculations of the same file
+    if use_cache and not cache_dir:
+        cache_dir = _default_cache_dir()
+    centroid, radius, alphas, betas, carbons, nitrogens, oxygens, column_for_res, res_for_column, name_for_res, atoms_in_res, side_chains = _load_structure(inputfile, file_extension, cache_dir if use_cache else None)
+
+    #Coordination ranges of the residues, and functions searching the sites
+    ranges = _residue_ranges(name_for_res, res_for_column, atoms_in_res, residues,
+                                propose_mutations_to, consider_backbone_residues)
+    def cluster_query(coordination_chunks, query):
+        return clustering(coordination_chunks, query['residues'], query['motifs'],
+                    query['min_coordinators'], query['min_sidechain'],
+                    query['consider_backbone_residues'], query['mutated_motif'],
+                    query['cluster_cutoff'], filename, name_for_res, res_for_column, atoms_in_res,
+                    query['maximal_only'], query['max_subset_size'], approximate_center)
+
+    #Construct grid
+    if custom_center and custom_radius:
+        centroid = np.array(list(map(float, custom_center.strip('[]').split(','))))
+        radius = custom_radius
+
+    #Results of a previous calculation with the same structure and parameters
+    #are reused
+    if use_cache:
+        result_key = _result_key(inputfile, parameters, __version__)
+        results = _load_results(cache_dir, result_key)
+    else:
+        results = None
+    if results is None:
+        results = _search_frame((alphas, betas, carbons, nitrogens, oxygens, side_chains),
+                                ranges, cluster_query, queries, centroid, radius,
+                                grid_step, coarse_step, shell, consider_backbone_residues,
+                                backbone_clashes_threshold, sidechain_clashes_threshold,
+                                engine, kernel, cores_number, max_memory, pool)
+        if use_cache:
+            _store_results(cache_dir, result_key, results, cache_size * 1024**2)
+
+    query_sites = []
+    for i, (options, query_results) in enumerate(zip(query_options, results), 1):
+        sites = _query_sites(query_results, name_for_res)
+        for sink in sinks:
+            sink(inputfile, sites, options, None if len(queries) == 1 else i)
+        query_sites.append(sites)
+    if single_query:
+        return query_sites[0]
+    return query_sites
+
+def search_ensemble(inputfile, min_coordinators=3, min_sidechain=2,
+            residues='[ASP,HIS,GLU,CYS]', motif='', grid_step=1.0,
+            consider_backbone_residues='[]', cluster_cutoff=0.0,
+            propose_mutations_to='', custom_radius=None, custom_center=None,
+            cores_number=None, backbone_clashes_threshold=1.0,
+            sidechain_clashes_threshold=0.0, engine='dense', kernel='squared',
+            shell=False, coarse_step=None, maximal_only=False,
+            max_subset_size=None, frames=None, pool=None, sinks=(),
+            verbose=False, approximate_center=None, max_memory=None,
+            cache_dir=None, use_cache=False, cache_size=1024):
+    """
+    Searches the binding sites of every conformation of an ensemble (e.g. the
+    models of an NMR structure or the snapshots of a trajectory).
+
+    All the models are parsed once, and share the residue dictionaries and
+    coordination ranges. Every model is searched in the same grid (containing
+    all of them) with the same pool of workers, and the sites found in any
+    model are reported with the fraction of models where they are found (i.e.
+    their occupancy). Takes the same options than `search`, except
+    `queries`. The sites found in every model are cached as the results of
+    `search`.
+
+    Parameters
+    ----------
+    inputfile : str or list of str
+        Path of a structure file with several models (`MODEL` records, or
+        model numbers in mmCIF files), or paths of the structure files of
+        every model
+    frames : slice or iterable of int, optional
+        Indices (starting at 0) of the models searched. Defaults to all
+    pool : multiprocessing.Pool, optional
+        Pool of workers used for the calculation. If None, a new one is
+        created
+    sinks : iterable of callables, optional
+        Receive the input file, the list of ensemble sites, the options of the
+        query and the number of models searched
+
+    Returns
+    -------
+    list of EnsembleSite
+        Sites found in any model, sorted by occupancy and mean number of
+        probes
+    """
+    if isinstance(inputfile, str):
+        inputfiles = [inputfile]
+    else:
+        inputfiles = list(inputfile)
+    filename, file_extension = _split_extension(inputfiles[0])
+    for path in inputfiles:
+        if _split_extension(path)[1] not in ALLOWED_FILE_TYPES:
+            raise Exception("The input should be a file of a valid type: " + str(ALLOWED_FILE_TYPES))
+        if _split_extension(path)[1].replace('.gz', '') != file_extension.replace('.gz', ''):
+            raise Exception("All the models should be given in files of the same format")
+    options = {'residues': residues, 'motif': motif,
+                'propose_mutations_to': propose_mutations_to,
+                'min_coordinators': min_coordinators,
+                'min_sidechain': min_sidechain,
+                'consider_backbone_residues': consider_backbone_residues,
+                'cluster_cutoff': cluster_cutoff,
+                'maximal_only': maximal_only,
+                'max_subset_size': max_subset_size}
+    query = _parse_query(**options, verbose=verbose)
+    if engine not in ENGINES:
+        raise Exception("The engine should be one of: " + str(ENGINES))
+    if kernel not in KERNELS:
+        raise Exception("The kernel should be one of: " + str(KERNELS))
+    if not cores_number:
+        cores_number = psutil.cpu_count(logical=False)
+
+    #All the models are parsed once, sharing the residues of the first one
+    models = []
+    for path in inputfiles:
+        with _open_structure(path, _split_extension(path)[1]) as f:
+            models += _split_models(f, _split_extension(path)[1])
+    if isinstance(frames, slice):
+        models = models[frames]
+    elif frames is not None:
+        models = [models[i] for i in frames]
+    centroid, radius, alphas, betas, carbons, nitrogens, oxygens, column_for_res, res_for_column, name_for_res, atoms_in_res, side_chains = _parse_ensemble(models, file_extension)
+    del models
+
+    residues, propose_mutations_to, consider_backbone_residues = _merge_queries([query])
+    ranges = _residue_ranges(name_for_res, res_for_column, atoms_in_res, residues,
+                                propose_mutations_to, consider_backbone_residues)
+    def cluster_query(coordination_chunks, query):
+        return clustering(coordination_chunks, query['residues'], query['motifs'],
+                    query['min_coordinators'], query['min_sidechain'],
+                    query['consider_backbone_residues'], query['mutated_motif'],
+                    query['cluster_cutoff'], filename, name_for_res, res_for_column, atoms_in_res,
+                    query['maximal_only'], query['max_subset_size'], approximate_center)
+    if custom_center and custom_radius:
+        centroid = np.array(list(map(float, custom_center.strip('[]').split(','))))
+        radius = custom_radius
+
+    #Results of a previous calculation with the same models and parameters
+    #are reused
+    if use_cache:
+        if not cache_dir:
+            cache_dir = _default_cache_dir()
+        parameters = dict(options, ensemble=True, frames=repr(frames), grid_step=grid_step,
+                            custom_radius=custom_radius, custom_center=custom_center,
+                            backbone_clashes_threshold=backbone_clashes_threshold,
+                            sidechain_clashes_threshold=sidechain_clashes_threshold,
+                            engine=engine, kernel=kernel, shell=shell, coarse_step=coarse_step,
+                            approximate_center=approximate_center)
+        result_key = _result_key(inputfiles, parameters, get_versions()['version'])
+        frame_results = _load_results(cache_dir, result_key)
+    else:
+        frame_results = None
+
+    #The models are searched one after the other, with the chunks of every
+    #model distributed among the same workers
+    if frame_results is None:
+        own_pool = pool is None
+        if own_pool:
+            _prepare_workers()
+            pool = multiprocessing.Pool(cores_number)
+        try:
+            frame_results = []
+            for frame in zip(alphas, betas, carbons, nitrogens, oxygens, side_chains):
+                results = _search_frame(frame, ranges, cluster_query, [query], centroid, radius,
+                                        grid_step, coarse_step, shell, consider_backbone_residues,
+                                        backbone_clashes_threshold, sidechain_clashes_threshold,
+                                        engine, kernel, cores_number, max_memory, pool)
+                frame_results.append(results[0])
+        finally:
+            if own_pool:
+                pool.terminate()
+        if use_cache:
+            _store_results(cache_dir, result_key, frame_results, cache_size * 1024**2)
+
+    frame_sites = [_query_sites(results, name_for_res) for results in frame_results]
+    sites = _ensemble_sites(frame_sites)
+    for sink in sinks:
+        sink(inputfile, sites, options, len(frame_sites))
+    return sites
+
+def _ensemble_sites(frame_sites):
+    """
+    Gathers the sites found in every model of an ensemble.
+
+    Parameters
+    ----------
+    frame_sites : list of lists of Site
+        Sites found in every model
+
+    Returns
+    -------
+    list of EnsembleSite
+        Sites found in any model, sorted by occupancy and mean number of
+        probes (and by the first model where they are found)
+    """
+    found = {}
+    for frame, sites in enumerate(frame_sites):
+        for site in sites:
+            found.setdefault(site.residues, []).append((frame, site))
+    ensemble_sites = []
+    for coord_residues, occurrences in found.items():
+        frames = tuple(frame for frame, site in occurrences)
+        sites = tuple(site for frame, site in occurrences)
+        ensemble_sites.append(EnsembleSite(coord_residues, sites[0].names, frames,
+                                len(frames) / len(frame_sites),
+                                np.mean([site.num_probes for site in sites]),
+                                np.mean([site.center for site in sites], axis=0), sites))
+    return sorted(ensemble_sites, key=lambda x: (x.occupancy, x.num_probes), reverse=True)
+
+def run_many(inputfiles, cores_number=None, summary_file=None, cmd_str="", **kwargs):
+    """
+    Searches the binding sites of several structures with the same options.
+
+    A single pool of worker processes is created for all the structures, and
+    the chunks of the grid of every structure are distributed among them.
+    The results files of every structure are written as in `run`, and a
+    summary of all of them can be saved in `summary_file`. Structures that
+    can not be processed (e.g. an invalid file) are reported in the summary
+    and do not stop the calculation.
+
+    Parameters
+    ----------
+    inputfiles : list of str
+        Paths of the structure files (or PDB codes)
+    cores_number : int, optional
+        Number of worker processes. Defaults to all the physical cores
+    summary_file : str, optional
+        Path of the file where the summary is saved
+    cmd_str : str, optional
+        Command line of the calculation
+    **kwargs
+        Options of the calculation, as in `run`
+
+    Returns
+    -------
+    list of tuples
+        Every input file with the sites found (as returned by `run`), or the
+        exception raised when processing it
+    """
+    if not cores_number:
+        cores_number = psutil.cpu_count(logical=False)
+    outcomes = []
+    _prepare_workers()
+    with multiprocessing.Pool(cores_number) as pool:
+        for inputfile in inputfiles:
+            try:
+                results = run(inputfile, cores_number=cores_number, pool=pool,
+                                cmd_str=cmd_str, **kwargs)
+            except Exception as error:
+                print("{} could not be processed: {}".format(inputfile, error))
+                results = error
+            outcomes.append((inputfile, results))
+    if summary_file:
+        _write_summary(outcomes, summary_file, cmd_str, kwargs.get('queries') is not None)
+    return outcomes
+
+def _write_summary(outcomes, summary_file, cmd_str, several_queries=False):
+    """
+    Saves the number of sites and the most populated site of every structure.
+
+    Parameters
+    ----------
+    outcomes : list of tuples
+        Results of every structure, as returned by `run_many`
+    summary_file : str
+        Path of the summary file
+    cmd_str : str
+        Command line of the calculation
+    several_queries : bool, optional
+        Whether the outcomes contain the sites of several queries
+    """
+    lines = []
+    for inputfile, results in outcomes:
+        if isinstance(results, Exception):
+            lines.append((inputfile, '', 'Error', '', str(results)))
+            continue
+        if not several_queries:
+            results = [results]
+        for i, sites in enumerate(results, 1):
+            query_str = str(i) if len(results) > 1 else ''
+            if sites:
+                best_site = sites[0]
+                best_str = "{} ({} probes)".format(' '.join(res_name + ":" + res for res_name, res in zip(best_site.names, best_site.residues)),
+                                                    best_site.num_probes)
+            else:
+                best_str = ''
+            lines.append((inputfile, query_str, str(len(sites)), best_str, ''))
+    header = ('Structure', 'Query', 'Num. sites', 'Most populated site', 'Error')
+    widths = [max([len(header[i])] + [len(line[i]) for line in lines]) for i in range(len(header))]
+    with open(summary_file, "w") as f:
+        f.write("*****BioMetAll {}\n".format(get_versions()['version']))
+        f.write(cmd_str + '\n')
+        f.write(' ' + ' | '.join('{:{}}'.format(item, width) for item, width in zip(header, widths)) + ' \n')
+        f.write('-' + '-+-'.join('-'*width for width in widths) + '-\n')
+        for line in lines:
+            f.write(' ' + ' | '.join('{:{}}'.format(item, width) for item, width in zip(line, widths)) + ' \n')
+
+def _merge_queries(queries):
+    """
+    Residues tested for all the queries of a calculation.
+
+    Parameters
+    ----------
+    queries : list of dict
+        Options of every query, as returned by `_parse_query`
+
+    Returns
+    -------
+    list of str
+        Residue types tested by their side-chain
+    bool
+        Whether mutations are proposed in any query, i.e. every residue is
+        tested with all the types
+    list of str or str
+        Residue types tested by their backbone oxygen, `ALL`, or None
+    """
+    residues = list(dict.fromkeys(res_name for query in queries for res_name in query['residues']))
+    propose_mutations_to = any(query['mutated_motif'] for query in queries)
+    consider_backbone_residues = [query['consider_backbone_residues'] for query in queries if query['consider_backbone_residues']]
+    if "ALL" in consider_backbone_residues:
+        consider_backbone_residues = "ALL"
+    elif consider_backbone_residues:
+        consider_backbone_residues = list(dict.fromkeys(res_name for query_residues in consider_backbone_residues for res_name in query_residues))
+    else:
+        consider_backbone_residues = None
+    return residues, propose_mutations_to, consider_backbone_residues
+
+def _residue_ranges(name_for_res, res_for_column, atoms_in_res, residues,
+                    propose_mutations_to, consider_backbone_residues):
+    """
+    Calculates the coordination ranges of the residues of a structure.
+
+    The ranges only depend on the residues, so they are shared by all the
+    frames of an ensemble.
+
+    Parameters
+    ----------
+    name_for_res : dict
+        Name of the residue given its number:chain
+    res_for_column : dict
+        Correspondence between column number and number:chain of residue
+    atoms_in_res : dict
+        Name of atoms contained in a given residue
+    residues, propose_mutations_to, consider_backbone_residues
+        Residues tested, as returned by `_merge_queries`
+
+    Returns
+    -------
+    tuple
+        Per-residue thresholds (None if every residue is tested with all the
+        types), residue types tested, largest Metal-Alpha carbon distance
+        of those types, and the distance from every alpha carbon (followed by
+        every backbone oxygen, if tested) within which the probes are kept by
+        `_shell`
+    """
+    #Coordination ranges of every residue according to its own residue type.
+    #To propose mutations, every residue is tested with all the requested types
+    if propose_mutations_to:
+        thresholds = None
+    else:
+        thresholds = _residue_thresholds(name_for_res, res_for_column, atoms_in_res, residues)
+    tested_types = [res_name for res_name in DIST_PROBE_ALPHA if res_name in residues]
+    alpha_cutoff = max([DIST_PROBE_ALPHA[res_name][1] for res_name in tested_types], default=DIST_PROBE_OXYGEN[1])
+
+    #Distance from every atom within which a probe could be coordinated
+    if thresholds is not None:
+        alpha_cutoffs = thresholds[0][1]
+    else:
+        alpha_cutoffs = np.array([alpha_cutoff if ('CA' in atoms_in_res[res_for_column[column]]) and ('CB' in atoms_in_res[res_for_column[column]])
+                                    else -np.inf for column in range(len(res_for_column))])
+    shell_cutoffs = [alpha_cutoffs]
+    if consider_backbone_residues:
+        shell_cutoffs.append(np.array([DIST_PROBE_OXYGEN[1] if consider_backbone_residues == "ALL" or name_for_res[res_for_column[column]] in consider_backbone_residues
+                                    else -np.inf for column in range(len(res_for_column))]))
+    return thresholds, tested_types, alpha_cutoff, np.concatenate(shell_cutoffs)
+
+def _search_frame(frame, ranges, cluster_query, queries, centroid, radius,
+                    grid_step, coarse_step, shell, consider_backbone_residues,
+                    backbone_clashes_threshold, sidechain_clashes_threshold,
+                    engine, kernel, cores_number, max_memory=None, pool=None):
+    """
+    Searches the sites of every query in a set of coordinates of a structure.
+
+    Parameters
+    ----------
+    frame : tuple of np.array
+        Coordinates of the alpha carbons, beta carbons, backbone carbons,
+        backbone nitrogens, backbone oxygens and side-chain atoms
+    ranges : tuple
+        Coordination ranges of the residues, as returned by `_residue_ranges`
+    cluster_query : callable
+        Clusters the coordinations of the chunks according to a query
+    queries : list of dict
+        Options of every query, as returned by `_parse_query`
+    centroid : np.array
+        Center of the grid
+    radius : float
+        Radius of the grid
+    max_memory : float, optional
+        Maximum memory, in MB, used by the chunks being tested
+    pool : multiprocessing.Pool, optional
+        Pool of workers used for the calculation
+    Other options are the ones of `search`
+
+    Returns
+    -------
+    list of tuples
+        Sites and mutations found for every query, as returned by `clustering`
+    """
+    alphas, betas, carbons, nitrogens, oxygens, side_chains = frame
+    thresholds, tested_types, alpha_cutoff, shell_cutoffs = ranges
+
+    #Alpha-Beta and Oxygen-Carbon distances for further use
+    alpha_beta_distances = np.sqrt((np.square(betas-alphas).sum(axis=1)))
+    oxygen_carbon_distances = np.sqrt((np.square(carbons-oxygens).sum(axis=1)))
+
+    #Atoms near which a probe could be coordinated, to only keep those probes
+    if shell:
+        shell_atoms = np.concatenate((alphas, oxygens) if consider_backbone_residues else (alphas,))
+    else:
+        shell_atoms, shell_cutoffs = None, None
+
+    #Index backbone atoms to only test the residues near each probe, and
+    #side-chain atoms to find the clashes of the probes
+    if engine == 'cells':
+        cells = _backbone_cells(alphas, carbons, nitrogens, oxygens, backbone_clashes_threshold, alpha_cutoff,
+                                side_chains, sidechain_clashes_threshold)
+    elif sidechain_clashes_threshold > 0:
+        cells = {'sidechains': _sidechain_cells(side_chains, sidechain_clashes_threshold)}
+    else:
+        cells = None
+
+    test_grid = partial(_test_grid, alphas=alphas, betas=betas, carbons=carbons,
+                nitrogens=nitrogens, oxygens=oxygens, side_chains=side_chains,
+                alpha_beta_distances=alpha_beta_distances,
+                oxygen_carbon_distances=oxygen_carbon_distances,
+                consider_backbone_residues=consider_backbone_residues,
+                thresholds=thresholds, tested_types=tested_types, cells=cells,
+                bck_clashes=backbone_clashes_threshold,
+                sc_clashes=sidechain_clashes_threshold, engine=engine,
+                kernel=kernel, cores_number=cores_number,
+                max_memory=max_memory * 1024**2 if max_memory else None, pool=pool)
+    return _search_queries(test_grid, cluster_query, queries, centroid, radius,
+                            grid_step, coarse_step, shell_atoms, shell_cutoffs)
+
+def _query_sites(query_results, name_for_res):
+    """
+    Builds the sites found for a query.
+
+    Parameters
+    ----------
+    query_results : tuple
+        Sites and mutations of the query, as returned by `clustering`
+    name_for_res : dict
+        Name of the residue given its number:chain
+
+    Returns
+    -------
+    list of Site
+        Sites found, sorted by number of probes
+    """
+    centers, mutations = query_results
+    return [Site(coord_residues, center, num_probes, radius_search, np.array(probes),
+                    tuple(name_for_res[res.split("_")[0]] for res in coord_residues),
+                    mutations.get(coord_residues, []))
+                for coord_residues, center, num_probes, radius_search, probes
+                    in sorted(centers, key=lambda x: x[2], reverse=True)]
+
+def _search_queries(test_grid, cluster, queries, centroid, radius, grid_step,
+                    coarse_step, shell_atoms, shell_cutoffs):
+    """
+    Searches the sites of every query in the grid of the calculation.
+
+    Parameters
+    ----------
+    test_grid : callable
+        `_test_grid` with the arrays of the protein, yielding the
+        coordinations of the chunks of a grid
+    cluster : callable
+        Clusters the coordinations of the chunks according to a query
+    queries : list of dict
+        Options of every query, as returned by `_parse_query`
+    centroid : np.array
+        Center of the grid
+    radius : float
+        Radius of the grid
+    grid_step : float
+        Distance between two probes of the grid
+    coarse_step : float
+        Distance between two probes of the coarse grid used to find the
+        zones where the grid is refined. If None, the whole grid is tested
+    shell_atoms : np.array
+        Atoms near which the probes are kept (see `_shell`). If None, all the
+        probes of the grid are tested
+    shell_cutoffs : np.array
+        Distance within which a probe is kept, for every shell atom
+
+    Returns
+    -------
+    list of tuples
+        Sites and mutations found for every query, as returned by `clustering`
+    """
+    if coarse_step:
+        #The fine grid is only constructed around the probes of the sites
+        #found with a coarse grid. All the sites are kept while the zone
+        #grows, and the cutoff is only applied to the sites of the final grid
+        query = dict(queries[0], cluster_cutoff=0.0)
+        coarse_grid = _grid(centroid, radius, coarse_step)
+        if shell_atoms is not None:
+            coarse_grid = _shell(coarse_grid, shell_atoms, shell_cutoffs)
+        centers, mutations = _search_grid(test_grid, cluster, coarse_grid, query)
+        seeds, distances = np.empty((0, 3)), np.empty(0)
+        seed_distance = coarse_step
+        grid = None
+        while centers:
+            #The refined zone grows (with the neighbors of every probe of the
+            #sites) while the sites reach its borders
+            site_probes = np.unique(np.concatenate([one_center[4] for one_center in centers]), axis=0)
+            seeds = np.concatenate((seeds, site_probes))
+            distances = np.concatenate((distances, np.full(len(site_probes), seed_distance)))
+            seed_distance = 1.5 * grid_step
+            refined_grid = _refined_grid(centroid, radius, grid_step, seeds, distances)
+            if shell_atoms is not None:
+                refined_grid = _shell(refined_grid, shell_atoms, shell_cutoffs)
+            if grid is not None and len(refined_grid) == len(grid):
+                break
+            grid = refined_grid
+            centers, mutations = _search_grid(test_grid, cluster, grid, query)
+        if centers:
+            max_probes = max(one_center[2] for one_center in centers)
+            centers = [one_center for one_center in centers
+                        if one_center[2] >= max_probes*queries[0]['cluster_cutoff']]
+        return [(centers, mutations)]
+
+    grid = _grid(centroid, radius, grid_step)
+    if shell_atoms is not None:
+        grid = _shell(grid, shell_atoms, shell_cutoffs)
+    if len(queries) == 1:
+        return [_search_grid(test_grid, cluster, grid, queries[0])]
+    #The coordinations of the probes are tested only once, and kept in
+    #memory to be clustered by every query
+    coordination_chunks = _search_grid(test_grid, None, grid, None)
+    return [cluster(coordination_chunks, query) for query in queries]
+
+def _parse_query(residues, motif, propose_mutations_to, min_coordinators,
+                    min_sidechain, consider_backbone_residues, cluster_cutoff,
+                    maximal_only=False, max_subset_size=None, verbose=False):
+    """
+    Interprets the options of a query (i.e. what sites are searched).
+
+    Parameters
+    ----------
+    residues : str
+        Names of the residues considered as potentially coordinating, e.g.
+        `[ASP,HIS,GLU,CYS]`
+    motif : str
+        Motif to search, e.g. `[HIS,HIS,ASP/GLU]`
+    propose_mutations_to : str
+        Motif to complete by mutating residues, e.g. `[ASP]`
+    min_coordinators : int
+        Minimum number of coordinating residues of a site
+    min_sidechain : int
+        Minimum number of residues coordinating by their side-chain
+    consider_backbone_residues : str
+        Names of the residues considered as coordinating by their backbone
+        oxygen, `ALL` or `[]`
+    cluster_cutoff : float
+        Minimum number of probes of a site, relative to the largest one
+    maximal_only : bool, optional
+        Whether every probe is only added to the site formed by all its
+        coordinators, instead of to every site formed by a subset of them
+    max_subset_size : int, optional
+        Maximum number of coordinating residues of a site. If None, there is
+        no limit. Can not be used with `maximal_only`
+    verbose : bool, optional
+        Whether to print the adjustments of the options
 
+    Returns
+    -------
+    dict
+        Options of the query, with the motifs and residues as lists
+    """
     if motif:
         motifs = list(map(str, motif.strip('[]').split(',')))
         motifs_list = []
@@ -79,13 +894,13 @@ def run(inputfile, min_coordinators=3, min_sidechain=2,
         if min_coordinators < (len(motifs) + len(mutated_motif)):
             min_coordinators = len(motifs) + len(mutated_motif)
     elif propose_mutations_to and not motif:
-        print("To propose mutations is necessary to set a base motif with --motif parameter.")
-        sys.exit()
+        raise Exception("To propose mutations is necessary to set a base motif with --motif parameter.")
     elif motif:
         #min_coordinators should be at least len(motif)
         if min_coordinators < len(motifs):
             min_coordinators = len(motifs)
-            print("min_coordinators has been set to {} due to the motif length".format(len(motifs)))
+            if verbose:
+                print("min_coordinators has been set to {} due to the motif length".format(len(motifs)))
 
     #Set residues to consider as coordinating in backbone oxygens
     if consider_backbone_residues == '[]':
@@ -96,92 +911,137 @@ def run(inputfile, min_coordinators=3, min_sidechain=2,
     else:
         consider_backbone_residues = list(map(str, consider_backbone_residues.strip('[]').split(',')))
 
+    if max_subset_size is not None and max_subset_size < min_coordinators:
+        raise Exception("max_subset_size should be at least min_coordinators ({}).".format(min_coordinators))
+    #The site of all the coordinators of a probe can not be capped without
+    #changing the counts of its sub-sites
+    if max_subset_size is not None and maximal_only:
+        raise Exception("max_subset_size can not be used with maximal_only.")
 
-    t0 = time.time()
+    return {'residues': residues, 'motif': motif, 'motifs': motifs,
+            'propose_mutations_to': propose_mutations_to,
+            'mutated_motif': mutated_motif, 'min_coordinators': min_coordinators,
+            'min_sidechain': min_sidechain,
+            'consider_backbone_residues': consider_backbone_residues,
+            'cluster_cutoff': cluster_cutoff, 'maximal_only': maximal_only,
+            'max_subset_size': max_subset_size}
 
-    if not cores_number:
-        cores_number = psutil.cpu_count(logical=False)
-    pool = multiprocessing.Pool(cores_number)
+def _write_ensemble_results(sites, inputfile, motif, n_frames, pdb, cmd_str,
+                            __version__, t0):
+    """
+    Prints the sites found in an ensemble and saves them in the results file.
 
-    #Parse inputfile to obtain atom coords
-    if file_extension in ALLOWED_FILE_TYPES:
-        with open(inputfile, "r") as f:
-            lines = f.read().splitlines()
-    elif file_extension == "":
-        try:
-            response = urllib.request.urlretrieve('http://files.rcsb.org/download/%s.pdb' % (filename), '%s.pdb' % (filename))
-            file_extension = ".pdb"
-            with open(filename + file_extension, "r") as f:
-                lines = f.read().splitlines()
-        except:
-            raise Exception("The input should be a valid PDB code or a file of a valid type: " + str(ALLOWED_FILE_TYPES))
+    Parameters
+    ----------
+    sites : list of EnsembleSite
+        Sites found, sorted by occupancy
+    inputfile : str
+        Path of the input file, whose directory and name are used for the
+        results file
+    motif : str
+        Motif searched, to name the results file
+    n_frames : int
+        Number of models searched
+    pdb : bool
+        Whether to save the probes of every site in a `.pdb` file, with its
+        mean center and the probes found in all the models
+    cmd_str : str
+        Command line of the calculation
+    __version__ : str
+        Version of BioMetAll
+    t0 : float
+        Starting time of the calculation
+    """
+    filename = _split_extension(inputfile)[0]
+    if motif:
+        file_name_addendum = "_" + motif.replace("[", "").replace("]", "").replace(",", "_").replace("/", "-")
     else:
-        raise Exception("The input should be a valid PDB code or a file of a valid type: " + str(ALLOWED_FILE_TYPES))
+        file_name_addendum = ""
+    if pdb:
+        #Every site is written with its mean center and the probes of all
+        #the models where it is found
+        pdb_filename = "probes_%s%s_ensemble.pdb" %(os.path.basename(filename), file_name_addendum)
+        pdb_filename = os.path.join(os.path.dirname(inputfile), pdb_filename)
+        _print_pdb([(site.residues, site.center, site.num_probes, None,
+                        np.unique(np.concatenate([frame_site.probes for frame_site in site.sites]), axis=0))
+                    for site in sites], pdb_filename)
+    header = ('#', 'Coordinating residues', 'Occupancy', 'Models', 'Mean num. probes', 'Mean coordinates of center')
+    lines = []
+    for pos, site in enumerate(sites, 1):
+        residues_str = ' '.join(str(res_name) + ":" + res for res_name, res in zip(site.names, site.residues))
+        lines.append((str(pos), residues_str, format(site.occupancy, '.3f'),
+                        "{}/{}".format(len(site.frames), n_frames), format(site.num_probes, '.1f'),
+                        ' '.join(format(r, '.3f') for r in site.center)))
+    widths = [max([len(header[i])] + [len(line[i]) for line in lines]) for i in range(len(header))]
+    text = [' ' + ' | '.join('{:^{}}'.format(item, width) for item, width in zip(header, widths)) + ' ',
+            '-' + '-+-'.join('-'*width for width in widths) + '-']
+    for line in lines:
+        text.append(' {:>{}} | {:<{}} | {:>{}} | {:>{}} | {:>{}} | {:^{}} '.format(
+                        *[value for item, width in zip(line, widths) for value in (item, width)]))
+    print('\n'.join(text))
 
-    centroid, radius, alphas, betas, carbons, nitrogens, oxygens, column_for_res, res_for_column, name_for_res, atoms_in_res, side_chains = _parse_molecule(lines, file_extension)
+    text_filename = "results_biometall_%s%s_ensemble.txt" %(os.path.basename(filename), file_name_addendum)
+    text_filename = os.path.join(os.path.dirname(inputfile), text_filename)
+    with open(text_filename, "w") as f:
+        f.write("*****BioMetAll {}\n".format(__version__))
+        f.write(cmd_str + '\n')
+        for line in text:
+            f.write(line + '\n')
+        f.write("*****Calculation took {0:.2f} seconds".format(time.time() - t0))
+    print("{0:.2f} seconds".format(time.time() - t0))
 
-    #Alpha-Beta and Oxygen-Carbon distances for further use
-    alpha_beta_distances = np.sqrt((np.square(betas-alphas).sum(axis=1)))
-    oxygen_carbon_distances = np.sqrt((np.square(carbons-oxygens).sum(axis=1)))
+def _write_results(sites, inputfile, motif, propose_mutations_to, pdb, cmd_str,
+                    __version__, t0, suffix="", subsites=None):
+    """
+    Prints the sites found and saves them in the results files.
 
-    #Construct grid
-    if custom_center and custom_radius:
-        centroid = np.array(list(map(float, custom_center.strip('[]').split(','))))
-        radius = custom_radius
-    grid = _grid(centroid, radius, grid_step)
-
-    #Split grid in chunks (to ensure a good use of the memory/processors)
-    n = _chunk_size(len(grid), len(alphas), cores_number)
-
-    grids = [grid[i * n:(i + 1) * n] for i in range((len(grid) + n - 1) // n )]
-
-    coordination_chunks = pool.map(partial(_test_chunk, alphas=alphas,
-                        betas=betas, carbons=carbons, nitrogens=nitrogens,
-                        oxygens=oxygens, side_chains=side_chains,
-                        alpha_beta_distances=alpha_beta_distances,
-                        oxygen_carbon_distances=oxygen_carbon_distances,
-                        name_for_res=name_for_res,
-                        column_for_res=column_for_res,
-                        res_for_column=res_for_column,
-                        atoms_in_res=atoms_in_res,
-                        consider_backbone_residues=consider_backbone_residues,
-                        DIST_PROBE_ALPHA=DIST_PROBE_ALPHA,
-                        DIST_PROBE_BETA=DIST_PROBE_BETA,
-                        ANGLE_PAB=ANGLE_PAB,
-                        bck_clashes=backbone_clashes_threshold,
-                        sc_clashes=sidechain_clashes_threshold), grids)
-
-    centers, mutations = clustering(coordination_chunks, residues, motifs, min_coordinators, min_sidechain,
-                    consider_backbone_residues, mutated_motif, cluster_cutoff, filename, name_for_res, res_for_column, atoms_in_res)
-    #Print results
-    sorted_data = sorted(centers, key=lambda x: x[2], reverse=True)
+    Parameters
+    ----------
+    sites : list of Site
+        Sites found, sorted by number of probes
+    inputfile : str
+        Path of the input file, whose directory and name are used for the
+        results files
+    motif : str
+        Motif searched, to name the results files
+    propose_mutations_to : str
+        Motif to complete by mutations, if any
+    pdb : bool
+        Whether to save the probes of every site in a `.pdb` file
+    cmd_str : str
+        Command line of the calculation
+    __version__ : str
+        Version of BioMetAll
+    t0 : float
+        Starting time of the calculation
+    suffix : str, optional
+        Added to the name of the results files
+    subsites : list of tuples, optional
+        Sub-sites of maximal sites, as returned by `_subsite_counts`, listed
+        after the sites
+    """
+    filename = _split_extension(inputfile)[0]
     if motif:
         file_name_addendum = "_" + motif.replace("[", "").replace("]", "").replace(",", "_").replace("/", "-")
     else:
         file_name_addendum = ""
+    file_name_addendum += suffix
     if pdb:
         pdb_filename = "probes_%s%s.pdb" %(os.path.basename(filename), file_name_addendum)
         pdb_filename = os.path.join(os.path.dirname(inputfile), pdb_filename)
-        _print_pdb(sorted_data, pdb_filename)
+        _print_pdb(sites, pdb_filename)
 
     mutations_width, radius_width, coord_width, probes_width, residues_width, pos_width = len('Proposed mutations'), len('Radius search'), len('Coordinates of center'), len('Num. probes'), len('Coordinating residues'), 1
     lines=[]
-    for pos, one_center in enumerate(sorted_data,1):
-        residues = []
-        for res in one_center[0]:
-            if not "_BCK" in res:
-                residues.append(str(name_for_res[res]) + ":" + res)
-            else:
-                res_bck = res.split("_")[0]
-                residues.append(str(name_for_res[res_bck]) + ":" + res_bck + "_BCK")
-                continue
+    for pos, site in enumerate(sites,1):
+        residues = [str(res_name) + ":" + res for res_name, res in zip(site.names, site.residues)]
 
         residues_str = ' '.join(res for res in residues)
-        coord_str = ' '.join([str(format(r, '.3f')) for r in one_center[1]])
-        pos_str, radius_str, probes_str = str(pos), str(format(one_center[3], '.3f')), str(one_center[2])
+        coord_str = ' '.join([str(format(r, '.3f')) for r in site.center])
+        pos_str, radius_str, probes_str = str(pos), str(format(site.radius, '.3f')), str(site.num_probes)
 
         if propose_mutations_to:
-            mutations_str = ' '.join([str(res) + ":" + str(mut) for (res,mut) in mutations[one_center[0]]])
+            mutations_str = ' '.join([str(res) + ":" + str(mut) for (res,mut) in site.mutations])
             if len(mutations_str) > mutations_width:
                 mutations_width = len(mutations_str)
         else:
@@ -206,6 +1066,21 @@ def run(inputfile, min_coordinators=3, min_sidechain=2,
                 line[0], line[1], line[2], line[3], line[4], line[5], pos_width=pos_width, residues_width=residues_width,
                 coord_width=coord_width, probes_width=probes_width, radius_width=radius_width, mutations_width=mutations_width))
 
+    #Sub-sites, with the number of probes derived from the maximal sites
+    subsite_lines = []
+    if subsites:
+        subsite_rows = [(str(pos), ' '.join(str(res_name) + ":" + res for res_name, res in zip(names, coord_residues)), str(num_probes))
+                            for pos, (coord_residues, names, num_probes) in enumerate(subsites, 1)]
+        widths = [max([len(header)] + [len(row[i]) for row in subsite_rows])
+                    for i, header in enumerate(('#', 'Sub-site residues', 'Num. probes'))]
+        subsite_lines.append('')
+        subsite_lines.append(' {:>{}} | {:^{}} | {:{}} '.format('#', widths[0], 'Sub-site residues', widths[1], 'Num. probes', widths[2]))
+        subsite_lines.append('-{}-+-{}-+-{}-'.format('-'*widths[0], '-'*widths[1], '-'*widths[2]))
+        for row in subsite_rows:
+            subsite_lines.append(' {:>{}} | {:<{}} | {:>{}} '.format(row[0], widths[0], row[1], widths[1], row[2], widths[2]))
+        for subsite_line in subsite_lines:
+            print(subsite_line)
+
     text_filename = "results_biometall_%s%s.txt" %(os.path.basename(filename), file_name_addendum)
     text_filename = os.path.join(os.path.dirname(inputfile), text_filename)
     f = open(text_filename, "w")
@@ -222,179 +1097,655 @@ def run(inputfile, min_coordinators=3, min_sidechain=2,
         f.write(' {:>{pos_width}} | {:<{residues_width}} | {:^{coord_width}} | {:>{probes_width}} | {:<{radius_width}} | {:<{mutations_width}} \n'.format(
                 line[0], line[1], line[2], line[3], line[4], line[5], pos_width=pos_width, residues_width=residues_width,
                 coord_width=coord_width, probes_width=probes_width, radius_width=radius_width, mutations_width=mutations_width))
+    for subsite_line in subsite_lines:
+        f.write(subsite_line + '\n')
     f.write("*****Calculation took {0:.2f} seconds".format(time.time() - t0))
     f.close()
     print("{0:.2f} seconds".format(time.time() - t0))
 
+def _test_grid(grid, alphas, betas, carbons, nitrogens, oxygens, side_chains,
+                alpha_beta_distances, oxygen_carbon_distances,
+                consider_backbone_residues, thresholds, tested_types, cells,
+                bck_clashes, sc_clashes, engine, kernel, cores_number,
+                max_memory=None, pool=None):
+    """
+    Tests the coordination of all the probes of a grid.
+
+    The grid is split in chunks that are evaluated in parallel, and the
+    results of every chunk are yielded as soon as they are available. If no
+    `pool` of workers is given, a new one is created for the grid.
+
+    Yields
+    ------
+    tuple
+        Position of the first probe of the chunk in the grid, probes of the
+        chunk, and their coordinations and discarded residues (as returned by
+        `_test_chunk`), in completion order
+    """
+    #Split grid in chunks (to ensure a good use of the memory/processors)
+    n = _chunk_size(len(grid), len(alphas), cores_number, max_memory, engine,
+                    kernel, sc_clashes)
+
+    bounds = [(i * n, min((i + 1) * n, len(grid))) for i in range((len(grid) + n - 1) // n )]
+
+    #Grid and protein arrays are placed once in shared memory, and the workers
+    #attach to them by name instead of receiving a pickled copy for each chunk
+    arrays = {'grid': grid, 'alphas': alphas, 'betas': betas, 'carbons': carbons,
+                'nitrogens': nitrogens, 'oxygens': oxygens, 'side_chains': side_chains,
+                'alpha_beta_distances': alpha_beta_distances,
+                'oxygen_carbon_distances': oxygen_carbon_distances}
+    if thresholds is not None:
+        arrays['thresholds'] = np.array(thresholds)
+    if cells is not None:
+        for cell_key, cell_list in cells.items():
+            for i, item in enumerate(cell_list):
+                arrays['cells:%s:%d' % (cell_key, i)] = np.asarray(item)
+    shared_block, shared = _share_arrays(arrays)
+    #Calculations of several structures can share a pool of workers
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(cores_number)
+    try:
+        #Only a few chunks are kept in memory at the same time
+        results = _imap_bounded(pool, partial(_test_shared_chunk,
+                    shared=shared,
+                    consider_backbone_residues=consider_backbone_residues,
+                    DIST_PROBE_ALPHA={res_name: DIST_PROBE_ALPHA[res_name] for res_name in tested_types},
+                    DIST_PROBE_BETA={res_name: DIST_PROBE_BETA[res_name] for res_name in tested_types},
+                    ANGLE_PAB={res_name: ANGLE_PAB[res_name] for res_name in tested_types},
+                    bck_clashes=bck_clashes, sc_clashes=sc_clashes,
+                    engine=engine, kernel=kernel), bounds, 2 * cores_number)
+        try:
+            for (start, end), coords, discarded in results:
+                yield start, grid[start:end], coords, discarded
+        finally:
+            results.close()
+    finally:
+        if own_pool:
+            pool.terminate()
+        _release_arrays(shared_block)
+
+def _search_grid(test_grid, cluster, grid, query):
+    """
+    Tests the coordination of the probes of a grid and clusters them.
+
+    Chunks are clustered as soon as they are computed. The pool of workers is
+    always released, even if the clustering fails.
+
+    Parameters
+    ----------
+    test_grid : callable
+        `_test_grid` with the protein data
+    cluster : callable
+        Clustering of the chunks for a query. If None, the chunks are returned
+    grid : np.array
+        Probes to test
+    query : dict
+        Options of the query, as returned by `_parse_query`
+
+    Returns
+    -------
+    tuple or list
+        Sites and mutations, as returned by `clustering`, or the list of the
+        chunks if `cluster` is None
+    """
+    coordination_chunks = test_grid(grid)
+    try:
+        if cluster is None:
+            return list(coordination_chunks)
+        return cluster(coordination_chunks, query)
+    finally:
+        coordination_chunks.close()
+
 def clustering(coordination_chunks, residues, motifs, min_coordinators, min_sidechain,
             consider_backbone_residues, mutated_motif, cluster_cutoff, filename,
-            name_for_res, res_for_column, atoms_in_res):
+            name_for_res, res_for_column, atoms_in_res, maximal_only=False,
+            max_subset_size=None, approximate_center=None):
+    """
+    Groups the probes by coordinating environment.
+
+    A probe belongs to every environment formed by a subset of its
+    coordinators fulfilling the minimum requirements (with at most
+    `max_subset_size` coordinators), or only to the environment formed by all
+    its coordinators if `maximal_only` is set (which is not capped by
+    `max_subset_size`). The center of the sites with
+    more than `approximate_center` probes is approximated.
+
+    Chunks can be given in any order. Every probe gets a key (the position in
+    `residues` of its first coordinating residue type and its position in the
+    grid), and probes, environments and mutations are sorted by these keys at
+    the end, so the results do not depend on the chunking of the grid nor on
+    the order in which the chunks are computed.
+
+    `coordination_chunks` is an iterable of tuples with the position of the
+    first probe of each chunk in the grid, the probes of the chunk, the table
+    of their coordinations and the bitmask of discarded probes (as returned
+    by `_test_chunk`).
+    """
     dict_cluster = {}
-    dict_mutations = {}
+    #Probes proposing every mutation of a residue, by environment, and the
+    #key of the first probe proposing it
+    mutation_counts = {}
+    mutation_keys = {}
+    environment_keys = {}
     centers = []
     if motifs:
-        motif_possibilities = list(itertools.product(*motifs))
+        #Probes with the same names of coordinators match the same multisets
+        #of the motif
+        compiled_motif = _compile_motif(_motif_combinations(motifs))
+        motif_memo = {}
     if mutated_motif:
-        mutated_motif_possibilities = list(itertools.product(*mutated_motif))
+        #Probes with the same resting coordinators can achieve the same
+        #mutated motifs
+        compiled_mutated_motif = _compile_motif(_motif_combinations(mutated_motif))
         residues_of_mutated_motif = set(x for l in mutated_motif for x in l)
+        mutation_memo = {}
 
-    for probes, coordinations, discarded in coordination_chunks:
-        coordinators = {}
-        for possible_coord_name in residues: #Sidechain coordinations
-            for probe_idx, res_idx in coordinations[possible_coord_name][0,:,:]:
-                if not mutated_motif and (possible_coord_name != name_for_res[res_for_column[res_idx]]): #discarded due to different residue name
-                    continue
-                if probe_idx in discarded: #residue is discarded for that probe
-                    continue
-                elif ('CA' not in atoms_in_res[res_for_column[res_idx]]) or ('CB' not in atoms_in_res[res_for_column[res_idx]]):
-                    continue
-                else: #coordination is valid for that probe and residue
-                    if probe_idx not in list(coordinators):
-                        coordinators[probe_idx] = {res_idx: [possible_coord_name]}
-                    else:
-                        if res_idx not in list(coordinators[probe_idx]):
-                            coordinators[probe_idx][res_idx] = [possible_coord_name]
-                        else:
-                            coordinators[probe_idx][res_idx].append(possible_coord_name)
+    #Position of the residue type of every column in `residues`, to sort the
+    #sidechain coordinations computed with per-residue thresholds
+    residue_position = {res_name: i for i, res_name in enumerate(residues)}
+    column_position = np.array([residue_position.get(name_for_res[res_for_column[column]], len(residues))
+                                for column in range(len(res_for_column))])
+    column_names = np.array([name_for_res[res_for_column[column]] for column in range(len(res_for_column))])
+    #Residues without alpha or beta carbons do not coordinate by their sidechain
+    has_sidechain = np.array([('CA' in atoms_in_res[res_for_column[column]]) and ('CB' in atoms_in_res[res_for_column[column]])
+                                for column in range(len(res_for_column))], dtype=bool)
+    if consider_backbone_residues == "ALL":
+        has_backbone = np.ones(len(res_for_column), dtype=bool)
+    else:
+        has_backbone = np.isin(column_names, consider_backbone_residues or [])
+    #Environments are bitsets over the columns, with the backbones in a second
+    #bit space, and their coordinators are sorted by their labels
+    n_columns = len(res_for_column)
+    labels = [res_for_column[column] for column in range(n_columns)] + \
+                [str(res_for_column[column]) + "_BCK" for column in range(n_columns)]
+    bit_rank = [0] * len(labels)
+    for rank, bit in enumerate(sorted(range(len(labels)), key=labels.__getitem__)):
+        bit_rank[bit] = rank
+    environment_subsets = {}
+
+    #Probes with the same coordinations (the same residues, tested as the same
+    #types) belong to the same environments, so they are grouped by their
+    #coordinations and every distinct group is processed once
+    probe_groups = {}
+    for offset, probes, (probe_indices, res_indices, types), discarded in coordination_chunks:
+        #Coordinations of discarded probes (or residues) are not valid
+        is_valid = ~np.unpackbits(discarded, count=len(probes)).astype(bool)[probe_indices]
+        is_sidechain = is_valid & has_sidechain[res_indices]
+        #Each residue already tested with its own type. Residue types only
+        #tested for other queries are not considered
+        selected = np.flatnonzero(is_sidechain & (types == COORDINATION_TYPES.index("SC")) &
+                                    (column_position[res_indices] < len(residues)))
+        selected = selected[np.argsort(column_position[res_indices[selected]], kind='stable')]
+        rows = [selected]
+        row_positions = [column_position[res_indices[selected]]]
+        #Each residue tested with all the types
+        for position, possible_coord_name in enumerate(residues):
+            if possible_coord_name not in COORDINATION_TYPES:
+                continue
+            is_selected = is_sidechain & (types == COORDINATION_TYPES.index(possible_coord_name))
+            if not mutated_motif: #discarded due to different residue name
+                is_selected &= column_names[res_indices] == possible_coord_name
+            rows.append(np.flatnonzero(is_selected))
+            row_positions.append(np.full(len(rows[-1]), position))
         if consider_backbone_residues:
-            for probe_idx, res_idx in coordinations["BCK"][0,:,:]:
-                if probe_idx in discarded:
+            #Only the backbones of the searched residues are considered
+            rows.append(np.flatnonzero(is_valid & (types == COORDINATION_TYPES.index("BCK")) & has_backbone[res_indices]))
+            row_positions.append(np.full(len(rows[-1]), len(residues)))
+        rows = np.concatenate(rows)
+        if not len(rows):
+            continue
+        order = np.argsort(probe_indices[rows], kind='stable')
+        rows = rows[order]
+        row_probes = probe_indices[rows]
+        #Coordinations of every probe, as (column, position of the type) pairs
+        pairs = np.column_stack((res_indices[rows], np.concatenate(row_positions)[order])).astype(np.int32)
+        starts = np.flatnonzero(np.r_[True, row_probes[1:] != row_probes[:-1]])
+        counts = np.diff(np.append(starts, len(rows)))
+        if motifs:
+            #Probes coordinated by less residues of their own type than the
+            #length of the motif can not match it, and are not grouped
+            is_actual = column_names[pairs[:,0]] == np.append(np.array(residues, dtype=object), None)[pairs[:,1]]
+            is_matching = np.add.reduceat(is_actual, starts) >= len(motifs)
+            if not is_matching.all():
+                is_kept = np.repeat(is_matching, counts)
+                rows, row_probes, pairs = rows[is_kept], row_probes[is_kept], pairs[is_kept]
+                if not len(rows):
                     continue
-                if (name_for_res[res_for_column[res_idx]] not in consider_backbone_residues) and consider_backbone_residues != "ALL": #discarded due to not searched residue
-                    continue
-                else: #coordination is valid for that probe and residue
-                    if probe_idx not in list(coordinators):
-                        coordinators[probe_idx] = {res_idx: [name_for_res[res_for_column[res_idx]] + "_BCK"]}
-                    else:
-                        if res_idx not in list(coordinators[probe_idx]):
-                            coordinators[probe_idx][res_idx] = [name_for_res[res_for_column[res_idx]] + "_BCK"]
-                        else:
-                            coordinators[probe_idx][res_idx].append(name_for_res[res_for_column[res_idx]] + "_BCK")
-        for probe_idx in list(coordinators):
-            if motifs:
-                #A minimum motif should be accomplished without mutations (contained in motifs/motif_possibilities)
-                actual_motif_solutions = _check_actual_motif(motif_possibilities, coordinators[probe_idx], name_for_res, res_for_column)
-            if mutated_motif:
-                #The resting coordinators of each solution should be mutable to complete the propose_mutations_to motif
-                mutation_motif_solutions = {}
-                for actual_motif_solution in actual_motif_solutions:
-                    resting_coordinators = copy.deepcopy(coordinators[probe_idx])
-                    for r in actual_motif_solution:
-                        del resting_coordinators[r]
-                    mutation_motif_solutions = _check_possible_mutations(mutated_motif_possibilities, residues_of_mutated_motif, resting_coordinators)
-
-            if motifs and mutated_motif and actual_motif_solutions and mutation_motif_solutions:
-                #Searching for already present motifs plus proposing mutations
-                #already present motifs
-                for actual_motif_solution in actual_motif_solutions:
-                    item = [probes[probe_idx], tuple(sorted([res_for_column[c] for c in actual_motif_solution]))]
-                    if item[1] not in list(dict_cluster):
-                        dict_cluster[item[1]] = [item[0]]
-                    else:
-                        dict_cluster[item[1]] += [item[0]]
-                    #Mutation information
-                    for m in list(mutation_motif_solutions):
-                        if item[1] not in dict_mutations:
-                            dict_mutations[item[1]] = {res_for_column[m]: [[el, 1] for el in mutation_motif_solutions[m]]}
-                        else:
-                            if res_for_column[m] not in dict_mutations[item[1]]:
-                                dict_mutations[item[1]][res_for_column[m]] = [[el, 1] for el in mutation_motif_solutions[m]]
-                            else:
-                                for el1 in mutation_motif_solutions[m]:
-                                    if el1 not in [el2[0] for el2 in dict_mutations[item[1]][res_for_column[m]]]:
-                                        dict_mutations[item[1]][res_for_column[m]].append([el1, 1])
-                                    else:
-                                        for el2 in dict_mutations[item[1]][res_for_column[m]]:
-                                            if el1 == el2[0]:
-                                                el2[1] += 1
-                                                break
-            elif motifs and not mutated_motif:
-                #Searching for already present motifs
-                for actual_motif_solution in actual_motif_solutions:
-                    item = [probes[probe_idx], tuple(sorted([res_for_column[c] for c in actual_motif_solution]))]
-                    if item[1] not in list(dict_cluster):
-                        dict_cluster[item[1]] = [item[0]]
+                starts = np.flatnonzero(np.r_[True, row_probes[1:] != row_probes[:-1]])
+                counts = np.diff(np.append(starts, len(rows)))
+        #Padded row of coordinations of every probe, to group them in bulk
+        padded = np.full((len(starts), counts.max(), 2), -1, dtype=np.int32)
+        padded[np.repeat(np.arange(len(starts)), counts), np.arange(len(rows)) - np.repeat(starts, counts)] = pairs
+        padded = padded.reshape(len(starts), -1)
+        _, first, inverse = np.unique(padded.view(np.dtype((np.void, padded.shape[1] * 4))).ravel(),
+                                        return_index=True, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        split = np.cumsum(np.bincount(inverse))[:-1]
+        for group, members in zip(first.tolist(), np.split(row_probes[starts[order]], split)):
+            encoding = padded[group, :2*counts[group]].tobytes()
+            probe_groups.setdefault(encoding, []).append((offset + members, probes[members]))
+
+    for encoding, members in probe_groups.items():
+        pairs = np.frombuffer(encoding, dtype=np.int32).reshape(-1, 2).tolist()
+        indices = np.concatenate([probe_indices for probe_indices, group_probes in members])
+        group = (pairs[0][1], indices, np.concatenate([group_probes for probe_indices, group_probes in members]))
+        #The key of the group is the key of its first probe
+        probe_key = (pairs[0][1], int(indices.min()))
+        coordinators = {}
+        for res_idx, position in pairs:
+            if position < len(residues):
+                coordinators.setdefault(res_idx, []).append(residues[position])
+            else:
+                coordinators.setdefault(res_idx, []).append(name_for_res[res_for_column[res_idx]] + "_BCK")
+        if motifs:
+            #A minimum motif should be accomplished without mutations (contained in motifs/motif_possibilities)
+            actual_motif_solutions = _check_actual_motif(compiled_motif, coordinators, name_for_res, res_for_column, motif_memo)
+        if mutated_motif:
+            #The resting coordinators of each solution should be mutable to complete the propose_mutations_to motif.
+            #The mutations of the last solution are proposed for all of them
+            mutation_motif_solutions = {}
+            if actual_motif_solutions:
+                actual_motif_solution = list(actual_motif_solutions)[-1]
+                resting_coordinators = {r: coordinators[r] for r in coordinators if r not in actual_motif_solution}
+                mutation_motif_solutions = _check_possible_mutations(compiled_mutated_motif, residues_of_mutated_motif, resting_coordinators, mutation_memo)
+
+        if motifs and mutated_motif and actual_motif_solutions and mutation_motif_solutions:
+            #Searching for already present motifs plus proposing mutations
+            #already present motifs
+            for solution_position, actual_motif_solution in enumerate(actual_motif_solutions):
+                coord_environment = sum(1 << c for c in actual_motif_solution)
+                _add_probes(dict_cluster, environment_keys, coord_environment, group, probe_key, solution_position)
+                #Mutation information, with the key of the first probe proposing each mutation
+                environment_counts = mutation_counts.setdefault(coord_environment, {})
+                for m_position, m in enumerate(mutation_motif_solutions):
+                    residue_counts = environment_counts.setdefault(res_for_column[m], Counter())
+                    for el_position, el in enumerate(sorted(mutation_motif_solutions[m])):
+                        residue_counts[el] += len(indices)
+                        mutation_key = (probe_key, solution_position, m_position, el_position)
+                        previous_key = mutation_keys.setdefault((coord_environment, res_for_column[m], el), mutation_key)
+                        if mutation_key < previous_key:
+                            mutation_keys[(coord_environment, res_for_column[m], el)] = mutation_key
+        elif motifs and not mutated_motif:
+            #Searching for already present motifs
+            for solution_position, actual_motif_solution in enumerate(actual_motif_solutions):
+                coord_environment = sum(1 << c for c in actual_motif_solution)
+                _add_probes(dict_cluster, environment_keys, coord_environment, group, probe_key, solution_position)
+        elif not motifs and not mutated_motif:
+            #Searching number of coordinators
+            sidechain_coord = []
+            bck_coord = []
+            for item in list(coordinators):
+                actual_residue_name = name_for_res[res_for_column[item]]
+                if actual_residue_name in coordinators[item]:
+                    sidechain_coord.append(item)
+                if actual_residue_name + "_BCK" in coordinators[item]:
+                    bck_coord.append(n_columns + item)
+            if ((len(sidechain_coord) + len(bck_coord)) >= min_coordinators) and (len(sidechain_coord) >= min_sidechain):
+                #The probes belong to every environment formed by a subset
+                #of their coordinators fulfilling the minimum requirements
+                c = tuple(sorted(sidechain_coord + bck_coord, key=bit_rank.__getitem__))
+                if c not in environment_subsets:
+                    if maximal_only:
+                        environment_subsets[c] = _coordinator_subsets(c, len(c), min_sidechain, n_columns)
                     else:
-                        dict_cluster[item[1]] += [item[0]]
-            elif not motifs and not mutated_motif:
-                #Searching number of coordinators
-                sidechain_coord = []
-                bck_coord = []
-                for item in list(coordinators[probe_idx]):
-                    actual_residue_name = name_for_res[res_for_column[item]]
-                    if actual_residue_name in coordinators[probe_idx][item]:
-                        sidechain_coord.append(res_for_column[item])
-                    if actual_residue_name + "_BCK" in coordinators[probe_idx][item]:
-                        bck_coord.append(str(res_for_column[item]) + "_BCK")
-                if ((len(sidechain_coord) + len(bck_coord)) >= min_coordinators) and (len(sidechain_coord) >= min_sidechain):
-                    c = tuple(sorted(sidechain_coord + bck_coord))
-                    for coord_environment in list(dict_cluster):
-                        if set(c).issuperset(coord_environment):
-                            dict_cluster[coord_environment] += [probes[probe_idx]]
-                    coordination_possibilities = []
-                    for i in range(min_coordinators, len(c)+1):
-                        coordination_possibilities += list(itertools.combinations(c,i))
-                    coordination_possibilities = [tuple(sorted(el)) for el in coordination_possibilities]
-                    for el in coordination_possibilities:
-                        sc_num = sum("BCK" not in L for L in el)
-                        if (el not in dict_cluster) and sc_num >= min_sidechain:
-                            dict_cluster[el] = [probes[probe_idx]]
-
-    #Order Mutation information
-    for coord_environment in list(dict_mutations):
-        for residue in list(dict_mutations[coord_environment]):
-            dict_mutations[coord_environment][residue].sort(key = lambda x: x[1], reverse=True)   #order every residue by number of probes
-    for coord_environment in list(dict_mutations):
-        dict_mutations[coord_environment] = sorted(dict_mutations[coord_environment].items(), key=lambda item: item[1][0][1], reverse=True)
+                        environment_subsets[c] = _coordinator_subsets(c, min_coordinators, min_sidechain, n_columns, max_subset_size)
+                for el_position, el in environment_subsets[c]:
+                    _add_probes(dict_cluster, environment_keys, el, group, probe_key, el_position)
 
-    try:
-        max_probes = max([len(v) for v in dict_cluster.values()])
-    except:
-        print("None possible coordinating sites have been found. Try again with other parameters or check/change the input file.")
-        sys.exit()
+    #Sort environments and probes as if all the probes had been processed in a single chunk
+    dict_cluster = {_environment_residues(coord_environment, labels): _merge_probes(dict_cluster[coord_environment])
+                        for coord_environment in sorted(dict_cluster, key=lambda x: environment_keys[x])}
+    #Order Mutation information: residues and their mutations by their first
+    #probe, then by number of probes
+    dict_mutations = {}
+    for coord_environment, environment_counts in mutation_counts.items():
+        ordered_mutations = []
+        for residue, residue_counts in environment_counts.items():
+            residue_keys = {el: mutation_keys[(coord_environment, residue, el)] for el in residue_counts}
+            residue_mutations = [[el, residue_counts[el]] for el in sorted(residue_counts, key=residue_keys.__getitem__)]
+            residue_mutations.sort(key=lambda x: x[1], reverse=True)   #order every residue by number of probes
+            ordered_mutations.append((min(residue_keys.values()), residue, residue_mutations))
+        ordered_mutations = [(residue, residue_mutations) for first_key, residue, residue_mutations in sorted(ordered_mutations, key=lambda item: item[0])]
+        dict_mutations[_environment_residues(coord_environment, labels)] = sorted(ordered_mutations, key=lambda item: item[1][0][1], reverse=True)
+
+    if not dict_cluster:
+        return centers, dict_mutations
+    max_probes = max([len(v) for v in dict_cluster.values()])
 
     for coord_residues,probes in dict_cluster.items():
         if len(probes) >= max_probes*cluster_cutoff:
-            center, radius_search = _calculate_center_and_radius(probes)
+            center, radius_search = _calculate_center_and_radius(probes, approximate_center)
             centers.append((coord_residues, center, len(probes), radius_search, probes))
 
     return centers, dict_mutations
 
+def _coordinator_subsets(coordinators, min_coordinators, min_sidechain, sidechain_bits,
+                            max_coordinators=None):
+    """
+    Finds the environments formed by the subsets of a set of coordinators.
+
+    Parameters
+    ----------
+    coordinators : tuple of int
+        Bits of the coordinators, sorted by their labels
+    min_coordinators : int
+        Minimum number of coordinators of an environment
+    min_sidechain : int
+        Minimum number of sidechain coordinators of an environment
+    sidechain_bits : int
+        Number of bits of the sidechain coordinators (the backbone
+        coordinators have the following bits)
+    max_coordinators : int, optional
+        Maximum number of coordinators of an environment. If None, there is no
+        limit
+
+    Returns
+    -------
+    list of tuple
+        Position of every valid subset among all the subsets (in the order
+        of `itertools.combinations`) and the bitset of the subset
+    """
+    subsets = []
+    position = 0
+    if max_coordinators is None:
+        max_coordinators = len(coordinators)
+    for i in range(min_coordinators, min(len(coordinators), max_coordinators)+1):
+        for subset in itertools.combinations(coordinators, i):
+            if sum(bit < sidechain_bits for bit in subset) >= min_sidechain:
+                subsets.append((position, sum(1 << bit for bit in subset)))
+            position += 1
+    return subsets
+
+def _subsite_counts(sites, min_coordinators, min_sidechain, max_subset_size=None):
+    """
+    Derives the number of probes of the sites formed by a subset of the
+    coordinators of the sites found with `maximal_only`.
+
+    Every probe of a maximal site also belongs to the sites formed by the
+    subsets of its coordinators, so the number of probes of a sub-site is the
+    sum of the probes of the maximal sites containing it (i.e. the one found
+    without `maximal_only`). The counts are only derived from the sites given,
+    so the maximal sites discarded by the cutoff are not counted.
+
+    Parameters
+    ----------
+    sites : list of Site
+        Sites found with `maximal_only`
+    min_coordinators : int
+        Minimum number of coordinating residues of a site
+    min_sidechain : int
+        Minimum number of residues coordinating by their side-chain
+    max_subset_size : int, optional
+        Maximum number of coordinating residues of a site. If None, there is
+        no limit
+
+    Returns
+    -------
+    list of tuples
+        Coordinating residues, their names and number of probes of every
+        sub-site (including the maximal sites), sorted by number of probes
+    """
+    counts = {}
+    names = {}
+    for site in sites:
+        max_coordinators = len(site.residues) if max_subset_size is None else min(len(site.residues), max_subset_size)
+        for i in range(min_coordinators, max_coordinators+1):
+            for subset in itertools.combinations(range(len(site.residues)), i):
+                coord_residues = tuple(site.residues[j] for j in subset)
+                if sum(not res.endswith("_BCK") for res in coord_residues) >= min_sidechain:
+                    counts[coord_residues] = counts.get(coord_residues, 0) + site.num_probes
+                    names[coord_residues] = tuple(site.names[j] for j in subset)
+    return sorted(((coord_residues, names[coord_residues], num_probes) for coord_residues, num_probes in counts.items()),
+                    key=lambda x: x[2], reverse=True)
+
+def _environment_residues(environment, labels):
+    """
+    Decodes the bitset of an environment.
+
+    Parameters
+    ----------
+    environment : int
+        Bitset of the coordinators of the environment
+    labels : list of str
+        Label of the coordinator of every bit
+
+    Returns
+    -------
+    tuple of str
+        Sorted labels of the coordinators of the environment
+    """
+    coordinators = []
+    while environment:
+        bit = environment & -environment
+        coordinators.append(labels[bit.bit_length() - 1])
+        environment ^= bit
+    return tuple(sorted(coordinators))
+
+def _add_probes(dict_cluster, environment_keys, coord_environment, group, group_key, position):
+    """
+    Adds a group of probes to a coordinating environment.
+
+    Parameters
+    ----------
+    dict_cluster : dict
+        Groups of probes of every environment
+    environment_keys : dict
+        Key of every environment (the smallest key of its probes, followed by
+        the position of the environment among the ones of that probe)
+    coord_environment : tuple
+        Coordinating residues of the environment
+    group : tuple
+        Position of the first coordinating residue type of the probes, their
+        positions in the grid and their 3-D coordinates
+    group_key : tuple
+        Smallest key of the probes of the group
+    position : int
+        Position of the environment among the ones found for the group
+    """
+    if coord_environment not in dict_cluster:
+        dict_cluster[coord_environment] = [group]
+        environment_keys[coord_environment] = (group_key, position)
+    else:
+        dict_cluster[coord_environment].append(group)
+        environment_keys[coord_environment] = min(environment_keys[coord_environment], (group_key, position))
+
+def _merge_probes(groups):
+    """
+    Joins the groups of probes of an environment, sorted by their keys.
+
+    Parameters
+    ----------
+    groups : list of tuple
+        Groups of probes, as added by `_add_probes`
+
+    Returns
+    -------
+    np.array
+        Nx3 array with the coordinates of the probes
+    """
+    positions = np.concatenate([np.full(len(indices), position) for position, indices, probes in groups])
+    indices = np.concatenate([indices for position, indices, probes in groups])
+    probes = np.concatenate([probes for position, indices, probes in groups])
+    return probes[np.lexsort((indices, positions))]
+
+def _test_shared_chunk(bounds, shared, consider_backbone_residues,
+                        DIST_PROBE_ALPHA, DIST_PROBE_BETA, ANGLE_PAB,
+                        bck_clashes, sc_clashes, engine='dense',
+                        kernel='squared'):
+    #Arrays are read from the shared block created in `run`
+    arrays = _attach_arrays(shared)
+    start, end = bounds
+    if 'thresholds' in arrays:
+        thresholds = tuple(arrays['thresholds'])
+    else:
+        thresholds = None
+    cells = {}
+    for cell_key in ('alphas', 'oxygens', 'clashes', 'sidechains'):
+        if 'cells:%s:0' % cell_key in arrays:
+            cells[cell_key] = tuple(arrays['cells:%s:%d' % (cell_key, i)] for i in range(6))
+    if engine != 'cells' and not cells:
+        cells = None
+    grid, coords, discarded = _test_chunk(arrays['grid'][start:end],
+                        arrays['alphas'], arrays['betas'], arrays['carbons'],
+                        arrays['nitrogens'], arrays['oxygens'],
+                        arrays['side_chains'], arrays['alpha_beta_distances'],
+                        arrays['oxygen_carbon_distances'], None, None, None,
+                        None, consider_backbone_residues, DIST_PROBE_ALPHA,
+                        DIST_PROBE_BETA, ANGLE_PAB, bck_clashes, sc_clashes,
+                        engine, cells, thresholds, kernel)
+    #The probes are not sent back, the parent process already has them
+    return [bounds, coords, discarded]
+
 def _test_chunk(grid, alphas, betas, carbons, nitrogens, oxygens, side_chains,
                         alpha_beta_distances, oxygen_carbon_distances,
                         name_for_res, column_for_res, res_for_column,
                         atoms_in_res, consider_backbone_residues,
                         DIST_PROBE_ALPHA, DIST_PROBE_BETA, ANGLE_PAB,
-                        bck_clashes, sc_clashes):
-    alpha_distances = np.sqrt((np.square(grid[:,np.newaxis]-alphas).sum(axis=2)))
-    beta_distances = np.sqrt((np.square(grid[:,np.newaxis]-betas).sum(axis=2)))
-    carbon_distances = np.sqrt((np.square(grid[:,np.newaxis]-carbons).sum(axis=2)))
-    nitrogen_distances = np.sqrt((np.square(grid[:,np.newaxis]-nitrogens).sum(axis=2)))
-    oxygen_distances = np.sqrt((np.square(grid[:,np.newaxis]-oxygens).sum(axis=2)))
+                        bck_clashes, sc_clashes, engine='dense', cells=None,
+                        thresholds=None, kernel='squared'):
+    if engine == 'cells':
+        return _test_chunk_cells(grid, alphas, betas, carbons, nitrogens,
+                        oxygens, side_chains, alpha_beta_distances,
+                        oxygen_carbon_distances, consider_backbone_residues,
+                        DIST_PROBE_ALPHA, DIST_PROBE_BETA, ANGLE_PAB,
+                        bck_clashes, sc_clashes, cells, thresholds, kernel)
 
-    PAB_angles = np.arccos((np.square(alpha_distances) + np.square(alpha_beta_distances) - np.square(beta_distances)) / (2*alpha_distances*alpha_beta_distances))
-    POC_angles = np.arccos((np.square(oxygen_distances) + np.square(oxygen_carbon_distances) - np.square(carbon_distances)) / (2*oxygen_distances*oxygen_carbon_distances))
+    alpha_sq_distances = _sq_distance_matrix(grid, alphas)
+    beta_sq_distances = _sq_distance_matrix(grid, betas)
+    carbon_sq_distances = _sq_distance_matrix(grid, carbons)
+    nitrogen_sq_distances = _sq_distance_matrix(grid, nitrogens)
+    oxygen_sq_distances = _sq_distance_matrix(grid, oxygens)
 
-    coords = {}
+    #Distances and angles in the space of the kernel (e.g. squared distances
+    #and squared cosines to avoid the sqrt and arccos calculations)
+    alpha_distances = _distance_feature(alpha_sq_distances, kernel)
+    beta_distances = _distance_feature(beta_sq_distances, kernel)
+    carbon_distances = _distance_feature(carbon_sq_distances, kernel)
+    nitrogen_distances = _distance_feature(nitrogen_sq_distances, kernel)
+    oxygen_distances = _distance_feature(oxygen_sq_distances, kernel)
+    PAB_angles = _angle_feature(alpha_sq_distances, np.square(alpha_beta_distances), beta_sq_distances, kernel)
+    POC_angles = _angle_feature(oxygen_sq_distances, np.square(oxygen_carbon_distances), carbon_sq_distances, kernel)
+    oxygen_limits = _distance_limits(DIST_PROBE_OXYGEN, kernel)
+    poc_limits = _angle_limits(ANGLE_POC, kernel)
+    clash_limit = _distance_limits(bck_clashes, kernel)
+
+    coords = []
     # include backbone coordinations
     if consider_backbone_residues:
-        coords["BCK"] = np.dstack(np.where((DIST_PROBE_OXYGEN[0]<=oxygen_distances) & (oxygen_distances<=DIST_PROBE_OXYGEN[1]) &
-                                (ANGLE_POC[0]<=POC_angles) & (POC_angles<=ANGLE_POC[1])))
-    # include sidechain coordinations (Alpha+Beta)
-    for res_name in list(DIST_PROBE_ALPHA):
-        coords[res_name] = np.dstack(np.where((DIST_PROBE_ALPHA[res_name][0]<=alpha_distances) & (alpha_distances<=DIST_PROBE_ALPHA[res_name][1]) &
-                                                (DIST_PROBE_BETA[res_name][0]<=beta_distances) & (beta_distances<=DIST_PROBE_BETA[res_name][1]) &
-                                                (ANGLE_PAB[res_name][0]<=PAB_angles) & (PAB_angles<=ANGLE_PAB[res_name][1])))
+        coords.append((COORDINATION_TYPES.index("BCK"),) + np.where((oxygen_limits[0]<=oxygen_distances) & (oxygen_distances<=oxygen_limits[1]) &
+                                (poc_limits[0]<=POC_angles) & (POC_angles<=poc_limits[1])))
+    if thresholds is not None:
+        # include sidechain coordinations (Alpha+Beta), each residue tested
+        # only against the geometry of its own residue type
+        coords.append((COORDINATION_TYPES.index("SC"),) + np.where(_sidechain_mask(alpha_distances,
+                                    beta_distances, PAB_angles,
+                                    _distance_limits(thresholds[0], kernel),
+                                    _distance_limits(thresholds[1], kernel),
+                                    _angle_limits(thresholds[2], kernel))))
+    else:
+        # include sidechain coordinations (Alpha+Beta) for every residue type
+        for res_name in list(DIST_PROBE_ALPHA):
+            coords.append((COORDINATION_TYPES.index(res_name),) + np.where(_sidechain_mask(alpha_distances,
+                                    beta_distances, PAB_angles,
+                                    _distance_limits(DIST_PROBE_ALPHA[res_name], kernel),
+                                    _distance_limits(DIST_PROBE_BETA[res_name], kernel),
+                                    _angle_limits(ANGLE_PAB[res_name], kernel))))
+    # If there is a clash (distance < bck_clashes) with a backbone atom,
+    # no coordination is possible for that probe
+    discarded = np.any((oxygen_distances<clash_limit) |
+                            (carbon_distances<clash_limit) |
+                            (nitrogen_distances<clash_limit) |
+                            (alpha_distances<clash_limit), axis=1)
+
+    # Same for the side-chain atoms (only the ones near enough to the probes)
+    if sc_clashes > 0:
+        if cells is None or 'sidechains' not in cells:
+            cells = {'sidechains': _sidechain_cells(side_chains, sc_clashes)}
+        discarded |= _clash_mask(cells['sidechains'], grid, sc_clashes, kernel)
+
+    return [grid, _coordination_table(coords), np.packbits(discarded)]
+
+def _test_chunk_cells(grid, alphas, betas, carbons, nitrogens, oxygens, side_chains,
+                        alpha_beta_distances, oxygen_carbon_distances,
+                        consider_backbone_residues,
+                        DIST_PROBE_ALPHA, DIST_PROBE_BETA, ANGLE_PAB,
+                        bck_clashes, sc_clashes, cells=None, thresholds=None,
+                        kernel='squared'):
+    if cells is None:
+        cells = _backbone_cells(alphas, carbons, nitrogens, oxygens, bck_clashes,
+                                side_chains=side_chains, sc_clashes=sc_clashes)
+
+    coords = []
+    # include backbone coordinations (only oxygens near enough to the probes)
+    if consider_backbone_residues:
+        probe_idx, res_idx = _query_cell_list(cells['oxygens'], grid, cells['oxygens'][2])
+        oxygen_sq_distances = _sq_distances(grid, oxygens, probe_idx, res_idx)
+        carbon_sq_distances = _sq_distances(grid, carbons, probe_idx, res_idx)
+        oxygen_distances = _distance_feature(oxygen_sq_distances, kernel)
+        POC_angles = _angle_feature(oxygen_sq_distances, np.square(oxygen_carbon_distances[res_idx]), carbon_sq_distances, kernel)
+        oxygen_limits = _distance_limits(DIST_PROBE_OXYGEN, kernel)
+        poc_limits = _angle_limits(ANGLE_POC, kernel)
+        is_coordinating = ((oxygen_limits[0]<=oxygen_distances) & (oxygen_distances<=oxygen_limits[1]) &
+                                (poc_limits[0]<=POC_angles) & (POC_angles<=poc_limits[1]))
+        coords.append((COORDINATION_TYPES.index("BCK"), probe_idx[is_coordinating], res_idx[is_coordinating]))
+    # include sidechain coordinations (only alphas near enough to the probes)
+    probe_idx, res_idx = _query_cell_list(cells['alphas'], grid, cells['alphas'][2])
+    if thresholds is not None:
+        # residues without any coordination range are not evaluated
+        is_candidate = np.isfinite(thresholds[0][0][res_idx])
+        probe_idx, res_idx = probe_idx[is_candidate], res_idx[is_candidate]
+    alpha_sq_distances = _sq_distances(grid, alphas, probe_idx, res_idx)
+    beta_sq_distances = _sq_distances(grid, betas, probe_idx, res_idx)
+    alpha_distances = _distance_feature(alpha_sq_distances, kernel)
+    beta_distances = _distance_feature(beta_sq_distances, kernel)
+    PAB_angles = _angle_feature(alpha_sq_distances, np.square(alpha_beta_distances[res_idx]), beta_sq_distances, kernel)
+    if thresholds is not None:
+        is_coordinating = _sidechain_mask(alpha_distances, beta_distances, PAB_angles,
+                                _distance_limits(thresholds[0], kernel)[:,res_idx],
+                                _distance_limits(thresholds[1], kernel)[:,res_idx],
+                                _angle_limits(thresholds[2], kernel)[:,res_idx])
+        coords.append((COORDINATION_TYPES.index("SC"), probe_idx[is_coordinating], res_idx[is_coordinating]))
+    else:
+        for res_name in list(DIST_PROBE_ALPHA):
+            is_coordinating = _sidechain_mask(alpha_distances, beta_distances, PAB_angles,
+                                    _distance_limits(DIST_PROBE_ALPHA[res_name], kernel),
+                                    _distance_limits(DIST_PROBE_BETA[res_name], kernel),
+                                    _angle_limits(ANGLE_PAB[res_name], kernel))
+            coords.append((COORDINATION_TYPES.index(res_name), probe_idx[is_coordinating], res_idx[is_coordinating]))
     # If there is a clash (distance < bck_clashes) with a backbone atom,
     # no coordination is possible for that probe
-    discarded = set(np.where((oxygen_distances<bck_clashes) |
-                            (carbon_distances<bck_clashes) |
-                            (nitrogen_distances<bck_clashes) |
-                            (alpha_distances<bck_clashes))[0])
+    discarded = np.zeros(len(grid), dtype=bool)
+    if 'clashes' in cells:
+        discarded |= _clash_mask(cells['clashes'], grid, bck_clashes, kernel)
 
+    # Same for the side-chain atoms
     if sc_clashes > 0:
-        for sc_atom in side_chains:
-            sidechain_distances = np.sqrt((np.square(grid[:,np.newaxis]-sc_atom).sum(axis=2)))
-            discarded = discarded.union(set(np.where(sidechain_distances<sc_clashes)[0]))
+        if 'sidechains' not in cells:
+            cells = dict(cells, sidechains=_sidechain_cells(side_chains, sc_clashes))
+        discarded |= _clash_mask(cells['sidechains'], grid, sc_clashes, kernel)
+
+    return [grid, _coordination_table(coords), np.packbits(discarded)]
+
+def _coordination_table(coordinations):
+    """
+    Packs the coordinations found in a chunk as a columnar table.
+
+    Parameters
+    ----------
+    coordinations : list of tuples
+        Type code (position in `COORDINATION_TYPES`), probe indices and
+        residue columns of every group of coordinations
 
-    return [grid, coords, discarded]
+    Returns
+    -------
+    tuple of np.array
+        Probe index (int32), residue column (int32) and type code (int8) of
+        every coordination, following the order of the groups
+    """
+    probe_idx = [np.asarray(group[1], dtype=np.int32) for group in coordinations]
+    res_idx = [np.asarray(group[2], dtype=np.int32) for group in coordinations]
+    types = [np.full(len(group[1]), group[0], dtype=np.int8) for group in coordinations]
+    return (np.concatenate(probe_idx + [np.empty(0, dtype=np.int32)]),
+            np.concatenate(res_idx + [np.empty(0, dtype=np.int32)]),
+            np.concatenate(types + [np.empty(0, dtype=np.int8)]))
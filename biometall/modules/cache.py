@@ -0,0 +1,339 @@
+"""
+cache.py
+Module with functions to cache the parsed structures and the results on disk
+"""
+
+import os
+import hashlib
+import tempfile
+import shutil
+import pickle
+import numpy as np
+from .pdb import _parse_molecule, _open_structure
+
+# Version of the stored format (and of the parser), part of every key so that
+# entries written by previous versions are never loaded
+_CACHE_VERSION = 1
+
+# Backbone atoms that can be registered in `atoms_in_res`, as bits
+_CACHED_ATOMS = ('CA', 'CB', 'C', 'N', 'O')
+
+# Arrays of a parsed structure, in the order returned by `_parse_molecule`
+_CACHED_ARRAYS = ('alphas', 'betas', 'carbons', 'nitrogens', 'oxygens')
+
+# Size of the blocks of the input files read to hash them, in bytes
+_HASH_BLOCK_SIZE = 1 << 20
+
+def _default_cache_dir():
+    """
+    Directory used to cache the structures if none is given.
+
+    Returns
+    -------
+    str
+        `BIOMETALL_CACHE_DIR` environment variable if defined, or
+        `~/.cache/biometall` otherwise
+    """
+    return os.environ.get('BIOMETALL_CACHE_DIR',
+                            os.path.join(os.path.expanduser('~'), '.cache', 'biometall'))
+
+def _file_hash(inputfile):
+    """
+    Hashes the content of a file, read in blocks.
+
+    Parameters
+    ----------
+    inputfile : str
+        Path of the file
+
+    Returns
+    -------
+    hashlib.sha256
+        SHA-256 of the (compressed, if so) content of the file, to be updated
+        with other data of the key
+    """
+    sha = hashlib.sha256()
+    with open(inputfile, "rb") as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b''):
+            sha.update(block)
+    return sha
+
+def _structure_key(inputfile, file_extension):
+    """
+    Generates the key of a structure in the cache.
+
+    Parameters
+    ----------
+    inputfile : str
+        Path of the structure file
+    file_extension : str
+        Extension indicating the format of the file
+
+    Returns
+    -------
+    str
+        SHA-256 of the file content, the format and the cache version
+    """
+    sha = _file_hash(inputfile)
+    sha.update(("%s:%d" % (file_extension, _CACHE_VERSION)).encode())
+    return sha.hexdigest()
+
+def _load_structure(inputfile, file_extension, cache_dir=None):
+    """
+    Parses a structure file, reusing the parsed data of previous calculations.
+
+    Parsed structures are stored in `cache_dir` as a directory of `.npy` files
+    (named by the hash of the file content), which are memory-mapped when the
+    same content is parsed again. The file is parsed while read (and
+    decompressed, if so), without keeping its text in memory.
+
+    Parameters
+    ----------
+    inputfile : str
+        Path of the structure file
+    file_extension : str
+        Extension indicating the format of the file
+    cache_dir : str, optional
+        Directory of the cache. If None, the file is always parsed
+
+    Returns
+    -------
+    tuple
+        Same data returned by `_parse_molecule`
+    """
+    if cache_dir is None:
+        with _open_structure(inputfile, file_extension) as f:
+            return _parse_molecule(f, file_extension)
+
+    path = os.path.join(cache_dir, _structure_key(inputfile, file_extension))
+    if os.path.isdir(path):
+        try:
+            structure = _read_structure(path)
+            _touch(path)
+            return structure
+        except (OSError, ValueError, KeyError): #corrupted entry, written again
+            shutil.rmtree(path, ignore_errors=True)
+    with _open_structure(inputfile, file_extension) as f:
+        structure = _parse_molecule(f, file_extension)
+    try:
+        _write_structure(path, structure)
+    except OSError: #the cache is optional
+        pass
+    return structure
+
+def _write_structure(path, structure):
+    """
+    Stores a parsed structure in the cache.
+
+    The files are written in a temporary directory that is renamed to `path`
+    at the end, so concurrent calculations never read a partial entry.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the entry
+    structure : tuple
+        Data returned by `_parse_molecule`
+    """
+    centroid, max_distance, alphas, betas, carbons, nitrogens, oxygens, \
+        column_for_res, res_for_column, name_for_res, atoms_in_res, \
+        side_chains = structure
+    residues = [res_for_column[column] for column in range(len(res_for_column))]
+    arrays = {
+        'centroid': np.asarray(centroid, dtype=float),
+        'max_distance': np.asarray(max_distance, dtype=float),
+        'alphas': alphas, 'betas': betas, 'carbons': carbons,
+        'nitrogens': nitrogens, 'oxygens': oxygens,
+        'side_chains': np.asarray(side_chains, dtype=float).reshape(-1, 3),
+        'residues': np.array(residues, dtype=str),
+        'names': np.array([name_for_res[res] for res in residues], dtype=str),
+        'atoms': np.array([sum(1 << bit for bit, atom_name in enumerate(_CACHED_ATOMS)
+                            if atom_name in atoms_in_res[res]) for res in residues], dtype=np.uint8),
+    }
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=parent, prefix='.tmp_')
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), array)
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(path): #not written by another calculation
+            raise
+
+def _read_structure(path):
+    """
+    Loads a parsed structure from the cache.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the entry
+
+    Returns
+    -------
+    tuple
+        Same data returned by `_parse_molecule`, with the coordinates as
+        read-only memory-mapped arrays
+    """
+    def load(name):
+        return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+    residues = [str(res) for res in load('residues')]
+    names = [str(name) for name in load('names')]
+    atoms = load('atoms')
+    column_for_res = {res: column for column, res in enumerate(residues)}
+    res_for_column = {column: res for column, res in enumerate(residues)}
+    name_for_res = dict(zip(residues, names))
+    atoms_in_res = {res: set(atom_name for bit, atom_name in enumerate(_CACHED_ATOMS) if bits & (1 << bit))
+                        for res, bits in zip(residues, atoms.tolist())}
+    alphas, betas, carbons, nitrogens, oxygens = [load(name) for name in _CACHED_ARRAYS]
+    return np.array(load('centroid')), load('max_distance')[()], alphas, \
+            betas, carbons, nitrogens, oxygens, column_for_res, res_for_column, \
+            name_for_res, atoms_in_res, load('side_chains')
+
+def _result_key(inputfile, parameters, version):
+    """
+    Generates the key of the results of a calculation in the cache.
+
+    Parameters
+    ----------
+    inputfile : str or list of str
+        Path of the structure file, or paths of the structure files of the
+        models of an ensemble
+    parameters : dict
+        Parameters of the calculation that may change its results
+    version : str
+        Version of BioMetAll
+
+    Returns
+    -------
+    str
+        SHA-256 of the file content, the parameters, the version of BioMetAll
+        and the cache version
+    """
+    if isinstance(inputfile, str):
+        sha = _file_hash(inputfile)
+    else:
+        sha = hashlib.sha256()
+        for path in inputfile:
+            sha.update(_file_hash(path).digest())
+    sha.update(repr(sorted(parameters.items())).encode())
+    sha.update(("%s:%d" % (version, _CACHE_VERSION)).encode())
+    return sha.hexdigest()
+
+def _load_results(cache_dir, key):
+    """
+    Loads the results of a previous calculation from the cache.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the cache
+    key : str
+        Key of the results, as returned by `_result_key`
+
+    Returns
+    -------
+    list or None
+        Results stored with `_store_results`, or None if they are not cached
+    """
+    path = os.path.join(cache_dir, key + '.pkl')
+    try:
+        with open(path, "rb") as f:
+            results = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError): #corrupted entry, written again
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    _touch(path)
+    return results
+
+def _store_results(cache_dir, key, results, max_size=None):
+    """
+    Stores the results of a calculation in the cache.
+
+    The least recently used entries of the cache (results or structures)
+    are removed afterwards while the cache is larger than `max_size`.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the cache
+    key : str
+        Key of the results, as returned by `_result_key`
+    results : list
+        Results of the calculation, must be picklable
+    max_size : float, optional
+        Maximum size of the cache, in bytes. If None, no entry is removed
+    """
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, os.path.join(cache_dir, key + '.pkl'))
+        except OSError:
+            os.remove(tmp_path)
+            raise
+        if max_size is not None:
+            _evict(cache_dir, max_size)
+    except OSError: #the cache is optional
+        pass
+
+def _touch(path):
+    """
+    Marks an entry of the cache as recently used.
+
+    Parameters
+    ----------
+    path : str
+        File or directory of the entry
+    """
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def _evict(cache_dir, max_size):
+    """
+    Removes the least recently used entries of the cache.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the cache
+    max_size : float
+        Maximum size of the cache, in bytes
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.startswith('.tmp_'): #being written
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            if os.path.isdir(path):
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+            else:
+                size = os.path.getsize(path)
+            entries.append((os.path.getmtime(path), size, path))
+        except OSError: #removed by another calculation
+            continue
+    total_size = sum(size for last_use, size, path in entries)
+    for last_use, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total_size -= size
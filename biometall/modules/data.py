@@ -81,8 +81,40 @@ DIST_PROBE_OXYGEN = (1.809, 3.000)
 # Range for angle Metal-Backbone oxygen-Backbone carbon (in Rad)
 ANGLE_POC = (1.774, 3.139)
 
-# Type of files allowed in BioMetAll calculations
-ALLOWED_FILE_TYPES = ('.pdb'),
+# Type of files allowed in BioMetAll calculations (PDB and mmCIF formats, which
+# can be compressed with gzip)
+ALLOWED_FILE_TYPES = ('.pdb', '.pdb.gz', '.cif', '.cif.gz')
+
+# Engines available to evaluate the probe-residue coordinations: `dense`
+# computes all probe-residue distances, `cells` only the ones of the residues
+# found near each probe with a cell list
+ENGINES = ('dense', 'cells')
+
+# Kernels available to compare the geometry of the probes with the ranges:
+# `squared` compares squared distances and squared cosines of the angles,
+# `sqrt` compares the actual distances and angles (i.e. with sqrt and arccos)
+KERNELS = ('squared', 'sqrt')
+
+# Peak memory (in bytes) allocated by `_test_chunk` for every probe-residue
+# pair evaluated, measured for every engine and kernel. The `cells` engine only
+# evaluates the residues near each probe, at most CELLS_MAX_RESIDUES of them
+CHUNK_MEMORY_PER_PAIR = {('dense', 'squared'): 80, ('dense', 'sqrt'): 128,
+                            ('cells', 'squared'): 25, ('cells', 'sqrt'): 25}
+CELLS_MAX_RESIDUES = 512
+
+# Additional memory (in bytes) for every probe when discarding the side-chain
+# clashes, measured for the search of the cell list of side-chain atoms
+SIDECHAIN_CLASH_MEMORY_PER_PROBE = 1800
+
+# Fraction of the available memory of the system used by the chunks being
+# tested at the same time
+CHUNK_MEMORY_FRACTION = 0.5
+
+# Options that can change between the queries of a calculation, i.e. the ones
+# that only affect the clustering of the probes and not their coordinations
+QUERY_OPTIONS = ('residues', 'motif', 'propose_mutations_to', 'min_coordinators',
+                    'min_sidechain', 'consider_backbone_residues', 'cluster_cutoff',
+                    'maximal_only', 'max_subset_size')
 
 # Conversion of some particular amino acid names to standard ones
 CONVERT_RES_NAMES = {
@@ -95,4 +127,10 @@ CONVERT_RES_NAMES = {
     'HIP': 'HIS',
     'HYP': 'PRO',
     'LYN': 'LYS'
-}
\ No newline at end of file
+}
+
+# Types of the coordinations returned by the workers, identified by their
+# position (type code): with a backbone oxygen, with the side-chain of the
+# residue's own type, or with the side-chain of a given residue type (to
+# propose mutations)
+COORDINATION_TYPES = ('BCK', 'SC') + tuple(DIST_PROBE_ALPHA)
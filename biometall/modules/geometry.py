@@ -0,0 +1,233 @@
+"""
+geometry.py
+Module with functions to evaluate the coordination geometry of the probes
+"""
+
+import numpy as np
+from .data import DIST_PROBE_ALPHA, DIST_PROBE_BETA, ANGLE_PAB
+
+def _residue_thresholds(name_for_res, res_for_column, atoms_in_res, residues):
+    """
+    Generates the coordination ranges of every residue of the protein.
+
+    Each column (i.e. residue) of the protein gets the Metal-Alpha carbon,
+    Metal-Beta carbon and Metal-Alpha carbon-Beta carbon ranges of its own
+    residue name, so every probe is tested only against the geometry of the
+    actual amino acid. Residues whose name is not in `residues`, or lacking
+    an alpha or a beta carbon, get empty ranges and never coordinate.
+
+    Parameters
+    ----------
+    name_for_res : dict
+        Name of the residue given its number:chain
+    res_for_column : dict
+        Correspondence between column number and number:chain of residue
+    atoms_in_res : dict
+        Name of atoms contained in a given residue (indexed by number_res:chain)
+    residues : list of str
+        Names of the residues considered as potentially coordinating
+
+    Returns
+    -------
+    np.array
+        2xN array with the lower and upper Metal-Alpha carbon distances
+    np.array
+        2xN array with the lower and upper Metal-Beta carbon distances
+    np.array
+        2xN array with the lower and upper Metal-Alpha carbon-Beta carbon angles
+    """
+    n_columns = len(res_for_column)
+    alpha_limits = np.tile([[np.inf], [-np.inf]], n_columns)
+    beta_limits = np.tile([[np.inf], [-np.inf]], n_columns)
+    pab_limits = np.tile([[np.inf], [-np.inf]], n_columns)
+    for column in range(n_columns):
+        res = res_for_column[column]
+        res_name = name_for_res[res]
+        if res_name not in residues or res_name not in DIST_PROBE_ALPHA:
+            continue
+        if ('CA' not in atoms_in_res[res]) or ('CB' not in atoms_in_res[res]):
+            continue
+        alpha_limits[:, column] = DIST_PROBE_ALPHA[res_name]
+        beta_limits[:, column] = DIST_PROBE_BETA[res_name]
+        pab_limits[:, column] = ANGLE_PAB[res_name]
+    return alpha_limits, beta_limits, pab_limits
+
+def _sidechain_mask(alpha_distances, beta_distances, PAB_angles, alpha_limits,
+                    beta_limits, pab_limits):
+    """
+    Checks which probe-residue pairs fulfill a side-chain coordination geometry.
+
+    Distances and angles (and their limits) can be expressed in the space of
+    any kernel (see `_distance_feature` and `_angle_feature`).
+
+    Parameters
+    ----------
+    alpha_distances : np.array
+        Probe-Alpha carbon distances
+    beta_distances : np.array
+        Probe-Beta carbon distances
+    PAB_angles : np.array
+        Probe-Alpha carbon-Beta carbon angles
+    alpha_limits : sequence
+        Lower and upper Metal-Alpha carbon distances. Either two floats (same
+        range for all the pairs) or two arrays broadcastable to the distances
+    beta_limits : sequence
+        Lower and upper Metal-Beta carbon distances
+    pab_limits : sequence
+        Lower and upper Metal-Alpha carbon-Beta carbon angles
+
+    Returns
+    -------
+    np.array
+        Boolean array, True for the pairs with a feasible coordination
+    """
+    return ((alpha_limits[0]<=alpha_distances) & (alpha_distances<=alpha_limits[1]) &
+            (beta_limits[0]<=beta_distances) & (beta_distances<=beta_limits[1]) &
+            (pab_limits[0]<=PAB_angles) & (PAB_angles<=pab_limits[1]))
+
+def _sq_distance_matrix(points, atoms):
+    """
+    Calculates the squared distances from every point to every atom.
+
+    Coordinates are accumulated axis by axis, which avoids the creation of an
+    intermediate NxMx3 array and gives the same values than summing the
+    squared differences over the last axis.
+
+    Parameters
+    ----------
+    points : np.array
+        Array of 3-D coordinates (e.g. the probes of a chunk)
+    atoms : np.array
+        Array of 3-D coordinates (e.g. the alpha carbons of the protein)
+
+    Returns
+    -------
+    np.array
+        NxM array of squared distances
+    """
+    sq_distances = np.square(points[:,0,np.newaxis] - atoms[:,0])
+    sq_distances += np.square(points[:,1,np.newaxis] - atoms[:,1])
+    sq_distances += np.square(points[:,2,np.newaxis] - atoms[:,2])
+    return sq_distances
+
+def _sq_distances(points, atoms, point_idx, atom_idx):
+    """
+    Calculates the squared distances of selected point-atom pairs.
+
+    Parameters
+    ----------
+    points : np.array
+        Array of 3-D coordinates (e.g. the probes of a chunk)
+    atoms : np.array
+        Array of 3-D coordinates (e.g. the alpha carbons of the protein)
+    point_idx : np.array
+        Index of the point of every pair
+    atom_idx : np.array
+        Index of the atom of every pair
+
+    Returns
+    -------
+    np.array
+        Squared distance of every pair
+    """
+    sq_distances = np.square(points[point_idx,0] - atoms[atom_idx,0])
+    sq_distances += np.square(points[point_idx,1] - atoms[atom_idx,1])
+    sq_distances += np.square(points[point_idx,2] - atoms[atom_idx,2])
+    return sq_distances
+
+def _distance_feature(sq_distances, kernel):
+    """
+    Transforms squared distances into the quantity compared by a kernel.
+
+    Parameters
+    ----------
+    sq_distances : np.array
+        Squared distances, in Angstroms^2
+    kernel : str
+        `squared` compares squared distances directly, `sqrt` compares the
+        actual distances
+
+    Returns
+    -------
+    np.array
+        Values to be compared against the output of `_distance_limits`
+    """
+    if kernel == 'sqrt':
+        return np.sqrt(sq_distances)
+    return sq_distances
+
+def _angle_feature(sq_side1, sq_side2, sq_opposite, kernel):
+    """
+    Transforms the sides of a triangle into the quantity compared by a kernel.
+
+    The angle between `side1` and `side2` is obtained with the law of cosines.
+    The `sqrt` kernel returns the angle itself, while the `squared` kernel
+    returns the signed square of its cosine (i.e. cos*abs(cos)), which is a
+    monotonic function of the angle that only requires the squared sides.
+
+    Parameters
+    ----------
+    sq_side1 : np.array
+        Squared length of the first side adjacent to the angle
+    sq_side2 : np.array
+        Squared length of the second side adjacent to the angle
+    sq_opposite : np.array
+        Squared length of the side opposite to the angle
+    kernel : str
+        Either `squared` or `sqrt`
+
+    Returns
+    -------
+    np.array
+        Values to be compared against the output of `_angle_limits`
+    """
+    if kernel == 'sqrt':
+        side1, side2, opposite = np.sqrt(sq_side1), np.sqrt(sq_side2), np.sqrt(sq_opposite)
+        return np.arccos((np.square(side1) + np.square(side2) - np.square(opposite)) / (2*side1*side2))
+    numerator = sq_side1 + sq_side2 - sq_opposite
+    return numerator * np.abs(numerator) / (4*sq_side1*sq_side2)
+
+def _distance_limits(limits, kernel):
+    """
+    Transforms distance ranges (or thresholds) into the space of a kernel.
+
+    Parameters
+    ----------
+    limits : array_like
+        Distances, in Angstroms. Empty ranges (lower > upper) stay empty
+    kernel : str
+        Either `squared` or `sqrt`
+
+    Returns
+    -------
+    array_like
+        Limits to be compared against the output of `_distance_feature`
+    """
+    if kernel == 'sqrt':
+        return limits
+    return np.square(np.asarray(limits, dtype=float))
+
+def _angle_limits(limits, kernel):
+    """
+    Transforms angle ranges into the space of a kernel.
+
+    Parameters
+    ----------
+    limits : array_like
+        Lower and upper angles, in radians
+    kernel : str
+        Either `squared` or `sqrt`
+
+    Returns
+    -------
+    array_like
+        Limits to be compared against the output of `_angle_feature`. For the
+        `squared` kernel, the signed square cosines of the upper and the lower
+        angles (the cosine decreases with the angle). Empty ranges give NaN
+        limits, which never match
+    """
+    if kernel == 'sqrt':
+        return limits
+    with np.errstate(invalid='ignore'):
+        cosines = np.cos(np.asarray(limits, dtype=float)[::-1])
+    return cosines * np.abs(cosines)
@@ -5,6 +5,9 @@ Module with functions to manage the creation of the probes grid
 
 import numpy as np
 import math
+import psutil
+from .data import CHUNK_MEMORY_PER_PAIR, CELLS_MAX_RESIDUES, SIDECHAIN_CLASH_MEMORY_PER_PROBE, CHUNK_MEMORY_FRACTION
+from .neighbors import _cell_list, _query_cell_list, _CELL_OFFSETS, _CANDIDATE_MARGIN
 
 def _grid(centroid, radius, step):
     """
@@ -32,6 +35,40 @@ def _grid(centroid, radius, step):
     list of array_like
         list of 3-float arrays containing the points (i.e. probes) of the grid
     """
+    #1-2. Each axis of a cube of l=2*radius is splitted at every step distance
+    x, y, z = _grid_axes(centroid, radius, step)
+
+    #3. A cubic grid is generated by combining the 3 axes (x varies slowest)
+    points = np.stack(np.meshgrid(x, y, z, indexing='ij'), axis=-1).reshape(-1, 3) #Cube embedding the protein
+
+    #4. Points out of the sphere are discarded
+    is_in_sphere = np.linalg.norm(points - centroid, axis=1) <= radius
+    points = points[is_in_sphere, :]
+
+    return points
+
+def _grid_axes(centroid, radius, step):
+    """
+    Splits the axes of the cube embedding the sphere of the grid.
+
+    Parameters
+    ----------
+    centroid : array_like
+        Array of 3 floats defining the center of the sphere
+    radius : float
+        Radius of the sphere used to construct the grid
+    step : float
+        Distance, in Angstroms, between two consecutive probes
+
+    Returns
+    -------
+    np.array
+        Coordinates of the probes along the x axis
+    np.array
+        Coordinates of the probes along the y axis
+    np.array
+        Coordinates of the probes along the z axis
+    """
     #1. Two points at the ends of a cube of l=2*radius are obtained
     xmi, ymi, zmi = centroid - radius
     xma, yma, zma = centroid + radius
@@ -43,36 +80,194 @@ def _grid(centroid, radius, step):
     x = np.linspace(xmi, xma, numx)
     y = np.linspace(ymi, yma, numy)
     z = np.linspace(zmi, zma, numz)
+    return x, y, z
 
-    #3. A cubic grid is generated by iterating over the 3 axes
-    grid = []
-    for i in range(len(x)):
-        for j in range(len(y)):
-            for k in range(len(z)):
-                grid.append([x[i], y[j], z[k]])
-    points = np.array(grid) #Cube embedding the protein
+def _refined_grid(centroid, radius, step, seeds, distance):
+    """
+    Generates the probes of a grid only around some points of interest.
 
-    #4. Points out of the sphere are discarded
+    The probes are the same (and in the same order) as the ones generated by
+    `_grid` with the same `centroid`, `radius` and `step`, but only the ones
+    inside a cube of half side `distance` around any of the `seeds` are
+    kept. It allows refining the regions found with a coarser grid (e.g. the
+    probes of the coordinating sites) without building the whole fine grid.
+
+    Parameters
+    ----------
+    centroid : array_like
+        Array of 3 floats defining the center of the sphere
+    radius : float
+        Radius of the sphere used to construct the grid
+    step : float
+        Distance, in Angstroms, between two consecutive probes
+    seeds : array_like
+        Array of 3-D coordinates of the points of interest
+    distance : float or array_like
+        Half side, in Angstroms, of the cube refined around every seed (either
+        the same for all or one for each seed)
+
+    Returns
+    -------
+    np.array
+        Probes of the grid around the seeds
+    """
+    axes = _grid_axes(centroid, radius, step)
+    shape = np.array([len(axis) for axis in axes])
+    origin = np.array([axis[0] for axis in axes])
+    spacing = np.array([axis[1] - axis[0] if len(axis) > 1 else step for axis in axes])
+    seeds = np.asarray(seeds, dtype=float).reshape(-1, 3)
+    distance = np.broadcast_to(np.asarray(distance, dtype=float), (len(seeds),))[:,np.newaxis]
+
+    #1. Lattice points inside the cube around every seed are marked
+    lower = np.clip(np.ceil((seeds - distance - origin) / spacing).astype(np.int64), 0, shape)
+    upper = np.clip(np.floor((seeds + distance - origin) / spacing).astype(np.int64) + 1, 0, shape)
+    is_refined = np.zeros(shape, dtype=bool)
+    for (i0, j0, k0), (i1, j1, k1) in zip(lower, upper):
+        is_refined[i0:i1, j0:j1, k0:k1] = True
+
+    #2. Marked points out of the sphere are discarded
+    i, j, k = np.nonzero(is_refined)
+    points = np.stack((axes[0][i], axes[1][j], axes[2][k]), axis=-1).reshape(-1, 3)
     is_in_sphere = np.linalg.norm(points - centroid, axis=1) <= radius
-    points = points[is_in_sphere, :]
+    return points[is_in_sphere, :]
 
-    return points
+def _shell(points, atoms, cutoffs, block_size=100000):
+    """
+    Discards the probes too far from the protein to coordinate a metal.
+
+    A probe is kept if it is within the cutoff of at least one atom (e.g. the
+    largest Metal-Alpha carbon distance of the residue of every alpha carbon).
+    Probes deep in the solvent, or buried far from any potential coordinator,
+    are removed before testing the coordination of the grid.
+
+    Parameters
+    ----------
+    points : np.array
+        Array of 3-D coordinates of the probes, as returned by `_grid`
+    atoms : np.array
+        Array of 3-D coordinates of the atoms
+    cutoffs : np.array
+        Maximum distance, in Angstroms, from a probe to every atom. Atoms with
+        a negative or infinite cutoff are ignored
+    block_size : int, optional
+        Number of probes tested at the same time. Defaults to 100000
+
+    Returns
+    -------
+    np.array
+        Probes within the cutoff of any atom, in the same order as `points`
+    """
+    atoms = np.asarray(atoms, dtype=float).reshape(-1, 3)
+    cutoffs = np.asarray(cutoffs, dtype=float)
+    is_valid = np.isfinite(cutoffs) & (cutoffs >= 0)
+    atoms, cutoffs = atoms[is_valid], cutoffs[is_valid] + _CANDIDATE_MARGIN
+    if not len(atoms):
+        return points[:0]
 
-def _calculate_center_and_radius(probes):
+    #Cells containing atoms, dilated to their neighbors (with one empty cell
+    #of padding at each side of the grid of cells)
+    cell_list = _cell_list(atoms, cutoffs.max())
+    origin, cell_size, dims = cell_list[1:4]
+    occupied = np.zeros(dims + 2, dtype=bool)
+    occupied[tuple((np.floor((atoms - origin) / cell_size).astype(np.int64) + 1).T)] = True
+    near_cells = np.zeros_like(occupied)
+    for offset in _CELL_OFFSETS:
+        near_cells |= np.roll(occupied, offset, axis=(0, 1, 2))
+
+    is_near = np.zeros(len(points), dtype=bool)
+    for start in range(0, len(points), block_size):
+        #Probes without atoms in the surrounding cells are skipped
+        block_cells = np.floor((points[start:start+block_size] - origin) / cell_size).astype(np.int64) + 1
+        candidates = np.flatnonzero(np.all((block_cells >= 0) & (block_cells < dims + 2), axis=1))
+        candidates = candidates[near_cells[tuple(block_cells[candidates].T)]]
+        block = points[start + candidates]
+        probe_idx, atom_idx = _query_cell_list(cell_list, block, cutoffs.max())
+        sq_distances = np.square(block[probe_idx] - atoms[atom_idx]).sum(axis=1)
+        is_near[start + candidates[probe_idx[sq_distances <= np.square(cutoffs[atom_idx])]]] = True
+    return points[is_near]
+
+def _calculate_center_and_radius(probes, approximate_above=None, block_size=None,
+                                 max_elements=4194304, sample_size=1024,
+                                 n_candidates=64):
     """
     Calculates the most central point of a list and its distance to the furthest
     point.
 
     Euclidean distances from all the points to all the points of the list (i.e.
-    `probes`) are calculated (i.e. distance_matrix). Then, the point with the
-    smallest sum of distances is considered the most central. The distance from
-    this central point to its farthest would be the radius which is necessary to
-    embed all the points in a sphere.
+    `probes`) are calculated in blocks of rows, so the whole distance matrix is
+    never kept in memory. Then, the point with the smallest sum of distances is
+    considered the most central. The distance from this central point to its
+    farthest would be the radius which is necessary to embed all the points in
+    a sphere.
+
+    For lists larger than `approximate_above`, the sums of distances are only
+    estimated with a sample of the points, and the exact sums are calculated
+    for the `n_candidates` best estimated points (see
+    `_approximate_center_and_radius`).
 
     Parameters
     ----------
     probes : list of array_like
         List of 3-float arrays containing coordinates
+    approximate_above : int, optional
+        Number of points above which the most central point is approximated.
+        Defaults to None (always exact)
+    block_size : int, optional
+        Number of rows of the distance matrix calculated at the same time. If
+        None, the largest one keeping every block under `max_elements`
+    max_elements : int, optional
+        Maximum number of distances of every block. Defaults to 4194304 (32 MB)
+    sample_size : int, optional
+        Number of points used to estimate the sums of distances when
+        approximating. Defaults to 1024
+    n_candidates : int, optional
+        Number of points whose exact sum is calculated when approximating.
+        Defaults to 64
+
+    Returns
+    -------
+    array_like
+        3-float array containing the coordinates of the most central point
+    float
+        radius of the sphere which is necessary to embed all points
+    """
+    probes = np.array(probes, dtype=float).reshape(-1, 3)
+    if approximate_above is not None and len(probes) > approximate_above:
+        return _approximate_center_and_radius(probes, sample_size, n_candidates,
+                                              block_size, max_elements)
+
+    #1. Sum of distances from every probe to all the probes
+    sum_distances, max_distances = _distance_sums(probes, probes, block_size, max_elements)
+
+    #2. Search for the most central point of the list (the first one on ties)
+    best_probe = np.argmin(sum_distances)
+    return probes[best_probe], max_distances[best_probe]
+
+def _approximate_center_and_radius(probes, sample_size=1024, n_candidates=64,
+                                   block_size=None, max_elements=4194304):
+    """
+    Approximates the most central point of a list and calculates its distance
+    to the furthest point.
+
+    The sum of distances from every point to all the points is estimated with
+    the distances to an evenly spaced sample of `sample_size` points. The exact
+    sums are then calculated for the `n_candidates` points with the smallest
+    estimations, and the best of them is returned. The radius is always the
+    exact distance from the returned point to its farthest.
+
+    Parameters
+    ----------
+    probes : np.array
+        Array of 3-D coordinates
+    sample_size : int, optional
+        Number of points used to estimate the sums of distances. Defaults to
+        1024
+    n_candidates : int, optional
+        Number of points whose exact sum is calculated. Defaults to 64
+    block_size : int, optional
+        Number of rows of the distance matrix calculated at the same time
+    max_elements : int, optional
+        Maximum number of distances of every block
 
     Returns
     -------
@@ -81,32 +276,77 @@ def _calculate_center_and_radius(probes):
     float
         radius of the sphere which is necessary to embed all points
     """
-    probes = np.array(probes)
+    #1. Estimated sums, with the distances to the sample
+    sample = probes[np.linspace(0, len(probes) - 1, min(sample_size, len(probes))).astype(np.int64)]
+    estimated_sums = _distance_sums(probes, sample, block_size, max_elements)[0]
+
+    #2. Exact sums of the best candidates (sorted to keep the first on ties)
+    n_candidates = min(n_candidates, len(probes))
+    candidates = np.sort(np.argpartition(estimated_sums, n_candidates - 1)[:n_candidates])
+    sum_distances, max_distances = _distance_sums(probes[candidates], probes, block_size, max_elements)
+    best_candidate = np.argmin(sum_distances)
+    return probes[candidates[best_candidate]], max_distances[best_candidate]
+
+def _distance_sums(points, others, block_size=None, max_elements=4194304):
+    """
+    Calculates the sum and the maximum of the distances from every point to
+    all the other points, in blocks of rows of the distance matrix.
 
-    #1. Euclidean distance from all to all probes
-    distance_matrix = np.linalg.norm(probes - probes[:,None], axis=-1)
+    Parameters
+    ----------
+    points : np.array
+        Array of 3-D coordinates (rows of the distance matrix)
+    others : np.array
+        Array of 3-D coordinates (columns of the distance matrix)
+    block_size : int, optional
+        Number of rows calculated at the same time. If None, the largest one
+        keeping every block under `max_elements`
+    max_elements : int, optional
+        Maximum number of distances of every block. Defaults to 4194304
 
-    #2. Search for the most central point of the list
-    for i, probe in enumerate(distance_matrix):
-        sum_dist_probe = sum(probe) #Sum of distances to all the other probes
-        if i == 0:
-            min_sum_dist = sum_dist_probe
-            best_probe = i
-            highest_dist = max(probe)
-        else:
-            if sum_dist_probe < min_sum_dist:
-                min_sum_dist = sum_dist_probe
-                best_probe = i
-                highest_dist = max(probe)
-    return probes[best_probe], highest_dist
+    Returns
+    -------
+    np.array
+        Sum of the distances from every point
+    np.array
+        Largest distance from every point
+    """
+    if block_size is None:
+        block_size = max(1, max_elements // max(1, len(others)))
+    sum_distances = np.empty(len(points))
+    max_distances = np.empty(len(points))
+    for start in range(0, len(points), block_size):
+        block = points[start:start+block_size]
+        #Squared distances are accumulated axis by axis, so only one matrix
+        #of the size of the block is allocated
+        distances = np.square(others[:,0] - block[:,0,None])
+        for axis in (1, 2):
+            distances += np.square(others[:,axis] - block[:,axis,None])
+        np.sqrt(distances, out=distances)
+        max_distances[start:start+block_size] = distances.max(axis=1)
+        #Distances are added one after the other (not pairwise, as in
+        #`np.sum`), so equal sums of symmetric points are rounded the same
+        #way and the first point of a tie is kept
+        np.cumsum(distances, axis=1, out=distances)
+        sum_distances[start:start+block_size] = distances[:,-1]
+    return sum_distances, max_distances
 
-def _chunk_size(len_grid, len_protein, n_cores, optimize_to=2147483648):
+def _chunk_size(len_grid, len_protein, n_cores, max_memory=None, engine='dense',
+                kernel='squared', sc_clashes=0.0, chunks_per_core=4,
+                min_chunk_size=256, available_memory=None):
     """
     Calculates the number of probes per chunk.
 
     To split the calculation in several cores (processors), the grid of probes
-    is divided in chunks. This method takes into account the memory and the
-    number of cores to find a good balanced size for the chunks.
+    is divided in chunks. Every core tests a chunk at the same time, so the
+    chunks are small enough for `n_cores` of them to fit in the memory budget:
+    the smallest of `max_memory` and a fraction (`CHUNK_MEMORY_FRACTION`) of the
+    memory currently available in the system. The memory of a chunk is
+    estimated with the peak memory measured for every probe-residue pair of
+    the engine and kernel used (`CHUNK_MEMORY_PER_PAIR`). Within that limit,
+    the grid is split in `chunks_per_core` chunks for every core (but not in
+    chunks smaller than `min_chunk_size`), so the work is balanced between
+    the cores even when some chunks are slower than others.
 
     Parameters
     ----------
@@ -116,9 +356,23 @@ def _chunk_size(len_grid, len_protein, n_cores, optimize_to=2147483648):
         Number of amino acids of the protein
     n_cores : int
         Number of cores that will be used in the calculation
-    optimize_to : int, optional
-        Maximum memory (in bytes) that will be used in the calculation. Defaults
-        to 2GB
+    max_memory : int, optional
+        Maximum memory (in bytes) used by the chunks being tested. Defaults to
+        None (only limited by the available memory)
+    engine : str, optional
+        Engine used to test the chunks (see `ENGINES`). Defaults to `dense`
+    kernel : str, optional
+        Kernel used to test the chunks (see `KERNELS`). Defaults to `squared`
+    sc_clashes : float, optional
+        Distance of the side-chain clashes. Defaults to 0.0 (not discarded)
+    chunks_per_core : int, optional
+        Number of chunks for every core, if the memory allows it. Defaults to 4
+    min_chunk_size : int, optional
+        Minimum number of probes per chunk when balancing the work between
+        the cores. Defaults to 256
+    available_memory : int, optional
+        Memory (in bytes) available in the system. If None, it is read with
+        `psutil.virtual_memory`
 
     Returns
     -------
@@ -127,14 +381,23 @@ def _chunk_size(len_grid, len_protein, n_cores, optimize_to=2147483648):
 
     Notes
     -----
-    The maximum memory employed by the calculation could in fact be higher than
-    the requested in the `optimize_to`. Before starting the actual biometall
-    calculation, there is a process to load in memory the .pdb, so if that .pdb
-    is bigger than `optimize_to`, the maximum memory employed will be the size
-    of the .pdb instead of the size of the chunks.
-    """
-    number_of_chunks = math.ceil((56 * len_grid * len_protein * n_cores)/optimize_to)
-    if number_of_chunks < n_cores:
-        return int(len_grid/n_cores) + 1
-    else:
-        return int(len_grid/number_of_chunks) + 1
+    The memory of the parent process (e.g. the parsed structure, the grid and
+    the clustered probes) is not included in the budget.
+    """
+    if available_memory is None:
+        available_memory = psutil.virtual_memory().available
+    budget = CHUNK_MEMORY_FRACTION * available_memory
+    if max_memory:
+        budget = min(budget, max_memory)
+
+    #1. Largest chunk that fits in memory when all the cores test one
+    if engine == 'cells':
+        len_protein = min(len_protein, CELLS_MAX_RESIDUES)
+    probe_memory = CHUNK_MEMORY_PER_PAIR[(engine, kernel)] * max(len_protein, 1)
+    if sc_clashes > 0:
+        probe_memory += SIDECHAIN_CLASH_MEMORY_PER_PROBE
+    memory_size = max(int(budget / (probe_memory * n_cores)), 1)
+
+    #2. Chunk size giving several chunks to every core
+    balanced_size = max(math.ceil(len_grid / (chunks_per_core * n_cores)), min_chunk_size)
+    return max(min(memory_size, balanced_size, len_grid), 1)
@@ -4,10 +4,63 @@ Module with functions to hadle combinations of motifs/mutations
 """
 
 import itertools
-from .box import _counterSubset
+from collections import Counter, namedtuple
 
-def _check_actual_motif(motif_possibilities, probe_coordinators, name_for_res, 
-                            res_for_column):
+# Motif compiled for `_check_actual_motif`: its number of residues and the
+# distinct multisets of residue names matching it, as sorted (name, count)
+# tuples
+Motif = namedtuple('Motif', ['length', 'multisets'])
+
+def _motif_combinations(motifs):
+    """
+    Lists the distinct combinations of amino acids that accomplish a motif.
+
+    The combinations are built position by position, keeping only the
+    distinct multisets of amino acids at every step, so motifs with many
+    alternatives (e.g. [HIS/ASP/GLU,HIS/ASP/GLU,HIS/ASP/GLU,CYS]) do not
+    enumerate all the products of their alternatives.
+
+    Parameters
+    ----------
+    motifs : list of lists
+        Alternative amino acids of every position of the motif
+
+    Returns
+    -------
+    list of tuples
+        Sorted names of the amino acids of every combination
+    """
+    combinations = {()}
+    for alternatives in motifs:
+        combinations = {tuple(sorted(combination + (res_name,)))
+                            for combination in combinations for res_name in set(alternatives)}
+    return sorted(combinations)
+
+def _compile_motif(motif_possibilities):
+    """
+    Compiles the combinations of amino acids accomplishing a motif to match
+    the coordinators of the probes with `_check_actual_motif`.
+
+    Parameters
+    ----------
+    motif_possibilities : list of sequences
+        All the combinations of amino acids that accomplish the motif (e.g. as
+        returned by `_motif_combinations`), all of the same length
+
+    Returns
+    -------
+    Motif
+        Length of the motif and distinct multisets of amino acids matching it
+    """
+    multisets = set()
+    length = 0
+    for possible_motif in motif_possibilities:
+        length = len(possible_motif)
+        multisets.add(tuple(sorted(Counter(possible_motif).items())))
+    return Motif(length, tuple(sorted(multisets)))
+
+def _check_actual_motif(motif, probe_coordinators, name_for_res,
+                            res_for_column, memo=None):
     """
     Checks if the coordinators of a probe match the motif requested by the user.
 
@@ -18,12 +71,17 @@ def _check_actual_motif(motif_possibilities, probe_coordinators, name_for_res,
     contains, at least, either (HIS,HIS,ASP) or (HIS,HIS,GLU).
 
     The function returns all the possible combinations of amino acids that match
-    the motif for the given probe.
+    the motif for the given probe. The multisets of the motif contained in the
+    amino acids of the probe are found by comparing their counts, and only
+    depend on those amino acids, so they can be memoized in `memo` for the
+    probes with the same names of coordinators. The combinations of every
+    multiset are then built directly, without testing all the combinations of
+    coordinators.
 
     Parameters
     ----------
-    motif_possibilities : list of sequences
-        All the combinations of amino acids that accomplish the motif
+    motif : Motif
+        Compiled motif, as returned by `_compile_motif`
     probe_coordinators : dict
         Contains the amino acids that coordinate the probe. Indexed by number of
         column, the values are the names of the coordinating amino acids.
@@ -31,25 +89,48 @@ def _check_actual_motif(motif_possibilities, probe_coordinators, name_for_res,
         Correspondence between number:chain of residue and residue name
     res_for_column: dict
         Correspondence between column number and number:chain of residue
+    memo : dict, optional
+        Multisets of the motif found for every multiset of amino acids,
+        shared between calls
 
     Returns
     -------
-    list of sequences
+    set of sequences
         sequences of the amino acids that match the motif for the queried probe
     """
     c = []
     for i in list(probe_coordinators):
         if name_for_res[res_for_column[i]] in probe_coordinators[i]:
             c.append(tuple([name_for_res[res_for_column[i]], i]))
+
+    #1. Multisets of the motif contained in the amino acids of the probe
+    counts = Counter(m_tuple[0] for m_tuple in c)
+    key = tuple(sorted(counts.items()))
+    if memo is not None and key in memo:
+        matched = memo[key]
+    else:
+        matched = [multiset for multiset in motif.multisets
+                    if all(counts[res_name] >= n for res_name, n in multiset)]
+        if memo is not None:
+            memo[key] = matched
+
+    #2. Combinations of coordinators of every multiset, added in the order of
+    #the coordinators of the probe
+    positions = {}
+    for position, m_tuple in enumerate(c):
+        positions.setdefault(m_tuple[0], []).append(position)
+    solution_positions = set()
+    for multiset in matched:
+        for combination in itertools.product(*[itertools.combinations(positions[res_name], n)
+                                                for res_name, n in multiset]):
+            solution_positions.add(tuple(sorted(itertools.chain.from_iterable(combination))))
     solutions = set()
-    for m in list(itertools.combinations(c, len(motif_possibilities[0]))):
-        for possible_motif in motif_possibilities:
-            if(_counterSubset(possible_motif, [m_tuple[0] for m_tuple in m])):
-                solutions.add(tuple(m_tuple[1] for m_tuple in m))
+    for m in sorted(solution_positions):
+        solutions.add(tuple(c[position][1] for position in m))
     return solutions
 
-def _check_possible_mutations(mutated_motif_possibilities, 
-                                residues_of_mutated_motif, probe_coordinators):
+def _check_possible_mutations(mutated_motif, residues_of_mutated_motif,
+                                probe_coordinators, memo=None):
     """
     Calculates the possible mutations to achieve a motif requested by the user.
 
@@ -60,22 +141,25 @@ def _check_possible_mutations(mutated_motif_possibilities,
     actual structure or by making a mutation, (HIS,ASP) or (HIS,GLU). 
 
     The function returns all the mutations that could be made in the residues
-    to achieve the coordinating motif for the given probe.
+    to achieve the coordinating motif for the given probe. Whether the motif
+    can be achieved is a matching between the amino acids of the motif and the
+    coordinators (see `_motif_fits`), which only depends on the names of every
+    coordinator, so it can be memoized in `memo` for the probes with the same
+    coordinators.
 
     Parameters
     ----------
-    mutated_motif_possibilities : list of sequences
-        All the combinations of amino acids that accomplish the motif
+    mutated_motif : Motif
+        Compiled motif, as returned by `_compile_motif`
     residues_of_mutated_motif : sequence of str
         Sequence of the names of the amino acids involved in the motif
     probe_coordinators : dict
         Contains the amino acids that coordinate the probe. Indexed by number of
         column, the values are the names of the coordinating amino acids and 
         their possible mutations.
-    name_for_res : dict
-        Correspondence between number:chain of residue and residue name
-    res_for_column: dict
-        Correspondence between column number and number:chain of residue
+    memo : dict, optional
+        Whether the motif can be achieved for every structure of coordinators,
+        shared between calls
 
     Returns
     -------
@@ -83,27 +167,52 @@ def _check_possible_mutations(mutated_motif_possibilities,
         Possible mutations for a given residue (indexed by column number)
         
     """
-    c = []
-    for i in list(probe_coordinators):
-        c.append([])
-        for j in probe_coordinators[i]:
-            c[-1].append(tuple([j, i]))
-    
-    c_possibilities = list(itertools.product(*c))
-          
+    key = tuple(sorted(tuple(sorted(set(names))) for names in probe_coordinators.values()))
+    if memo is not None and key in memo:
+        is_achievable = memo[key]
+    else:
+        is_achievable = any(_motif_fits([res_name for res_name, n in multiset for _ in range(n)], key)
+                                for multiset in mutated_motif.multisets)
+        if memo is not None:
+            memo[key] = is_achievable
+
     mutations = {}
-    for m in c_possibilities:
-        for possible_motif in mutated_motif_possibilities:
-            if(_counterSubset(possible_motif, [m_tuple[0] for m_tuple in m])):
-                for p in probe_coordinators:
-                    for r_name in probe_coordinators[p]:
-                        #Exists possibility of mutation
-                        if residues_of_mutated_motif.intersection(set([r_name])): 
-                            if p not in list(mutations):
-                                mutations[p] = set([r_name])
-                            else:
-                                mutations[p].add(r_name)
-                break
-        if mutations:
-            break
-    return mutations
\ No newline at end of file
+    if is_achievable:
+        for p in probe_coordinators:
+            for r_name in probe_coordinators[p]:
+                #Exists possibility of mutation
+                if r_name in residues_of_mutated_motif:
+                    mutations.setdefault(p, set()).add(r_name)
+    return mutations
+
+def _motif_fits(motif_names, coordinator_names):
+    """
+    Checks if every amino acid of a motif can be assigned to a different
+    coordinator having its name (i.e. a matching of the bipartite graph of
+    amino acids and coordinators covering all the amino acids).
+
+    Parameters
+    ----------
+    motif_names : list of str
+        Names of the amino acids of the motif (can be repetitions)
+    coordinator_names : sequence of sequences
+        Possible names of every coordinator
+
+    Returns
+    -------
+    bool
+        True if all the amino acids of the motif can be assigned
+    """
+    #Coordinator assigned to every amino acid of the motif, extended with
+    #augmenting paths
+    assigned = {}
+    def assign(i, visited):
+        for j, names in enumerate(coordinator_names):
+            if j in visited or motif_names[i] not in names:
+                continue
+            visited.add(j)
+            if j not in assigned or assign(assigned[j], visited):
+                assigned[j] = i
+                return True
+        return False
+    return all(assign(i, set()) for i in range(len(motif_names)))
@@ -0,0 +1,207 @@
+"""
+neighbors.py
+Module with functions to perform fixed-radius neighbor searches over atoms
+"""
+
+import itertools
+import numpy as np
+from .data import DIST_PROBE_ALPHA, DIST_PROBE_OXYGEN
+from .geometry import _sq_distances, _distance_feature, _distance_limits
+
+# Relative positions of the 27 cells surrounding (and including) a given cell
+_CELL_OFFSETS = np.array(list(itertools.product((-1, 0, 1), repeat=3)))
+
+# Extra distance (in angstroms) added to the search radii, so the candidate
+# pairs are always a superset of the ones accepted by the exact predicates
+_CANDIDATE_MARGIN = 1e-3
+
+def _cell_list(points, cell_size):
+    """
+    Bins a set of points into a uniform grid of cubic cells.
+
+    The bounding box of the `points` is divided in cubes of side `cell_size`.
+    Every point is assigned to the cell that contains it, and the points are
+    sorted by cell so that all the points of a given cell can be retrieved with
+    a binary search. Any query of radius smaller or equal than `cell_size` only
+    needs to inspect the 27 cells surrounding the cell of the query point.
+
+    Parameters
+    ----------
+    points : array_like
+        Array of 3-D coordinates to be indexed
+    cell_size : float
+        Side, in Angstroms, of every cell of the grid
+
+    Returns
+    -------
+    tuple
+        Indexed points, origin of the grid, cell size, number of cells along
+        each axis, sorted cell keys and indices of the points sorted by cell
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    if len(points):
+        origin = points.min(axis=0)
+        cells = np.floor((points - origin) / cell_size).astype(np.int64)
+        dims = cells.max(axis=0) + 1
+    else:
+        origin = np.zeros(3)
+        cells = np.zeros((0, 3), dtype=np.int64)
+        dims = np.ones(3, dtype=np.int64)
+    keys = (cells[:,0] * dims[1] + cells[:,1]) * dims[2] + cells[:,2]
+    order = np.argsort(keys, kind='stable')
+    return points, origin, cell_size, dims, keys[order], order
+
+def _query_cell_list(cell_list, queries, radius):
+    """
+    Finds all the pairs of query points and indexed points closer than a radius.
+
+    Parameters
+    ----------
+    cell_list : tuple
+        Indexed points, as returned by `_cell_list`
+    queries : array_like
+        Array of 3-D coordinates of the query points (e.g. the grid probes)
+    radius : float
+        Maximum distance, in Angstroms, between the points of a pair. It can
+        not be larger than the cell size of `cell_list`
+
+    Returns
+    -------
+    np.array
+        Indices of the query points of every pair
+    np.array
+        Indices of the indexed points of every pair
+
+    Notes
+    -----
+    Pairs are sorted by query index and, for the same query, by point index,
+    i.e. the same order that `np.where` yields over a dense distance matrix.
+    """
+    points, origin, cell_size, dims, keys, order = cell_list
+    if radius > cell_size:
+        raise ValueError("The search radius can not be larger than the cell size")
+    queries = np.asarray(queries, dtype=float).reshape(-1, 3)
+
+    #1. Cells surrounding every query point
+    query_cells = np.floor((queries - origin) / cell_size).astype(np.int64)
+    neighbor_cells = query_cells[:,np.newaxis] + _CELL_OFFSETS
+    valid = np.all((neighbor_cells >= 0) & (neighbor_cells < dims), axis=2)
+    neighbor_keys = (neighbor_cells[...,0] * dims[1] + neighbor_cells[...,1]) * dims[2] + neighbor_cells[...,2]
+
+    #2. Range of sorted points falling into each of those cells
+    starts = np.searchsorted(keys, neighbor_keys, side='left').ravel()
+    counts = np.where(valid, np.searchsorted(keys, neighbor_keys, side='right') - starts.reshape(valid.shape), 0).ravel()
+
+    #3. Expansion of the ranges into candidate pairs
+    total = counts.sum()
+    query_idx = np.repeat(np.repeat(np.arange(len(queries)), len(_CELL_OFFSETS)), counts)
+    offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    point_idx = order[offsets + np.arange(total)]
+
+    #4. Candidates farther than the radius are discarded
+    sq_distances = np.square(queries[query_idx] - points[point_idx]).sum(axis=1)
+    within = sq_distances <= radius * radius
+    query_idx, point_idx = query_idx[within], point_idx[within]
+    sorting = np.lexsort((point_idx, query_idx))
+    return query_idx[sorting], point_idx[sorting]
+
+def _clash_mask(cell_list, queries, threshold, kernel='squared'):
+    """
+    Finds the query points closer than a threshold to any indexed point.
+
+    All the clashes of the query points are found with a single search of the
+    cell list, instead of computing the distances from every query point to
+    every indexed point.
+
+    Parameters
+    ----------
+    cell_list : tuple
+        Indexed points (e.g. side-chain atoms), as returned by `_cell_list`
+        with a cell size of at least `threshold`
+    queries : array_like
+        Array of 3-D coordinates of the query points (e.g. the grid probes)
+    threshold : float
+        Distance, in Angstroms, that defines a clash
+    kernel : str, optional
+        Kernel used to compare the distances (see `_distance_feature`).
+        Defaults to `squared`
+
+    Returns
+    -------
+    np.array
+        Boolean mask of the query points with a clash
+    """
+    queries = np.asarray(queries, dtype=float).reshape(-1, 3)
+    is_clashing = np.zeros(len(queries), dtype=bool)
+    query_idx, point_idx = _query_cell_list(cell_list, queries, cell_list[2])
+    distances = _distance_feature(_sq_distances(queries, cell_list[0], query_idx, point_idx), kernel)
+    is_clashing[query_idx[distances < _distance_limits(threshold, kernel)]] = True
+    return is_clashing
+
+def _backbone_cells(alphas, carbons, nitrogens, oxygens, bck_clashes,
+                    alpha_cutoff=None, side_chains=None, sc_clashes=0.0):
+    """
+    Indexes the backbone atoms of the protein for the `cells` engine.
+
+    Alpha carbons are binned with the largest Metal-Alpha carbon distance of the
+    tested residue types, backbone oxygens with the largest Metal-Oxygen distance
+    and all the backbone atoms with the backbone clashes threshold, so every
+    probe only needs to be tested against its neighboring residues.
+
+    Parameters
+    ----------
+    alphas : np.array
+        Array of 3-D coordinates for all the alpha carbons of the protein
+    carbons : np.array
+        Array of 3-D coordinates for all the backbone carbons of the protein
+    nitrogens : np.array
+        Array of 3-D coordinates for all the backbone nitrogens of the protein
+    oxygens : np.array
+        Array of 3-D coordinates for all the backbone oxygens of the protein
+    bck_clashes : float
+        Distance from a probe to a backbone atom that defines a clash
+    alpha_cutoff : float, optional
+        Largest Metal-Alpha carbon distance of the residue types tested.
+        Defaults to the largest distance of `DIST_PROBE_ALPHA`
+    side_chains : np.array, optional
+        Array of 3-D coordinates for all the side-chain atoms of the protein
+    sc_clashes : float, optional
+        Distance from a probe to a side-chain atom that defines a clash.
+        Defaults to 0.0 (side-chain atoms are not indexed)
+
+    Returns
+    -------
+    dict
+        Cell lists indexed by `alphas`, `oxygens`, `clashes` and `sidechains`
+    """
+    if alpha_cutoff is None:
+        alpha_cutoff = max(upper for lower, upper in DIST_PROBE_ALPHA.values())
+    cells = {
+        'alphas': _cell_list(alphas, alpha_cutoff + _CANDIDATE_MARGIN),
+        'oxygens': _cell_list(oxygens, DIST_PROBE_OXYGEN[1] + _CANDIDATE_MARGIN),
+    }
+    if bck_clashes > 0:
+        cells['clashes'] = _cell_list(np.concatenate((oxygens, carbons, nitrogens, alphas)),
+                                      bck_clashes + _CANDIDATE_MARGIN)
+    if sc_clashes > 0 and side_chains is not None:
+        cells['sidechains'] = _sidechain_cells(side_chains, sc_clashes)
+    return cells
+
+def _sidechain_cells(side_chains, sc_clashes):
+    """
+    Indexes the side-chain atoms of the protein to find the clashes of the
+    probes (see `_clash_mask`).
+
+    Parameters
+    ----------
+    side_chains : np.array
+        Array of 3-D coordinates for all the side-chain atoms of the protein
+    sc_clashes : float
+        Distance from a probe to a side-chain atom that defines a clash
+
+    Returns
+    -------
+    tuple
+        Cell list of the side-chain atoms, as returned by `_cell_list`
+    """
+    return _cell_list(side_chains, sc_clashes + _CANDIDATE_MARGIN)
@@ -3,8 +3,203 @@ pdb.py
 Module with functions to manage the parsing and generation of .pdb files/structures
 """
 
+import os
+import re
+import gzip
 import numpy as np
-from .data import CONVERT_RES_NAMES, DIST_PROBE_ALPHA
+from .data import CONVERT_RES_NAMES, DIST_PROBE_ALPHA, ALLOWED_FILE_TYPES
+
+# Values of a row of a mmCIF table, unquoted or enclosed in quotes (which may
+# appear inside a value if not followed by a blank, e.g. 'O5'')
+_CIF_VALUE = re.compile(r"""'(.*?)'(?=\s|$)|"(.*?)"(?=\s|$)|(\S+)""")
+
+# Fields of the `_atom_site` table of mmCIF files read for every atom (group,
+# atom, residue name, residue number, chain, coordinates and model), with the
+# ones used if missing (None if the field is optional)
+_CIF_ATOM_FIELDS = (('group_PDB',), ('auth_atom_id', 'label_atom_id'),
+                    ('auth_comp_id', 'label_comp_id'), ('auth_seq_id', 'label_seq_id'),
+                    ('auth_asym_id', 'label_asym_id'), ('Cartn_x',), ('Cartn_y',),
+                    ('Cartn_z',), ('pdbx_PDB_model_num', None))
+
+def _split_extension(path):
+    """
+    Splits the path of a structure file in its name and its extension,
+    keeping the extension of the compressed files (e.g. `.cif.gz`).
+
+    Parameters
+    ----------
+    path : str
+        Path of the structure file
+
+    Returns
+    -------
+    str
+        Path without the extension
+    str
+        Extension indicating the format of the file
+    """
+    filename, file_extension = os.path.splitext(path)
+    if file_extension == '.gz':
+        filename, compressed_extension = os.path.splitext(filename)
+        file_extension = compressed_extension + file_extension
+    return filename, file_extension
+
+def _open_structure(inputfile, file_extension):
+    """
+    Opens a structure file as text, decompressing it on the fly if needed.
+
+    Parameters
+    ----------
+    inputfile : str
+        Path of the structure file
+    file_extension : str
+        Extension indicating the format of the file
+
+    Returns
+    -------
+    file object
+        Text file, whose lines are read one at a time
+    """
+    if file_extension.endswith('.gz'):
+        return gzip.open(inputfile, "rt")
+    return open(inputfile, "r")
+
+def _pdb_atoms(lines):
+    """
+    Reads the atoms of a structure in PDB format.
+
+    Parameters
+    ----------
+    lines : iterable
+        Lines of the structure (e.g. an open file)
+
+    Yields
+    ------
+    tuple
+        Name of the atom, number:chain and name of its residue, and text of its
+        x, y and z coordinates
+    """
+    for line in lines:
+        if line[0:6] != "ATOM  ":
+            continue
+        atom_fullname = line[12:16]
+        # get rid of whitespace in atom names
+        split_list = atom_fullname.split()
+        if len(split_list) != 1:
+            # atom name has internal spaces, e.g. " N B ", so
+            # we do not strip spaces
+            atom_name = atom_fullname
+        else:
+            # atom name is like " CA ", so we can strip spaces
+            atom_name = split_list[0]
+        chainid = line[21]
+        resid = line[22:26].split()[0]
+        res = str(resid) + ":" + str(chainid)
+        yield atom_name, res, line[17:20], line[30:38], line[38:46], line[46:54]
+
+def _cif_rows(lines):
+    """
+    Reads the rows of the `_atom_site` table of a structure in mmCIF format.
+
+    Parameters
+    ----------
+    lines : iterable
+        Lines of the structure (e.g. an open file)
+
+    Yields
+    ------
+    list of str
+        Names of the columns of the table (the same list for all its rows)
+    str
+        Line of the row
+    list of str
+        Values of the row
+    """
+    fields = []
+    in_header = False
+    in_atom_site = False
+    for line in lines:
+        #Names of the columns of a table, given before its rows
+        if line.startswith('loop_'):
+            fields = []
+            in_header = True
+            in_atom_site = False
+            continue
+        if in_header:
+            if line.startswith('_'):
+                fields.append(line.split()[0])
+                continue
+            in_header = False
+            in_atom_site = bool(fields) and fields[0].startswith('_atom_site.')
+        if not in_atom_site:
+            continue
+        if line.startswith(('#', '_', 'data_')):
+            in_atom_site = False
+            continue
+        #Every row of `_atom_site` is given in a single line
+        if '"' in line or "'" in line:
+            values = [next((value for value in match if value), '')
+                        for match in _CIF_VALUE.findall(line)]
+        else:
+            values = line.split()
+        if values:
+            yield fields, line, values
+
+def _cif_atoms(lines):
+    """
+    Reads the atoms of a structure in mmCIF format, i.e. the rows of its
+    `_atom_site` table.
+
+    The author numbering of residues and chains is used (the one of the PDB
+    format), falling back to the label numbering if missing.
+
+    Parameters
+    ----------
+    lines : iterable
+        Lines of the structure (e.g. an open file)
+
+    Yields
+    ------
+    tuple
+        Name of the atom, number:chain and name of its residue, and text of its
+        x, y and z coordinates
+    """
+    table_fields = None
+    for fields, line, values in _cif_rows(lines):
+        if fields is not table_fields:
+            table_fields = fields
+            group, atom_col, resname_col, resid_col, chain_col, x_col, y_col, z_col, model_col = \
+                [_cif_column(fields, options) for options in _CIF_ATOM_FIELDS]
+        if values[group] != 'ATOM':
+            continue
+        res = values[resid_col] + ":" + values[chain_col]
+        yield values[atom_col], res, values[resname_col], \
+                values[x_col], values[y_col], values[z_col]
+
+def _cif_column(fields, options):
+    """
+    Finds the column of an `_atom_site` field in a mmCIF table.
+
+    Parameters
+    ----------
+    fields : list of str
+        Names of the columns of the table
+    options : tuple of str
+        Names of the field, in order of preference. If the last one is None,
+        the field is optional
+
+    Returns
+    -------
+    int or None
+        Index of the first field found, or None if an optional field is
+        missing
+    """
+    for option in options:
+        if option is None:
+            return None
+        if '_atom_site.' + option in fields:
+            return fields.index('_atom_site.' + option)
+    raise Exception("Missing field _atom_site.%s in the mmCIF file" % options[0])
 
 def _parse_molecule(lines, file_extension):
     """
@@ -20,10 +215,12 @@ def _parse_molecule(lines, file_extension):
 
     Parameters
     ----------
-    lines : array_like
-        Array of str containing the structure of the protein
+    lines : iterable
+        Lines of the structure of the protein, e.g. a list of str or a file
+        opened with `_open_structure` (read while parsed)
     file_extension : str
-        Extension indicating the format of the `lines`
+        Extension indicating the format of the `lines` (`.pdb` or `.cif`,
+        optionally followed by `.gz`)
 
     Returns
     -------
@@ -53,112 +250,202 @@ def _parse_molecule(lines, file_extension):
     dict
         Name of atoms contained in a given residue (indexed by number_res:chain)
     """
-    if file_extension == '.pdb':
-        #Extract residue information and assign column
-        i = 0
-        column_for_res = {}
-        res_for_column = {}
-        name_for_res = {}
-        atoms_in_res = {}
-        for line in lines:
-            record_type = line[0:6]
-            if record_type == "ATOM  ":
-                atom_fullname = line[12:16]
-                # get rid of whitespace in atom names
-                split_list = atom_fullname.split()
-                if len(split_list) != 1:
-                    # atom name has internal spaces, e.g. " N B ", so
-                    # we do not strip spaces
-                    atom_name = atom_fullname
-                else:
-                    # atom name is like " CA ", so we can strip spaces
-                    atom_name = split_list[0]
-
-                if atom_name in ['CA', 'CB', 'C', 'N', 'O']:
-                    altloc = line[16]
-                    chainid = line[21]
-                    resid = line[22:26].split()[0]
-                    res = str(resid) + ":" + str(chainid)
-                    resname = line[17:20]
-                    if resname in list(CONVERT_RES_NAMES):
-                        resname = CONVERT_RES_NAMES[resname]
-                    if res not in list(column_for_res):
-                        column_for_res[res] = i
-                        res_for_column[i] = res
-                        name_for_res[res] = resname
-                        atoms_in_res[res] = set()
-                        i += 1
-                    atoms_in_res[res].add(atom_name)
-
-        #Extract coordinates and atoms information
-        alphas = [[0.0, 0.0, 0.0] for i in range(0, len(list(column_for_res)))]
-        betas = [[0.0, 0.0, 0.0] for i in range(0, len(list(column_for_res)))]
-        carbons = [[0.0, 0.0, 0.0] for i in range(0, len(list(column_for_res)))]
-        nitrogens = [[0.0, 0.0, 0.0] for i in range(0, len(list(column_for_res)))]
-        oxygens = [[0.0, 0.0, 0.0] for i in range(0, len(list(column_for_res)))]
-        side_chains = []
-        coords_array = [] #For calculate grid size
-
-        for line in lines:
-            record_type = line[0:6]
-            if record_type == "ATOM  ":
-                atom_fullname = line[12:16]
-                # get rid of whitespace in atom names
-                split_list = atom_fullname.split()
-                if len(split_list) != 1:
-                    # atom name has internal spaces, e.g. " N B ", so
-                    # we do not strip spaces
-                    atom_name = atom_fullname
-                else:
-                    # atom name is like " CA ", so we can strip spaces
-                    atom_name = split_list[0]
-
-                chainid = line[21]
-                resid = line[22:26].split()[0]
-                res = str(resid) + ":" + str(chainid)
-
-                # atomic coordinates
-                try:
-                    x = float(line[30:38])
-                    y = float(line[38:46])
-                    z = float(line[46:54])
-                except Exception:
-                    raise Exception("Invalid or missing coordinate(s) at \
-                                    residue %s, atom %s" % (res, name))
-                coord = [x, y, z]
-
-                if atom_name == "CA":
-                    # Coordinates for the grid
-                    coords_array.append(coord)
-                    # Coordinates for searching sites
-                    alphas[column_for_res[res]] = coord
-                elif atom_name == "CB":
-                    # Coordinates for searching sites
-                    betas[column_for_res[res]] = coord
-                elif atom_name == "C":
-                    # Coordinates for searching sites
-                    carbons[column_for_res[res]] = coord
-                elif atom_name == "N":
-                    # Coordinates for searching sites
-                    nitrogens[column_for_res[res]] = coord
-                elif atom_name == "O":
-                    # Coordinates for searching sites
-                    oxygens[column_for_res[res]] = coord
-                else: # Atom belongs to a side-chain
-                    # Coordinates for discarding clashes
-                    side_chains.append(coord)
-
-        coords_array = np.array(coords_array)
-        centroid =  np.mean(coords_array, axis=0)
-        max_distance  = np.max(np.linalg.norm(coords_array - centroid, axis=1)) \
-                        + DIST_PROBE_ALPHA['ALL'][1]
-
-        alphas = np.array(alphas)
-        betas = np.array(betas)
-        carbons = np.array(carbons)
-        nitrogens = np.array(nitrogens)
-        oxygens = np.array(oxygens)
-        side_chains = np.array(side_chains)
+    #Compressed files are decompressed while read, the format is the one of
+    #the inner file
+    file_format = file_extension[:-3] if file_extension.endswith('.gz') else file_extension
+    if file_format == '.pdb':
+        atoms = _pdb_atoms(lines)
+    elif file_format == '.cif':
+        atoms = _cif_atoms(lines)
+    else:
+        raise Exception("The input should be a file of a valid type: " + str(ALLOWED_FILE_TYPES))
+
+    #Position of every backbone atom type in the `backbone` array, the
+    #rest of atoms belong to side-chains
+    atom_types = {'CA': 0, 'CB': 1, 'C': 2, 'N': 3, 'O': 4}
+    side_chain_type = len(atom_types)
+
+    #Coordinates, type and residue column of every atom, filled in a single
+    #pass over the lines (which are not kept in memory), growing the arrays
+    #when full
+    capacity = 4096
+    coords = np.empty((capacity, 3))
+    types = np.empty(capacity, dtype=np.int8)
+    columns = np.empty(capacity, dtype=np.int64)
+    n_atoms = 0
+    column_for_res = {}
+    res_for_column = {}
+    name_for_res = {}
+    atoms_in_res = {}
+    for atom_name, res, resname, x, y, z in atoms:
+        if n_atoms == capacity:
+            capacity *= 2
+            coords = np.resize(coords, (capacity, 3))
+            types = np.resize(types, capacity)
+            columns = np.resize(columns, capacity)
+        # atomic coordinates
+        try:
+            coords[n_atoms] = float(x), float(y), float(z)
+        except Exception:
+            raise Exception("Invalid or missing coordinate(s) at \
+                            residue %s, atom %s" % (res, atom_name))
+        atom_type = atom_types.get(atom_name, side_chain_type)
+        types[n_atoms] = atom_type
+        if atom_type != side_chain_type:
+            # Residue information and column assignment
+            column = column_for_res.get(res)
+            if column is None:
+                column = len(column_for_res)
+                column_for_res[res] = column
+                res_for_column[column] = res
+                name_for_res[res] = CONVERT_RES_NAMES.get(resname, resname)
+                atoms_in_res[res] = set()
+            atoms_in_res[res].add(atom_name)
+            columns[n_atoms] = column
+        n_atoms += 1
+    coords, types, columns = coords[:n_atoms], types[:n_atoms], columns[:n_atoms]
+
+    #Backbone coordinates of every residue (the last ones if repeated, and
+    #zeros if missing) and side-chain coordinates for discarding clashes
+    backbone = np.zeros((len(atom_types), len(column_for_res), 3))
+    for atom_type in range(len(atom_types)):
+        is_type = types == atom_type
+        backbone[atom_type, columns[is_type]] = coords[is_type]
+    alphas, betas, carbons, nitrogens, oxygens = backbone
+    side_chains = coords[types == side_chain_type]
+
+    # Coordinates of all the alpha carbons for the grid
+    coords_array = coords[types == atom_types['CA']]
+    centroid =  np.mean(coords_array, axis=0)
+    max_distance  = np.max(np.linalg.norm(coords_array - centroid, axis=1)) \
+                    + DIST_PROBE_ALPHA['ALL'][1]
+    return centroid, max_distance, alphas, betas, carbons, nitrogens, \
+            oxygens, column_for_res, res_for_column, name_for_res, \
+            atoms_in_res, side_chains
+
+def _split_models(lines, file_extension='.pdb'):
+    """
+    Splits the lines of a structure in its models (e.g. the conformers of an
+    NMR structure or the snapshots of a trajectory).
+
+    Models are delimited by `MODEL` records in PDB files, and by the model
+    number of every atom (`pdbx_PDB_model_num`) in mmCIF files.
+
+    Parameters
+    ----------
+    lines : iterable
+        Lines of the structure of the protein, e.g. a list of str or an open
+        file
+    file_extension : str, optional
+        Extension indicating the format of the `lines`. Defaults to `.pdb`
+
+    Returns
+    -------
+    list of lists
+        Lines of every model. All the lines form a single model if there are
+        no `MODEL` records (or model numbers)
+    """
+    if file_extension.endswith('.gz'):
+        file_extension = file_extension[:-3]
+    if file_extension == '.cif':
+        return _split_cif_models(lines)
+    models = []
+    #Lines before the first model, which are the only model if there are no
+    #`MODEL` records (the lines are read once, e.g. from a file)
+    model = single_model = []
+    for line in lines:
+        if line[0:6] == "MODEL ":
+            model = []
+            models.append(model)
+        elif line[0:6] == "ENDMDL":
+            model = None
+        elif model is not None:
+            model.append(line)
+    if not models:
+        models.append(single_model)
+    return models
+
+def _split_cif_models(lines):
+    """
+    Splits the rows of the `_atom_site` table of a mmCIF structure by their
+    model number.
+
+    Parameters
+    ----------
+    lines : iterable
+        Lines of the structure of the protein in mmCIF format
+
+    Returns
+    -------
+    list of lists
+        Lines of every model (the header of the table and its rows), in the
+        order of their first atom
+    """
+    models = {}
+    table_fields = None
+    for fields, line, values in _cif_rows(lines):
+        if fields is not table_fields:
+            table_fields = fields
+            header = ['loop_'] + fields
+            model_col = _cif_column(fields, _CIF_ATOM_FIELDS[-1])
+        model = values[model_col] if model_col is not None else None
+        if model not in models:
+            models[model] = list(header)
+        models[model].append(line)
+    return list(models.values()) or [[]]
+
+def _parse_ensemble(models, file_extension):
+    """
+    Parses the models of an ensemble and stacks their coordinates.
+
+    Every model is parsed as in `_parse_molecule`, and all of them should
+    contain the same residues and atoms, so the residue dictionaries of the
+    first model are shared by all the models.
+
+    Parameters
+    ----------
+    models : list of array_like
+        Lines of every model, e.g. as returned by `_split_models`
+    file_extension : str
+        Extension indicating the format of the lines
+
+    Returns
+    -------
+    np.array
+        3-float numpy array containing the centroid of all the models
+    float
+        Distance to the furthest alpha carbon of any model, adding the same
+        margin than `_parse_molecule`
+    np.array
+        Coordinates of every model (first axis) for all the alpha carbons of
+        the protein. Same for the beta carbons, backbone carbons, backbone
+        nitrogens, backbone oxygens and side-chain atoms in the next arrays
+    dict
+        Correspondence between number:chain of residue and column number
+    dict
+        Correspondence between column number and number of residue:chain
+    dict
+        Name of the residue given its number:chain
+    dict
+        Name of atoms contained in a given residue (indexed by number_res:chain)
+    """
+    frames = []
+    for i, lines in enumerate(models):
+        structure = _parse_molecule(lines, file_extension)
+        if i == 0:
+            column_for_res, res_for_column, name_for_res, atoms_in_res = structure[7:11]
+        elif structure[8] != res_for_column or structure[10] != atoms_in_res or \
+                len(structure[11]) != len(frames[0][5]):
+            raise Exception("All the models should contain the same residues and atoms (model %d differs from the first one)" % (i + 1))
+        frames.append(structure[2:7] + structure[11:])
+    alphas, betas, carbons, nitrogens, oxygens, side_chains = [np.stack(arrays) for arrays in zip(*frames)]
+
+    #Grid containing the alpha carbons of all the models
+    has_alpha = np.array(['CA' in atoms_in_res[res_for_column[column]] for column in range(len(res_for_column))], dtype=bool)
+    coords_array = alphas[:,has_alpha].reshape(-1, 3)
+    centroid = np.mean(coords_array, axis=0)
+    max_distance = np.max(np.linalg.norm(coords_array - centroid, axis=1)) \
+                    + DIST_PROBE_ALPHA['ALL'][1]
     return centroid, max_distance, alphas, betas, carbons, nitrogens, \
             oxygens, column_for_res, res_for_column, name_for_res, \
             atoms_in_res, side_chains
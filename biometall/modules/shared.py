@@ -0,0 +1,186 @@
+"""
+shared.py
+Module with functions to share the protein arrays with the worker processes
+"""
+
+import os
+import tempfile
+import threading
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError: # Python < 3.8, a memory-mapped scratch file is used instead
+    shared_memory = None
+
+# Arrays attached by the current process, indexed by the name of their block
+_ATTACHED = {}
+
+def _share_arrays(arrays):
+    """
+    Copies a set of arrays into a single block of shared memory.
+
+    The block is created once per calculation, so the worker processes can
+    attach to it by name instead of receiving a pickled copy of the arrays
+    with every chunk. If `multiprocessing.shared_memory` is not available,
+    a memory-mapped scratch file is used instead.
+
+    Parameters
+    ----------
+    arrays : dict
+        Numpy arrays to be shared, indexed by name
+
+    Returns
+    -------
+    object
+        Handle of the block, to be released with `_release_arrays`
+    tuple
+        Description of the block (name and layout of the arrays), to be used
+        by the workers with `_attach_arrays`
+    """
+    arrays = {key: np.asarray(array, order='C') for key, array in arrays.items()}
+    layout = []
+    offset = 0
+    for key, array in arrays.items():
+        layout.append((key, array.dtype.str, array.shape, offset))
+        offset += array.nbytes
+    size = max(offset, 1)
+
+    if shared_memory is not None:
+        block = shared_memory.SharedMemory(create=True, size=size)
+        name = block.name
+        buffer = block.buf
+    else:
+        fd, name = tempfile.mkstemp(prefix='biometall_', suffix='.dat')
+        os.close(fd)
+        block = np.memmap(name, dtype=np.uint8, mode='w+', shape=(size,))
+        buffer = block
+    for (key, dtype, shape, start), array in zip(layout, arrays.values()):
+        view = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=start)
+        view[...] = array
+        del view
+    if shared_memory is None:
+        block.flush()
+    return block, (name, size, tuple(layout))
+
+def _prepare_workers():
+    """
+    Prepares the current process to share arrays with a pool created next.
+
+    Worker processes started before any block is shared would track the
+    blocks they attach to with their own resource tracker, which reports
+    (and tries to free) them as leaked when the worker exits. Starting the
+    tracker before the pool makes the workers use the one of the parent.
+    """
+    if shared_memory is not None and hasattr(resource_tracker, 'ensure_running'):
+        resource_tracker.ensure_running()
+
+def _attach_arrays(description):
+    """
+    Gives access to the arrays shared by `_share_arrays`.
+
+    Each process attaches to a given block only once. Previously attached
+    blocks are detached, since a worker only processes chunks from one
+    calculation at a time.
+
+    Parameters
+    ----------
+    description : tuple
+        Description of the block, as returned by `_share_arrays`
+
+    Returns
+    -------
+    dict
+        Read-only numpy arrays indexed by name
+    """
+    name, size, layout = description
+    if name in _ATTACHED:
+        return _ATTACHED[name][1]
+    _detach_arrays()
+    if shared_memory is not None:
+        block = shared_memory.SharedMemory(name=name)
+        buffer = block.buf
+    else:
+        block = np.memmap(name, dtype=np.uint8, mode='r', shape=(size,))
+        buffer = block
+    arrays = {}
+    for key, dtype, shape, start in layout:
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=start)
+        arrays[key].flags.writeable = False
+    _ATTACHED[name] = (block, arrays)
+    return arrays
+
+def _detach_arrays():
+    """
+    Detaches the current process from all the shared blocks.
+    """
+    for name in list(_ATTACHED):
+        block, arrays = _ATTACHED.pop(name)
+        arrays.clear()
+        if shared_memory is not None:
+            try:
+                block.close()
+            except BufferError: # some view is still alive, freed at exit
+                pass
+
+def _release_arrays(block):
+    """
+    Frees a block created by `_share_arrays`.
+
+    Parameters
+    ----------
+    block : object
+        Handle of the block, as returned by `_share_arrays`
+    """
+    if shared_memory is not None:
+        block.close()
+        block.unlink()
+    else:
+        name = block.filename
+        del block
+        os.remove(name)
+
+def _imap_bounded(pool, function, tasks, max_pending):
+    """
+    Applies a function to a list of tasks, yielding the results as they are ready.
+
+    Works as `pool.imap_unordered`, but no more than `max_pending` tasks are
+    submitted before their results are consumed, so the results waiting to be
+    processed by the parent never exceed `max_pending`.
+
+    Parameters
+    ----------
+    pool : multiprocessing.Pool
+        Pool of worker processes
+    function : callable
+        Function to apply to every task
+    tasks : iterable
+        Arguments of `function`
+    max_pending : int
+        Maximum number of tasks submitted and not yet consumed
+
+    Notes
+    -----
+    The generator should be closed before terminating the pool if it is not
+    fully consumed.
+
+    Yields
+    ------
+    object
+        Result of `function` for each task, in completion order
+    """
+    pending = threading.Semaphore(max(1, max_pending))
+    stopped = threading.Event()
+    def submitted():
+        for task in tasks:
+            #The pool can not be terminated while this generator is blocked
+            while not pending.acquire(timeout=0.1):
+                if stopped.is_set():
+                    return
+            yield task
+    try:
+        for result in pool.imap_unordered(function, submitted()):
+            pending.release()
+            yield result
+    finally:
+        stopped.set()
@@ -1,6 +1,14 @@
 import os
+import pytest
 
 TESTPATH = os.path.dirname(os.path.abspath(__file__))
 
 def datapath(path):
-    return os.path.join(TESTPATH, 'data', path)
\ No newline at end of file
+    return os.path.join(TESTPATH, 'data', path)
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Keeps the structures cached by the tests out of the user cache"""
+    path = tmp_path / 'cache'
+    monkeypatch.setenv('BIOMETALL_CACHE_DIR', str(path))
+    return path
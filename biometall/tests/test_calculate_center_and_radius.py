@@ -24,3 +24,39 @@ def test_calculate_center_and_radius(probes, center, radius):
     np_center = np.array(center)
     assert np_center == approx(center_result, abs=1e-3)
     assert radius_result == approx(radius, abs=1e-3)
+
+def _row_by_row_center_and_radius(probes):
+    #Previous implementation, adding the distances of every row in order
+    probes = np.array(probes)
+    distance_matrix = np.linalg.norm(probes - probes[:,None], axis=-1)
+    for i, probe in enumerate(distance_matrix):
+        sum_dist_probe = sum(probe)
+        if i == 0 or sum_dist_probe < min_sum_dist:
+            min_sum_dist = sum_dist_probe
+            best_probe = i
+            highest_dist = max(probe)
+    return probes[best_probe], highest_dist
+
+def test_calculate_center_and_radius_blocks():
+    rng = np.random.default_rng(0)
+    probes = rng.integers(-5, 6, size=(300, 3)) * 0.5
+    clusters = [probes]
+    #Symmetric clusters of grid probes, with many equal sums of distances
+    for n in range(4, 10):
+        points = np.stack(np.meshgrid(*[np.arange(n) * 0.5] * 3, indexing='ij'), axis=-1).reshape(-1, 3)
+        for cutoff in (0.6, 0.9, 1.3, 1.7):
+            points_in = points[np.linalg.norm(points - points.mean(axis=0), axis=1) <= cutoff * n / 4]
+            clusters.append(points_in + rng.uniform(-20, 20, 3).round(1))
+    for cluster in clusters:
+        expected_center, expected_radius = _row_by_row_center_and_radius(cluster)
+        for block_size in (1, 7, len(cluster)):
+            center_result, radius_result = grid._calculate_center_and_radius(cluster, block_size=block_size)
+            assert np.array_equal(expected_center, center_result)
+            assert expected_radius == radius_result
+
+def test_calculate_center_and_radius_approximate():
+    probes = np.stack(np.meshgrid(*[np.arange(12.0)] * 3, indexing='ij'), axis=-1).reshape(-1, 3)
+    center, radius = grid._calculate_center_and_radius(probes)
+    center_result, radius_result = grid._calculate_center_and_radius(probes, approximate_above=1000, sample_size=100)
+    assert np.linalg.norm(center_result - center) <= 1.0
+    assert np.linalg.norm(probes - center_result, axis=1).max() == approx(radius_result)
@@ -0,0 +1,28 @@
+import pytest
+import numpy as np
+from biometall.modules import neighbors
+
+testdata = [
+    (0, 50, 200, 3.0),
+    (1, 300, 1000, 10.162),
+    (2, 1, 10, 1.0),
+    (3, 0, 10, 1.0),
+]
+@pytest.mark.parametrize("seed,n_points,n_queries,radius", testdata)
+
+def test_query_cell_list(seed, n_points, n_queries, radius):
+    rng = np.random.RandomState(seed)
+    points = rng.uniform(-20, 20, (n_points, 3))
+    queries = rng.uniform(-30, 30, (n_queries, 3))
+    cell_list = neighbors._cell_list(points, radius)
+    query_idx, point_idx = neighbors._query_cell_list(cell_list, queries, radius)
+
+    distances = np.linalg.norm(queries[:,np.newaxis] - points, axis=-1)
+    expected_query_idx, expected_point_idx = np.where(distances <= radius)
+    assert np.array_equal(query_idx, expected_query_idx)
+    assert np.array_equal(point_idx, expected_point_idx)
+
+def test_query_cell_list_radius():
+    cell_list = neighbors._cell_list(np.zeros((1, 3)), 1.0)
+    with pytest.raises(ValueError):
+        neighbors._query_cell_list(cell_list, np.zeros((1, 3)), 2.0)
@@ -1,6 +1,7 @@
 import pytest
+import itertools
 
-from biometall.modules import motif
+from biometall.modules import box, motif
 
 
 testdata = [
@@ -32,7 +33,32 @@ testdata = [
 def test_check_actual_motif(motif_possibilities, probe_coordinators, 
                                 name_for_res, res_for_column, solution):
     
-    result = motif._check_actual_motif(motif_possibilities, 
+    result = motif._check_actual_motif(motif._compile_motif(motif_possibilities), 
                         probe_coordinators, name_for_res, res_for_column)
     
-    assert solution == result
\ No newline at end of file
+    assert solution == result
+
+
+def test_check_actual_motif_combinations():
+    #Same solutions than testing every combination of coordinators with
+    #every product of the alternatives of the motif
+    motifs = [['HIS', 'ASP', 'GLU'], ['HIS', 'ASP', 'GLU'], ['HIS', 'ASP', 'GLU'], ['CYS']]
+    names = ['HIS', 'ASP', 'GLU', 'CYS', 'HIS', 'GLU', 'CYS', 'HIS', 'SER']
+    res_for_column = {i: '%d:A' % i for i in range(len(names))}
+    name_for_res = {res_for_column[i]: names[i] for i in range(len(names))}
+    probe_coordinators = {i: [names[i]] for i in range(len(names))}
+    expected = set()
+    for m in itertools.combinations(range(len(names)), len(motifs)):
+        for possible_motif in itertools.product(*motifs):
+            if box._counterSubset(possible_motif, [names[i] for i in m]):
+                expected.add(m)
+
+    compiled_motif = motif._compile_motif(motif._motif_combinations(motifs))
+    assert len(compiled_motif.multisets) == 10
+    memo = {}
+    for i in range(2):
+        result = motif._check_actual_motif(compiled_motif, probe_coordinators,
+                                            name_for_res, res_for_column, memo)
+        assert expected == result
+        assert list(expected) == list(result)
+    assert len(memo) == 1
@@ -1,6 +1,8 @@
 import pytest
+import itertools
+import random
 
-from biometall.modules import motif
+from biometall.modules import box, motif
 
 
 testdata = [
@@ -24,7 +26,30 @@ testdata = [
 def test_check_possible_mutations(motif_possibilities, residues, 
                                 probe_coordinators, solution):
     
-    result = motif._check_possible_mutations(motif_possibilities, residues, 
+    result = motif._check_possible_mutations(motif._compile_motif(motif_possibilities), residues, 
                                                 probe_coordinators)
     
-    assert solution == result
\ No newline at end of file
+    assert solution == result
+
+def test_check_possible_mutations_matching():
+    #Same mutations than testing every product of the names of the
+    #coordinators with every product of the alternatives of the motif
+    rng = random.Random(0)
+    mutated_motif = [['HIS', 'ASP', 'GLU'], ['HIS', 'CYS'], ['ASP']]
+    residues = set(x for l in mutated_motif for x in l)
+    compiled_motif = motif._compile_motif(motif._motif_combinations(mutated_motif))
+    memo = {}
+    for i in range(200):
+        probe_coordinators = {column: rng.sample(['HIS', 'ASP', 'GLU', 'CYS', 'SER'], rng.randint(1, 3))
+                                for column in rng.sample(range(20), rng.randint(1, 5))}
+        is_achievable = any(box._counterSubset(possible_motif, names)
+                                for names in itertools.product(*probe_coordinators.values())
+                                for possible_motif in itertools.product(*mutated_motif))
+        expected = {}
+        if is_achievable:
+            expected = {column: set(names) & residues for column, names in probe_coordinators.items()
+                            if set(names) & residues}
+        result = motif._check_possible_mutations(compiled_motif, residues,
+                                                    probe_coordinators, memo)
+        assert expected == result
+    assert len(memo) < 200
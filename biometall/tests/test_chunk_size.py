@@ -2,18 +2,28 @@ import pytest
 from biometall.modules import grid
 
 testdata = [
-    (19870,437,1,268435456,9936),
-    (19870,437,4,268435456,2484),
-    (19870,437,8,268435456,1325),
-    (19870,437,1,2147483648,19871),
-    (19870,437,4,2147483648,4968),
-    (19870,437,8,2147483648,2484),
-    (19870,437,1,4294967296,19871),
-    (19870,437,4,4294967296,4968),
-    (19870,437,8,4294967296,2484),
+    (19870,437,1,67108864,'dense','squared',0.0,1919),
+    (19870,437,4,67108864,'dense','squared',0.0,479),
+    (19870,437,8,67108864,'dense','squared',0.0,239),
+    (19870,437,8,67108864,'dense','sqrt',0.0,149),
+    (19870,437,8,67108864,'dense','squared',1.5,228),
+    (19870,437,1,2147483648,'dense','squared',0.0,4968),
+    (19870,437,4,2147483648,'dense','squared',0.0,1242),
+    (19870,437,8,2147483648,'dense','squared',0.0,621),
+    (19870,437,8,None,'dense','squared',0.0,621),
+    (19870,5000,8,268435456,'cells','squared',0.0,621),
+    (19870,5000,8,268435456,'dense','squared',0.0,83),
+    (100,437,8,2147483648,'dense','squared',0.0,100),
 ]
-@pytest.mark.parametrize("len_grid,len_protein,n_cores,optimize_to,chunk_size", testdata)
+@pytest.mark.parametrize("len_grid,len_protein,n_cores,max_memory,engine,kernel,sc_clashes,chunk_size", testdata)
 
-def test_chunk_size(len_grid, len_protein, n_cores, optimize_to, chunk_size):
-    chunk_size_result = grid._chunk_size(len_grid, len_protein, n_cores, optimize_to)
+def test_chunk_size(len_grid, len_protein, n_cores, max_memory, engine, kernel, sc_clashes, chunk_size):
+    chunk_size_result = grid._chunk_size(len_grid, len_protein, n_cores, max_memory,
+                                            engine, kernel, sc_clashes,
+                                            available_memory=8589934592)
     assert chunk_size == chunk_size_result
+
+def test_chunk_size_available_memory():
+    #Chunks never use more than a fraction of the available memory
+    chunk_size_result = grid._chunk_size(19870, 437, 4, 2147483648, available_memory=134217728)
+    assert chunk_size_result * 80 * 437 * 4 <= 67108864
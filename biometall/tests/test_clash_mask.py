@@ -0,0 +1,20 @@
+import pytest
+import numpy as np
+from biometall.modules import neighbors
+
+testdata = [
+    (0.5, 'squared'),
+    (1.5, 'squared'),
+    (1.5, 'sqrt'),
+    (3.0, 'sqrt'),
+]
+@pytest.mark.parametrize("threshold,kernel", testdata)
+
+def test_clash_mask(threshold, kernel):
+    rng = np.random.default_rng(0)
+    atoms = rng.uniform(-8, 8, size=(400, 3))
+    probes = rng.uniform(-10, 10, size=(2000, 3))
+    cell_list = neighbors._sidechain_cells(atoms, threshold)
+    is_clashing = neighbors._clash_mask(cell_list, probes, threshold, kernel)
+    distances = np.linalg.norm(probes[:,None] - atoms, axis=-1)
+    assert np.array_equal(is_clashing, np.any(distances < threshold, axis=1))
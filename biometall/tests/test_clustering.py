@@ -0,0 +1,61 @@
+import pytest
+from pathlib import Path
+import numpy as np
+import os
+
+from biometall import biometall
+from biometall.modules import data, geometry, grid, pdb
+
+TEST_DATA_DIR = os.path.join(Path(__file__).resolve().parent, 'data')
+
+testdata = [
+    ('1oi0.pdb', [-8.0, 34.0, -45.0], 6.0, 0.5, None, 3, 2, 1000),
+    ('1oi0.pdb', [-8.0, 34.0, -45.0], 6.0, 0.5, 'ALL', 3, 1, 777),
+    ('1oi0.pdb', [-8.0, 34.0, -45.0], 8.0, 1.0, None, 2, 2, 100),
+]
+@pytest.mark.parametrize("file_name,center,radius,grid_step, \
+                            consider_backbone_residues,min_coordinators, \
+                            min_sidechain,chunk_size", testdata)
+
+def test_clustering(file_name, center, radius, grid_step, consider_backbone_residues,
+                    min_coordinators, min_sidechain, chunk_size):
+    residues = ['ASP', 'HIS', 'GLU', 'CYS']
+    with open(os.path.join(TEST_DATA_DIR, file_name), "r") as f:
+        lines = f.read().splitlines()
+    centroid, _, alphas, betas, carbons, nitrogens, oxygens, \
+        column_for_res, res_for_column, name_for_res, atoms_in_res, \
+        side_chains = pdb._parse_molecule(lines, '.pdb')
+    probes = grid._grid(np.array(center), radius, grid_step)
+    alpha_beta_distances = np.sqrt((np.square(betas-alphas).sum(axis=1)))
+    oxygen_carbon_distances = np.sqrt((np.square(carbons-oxygens).sum(axis=1)))
+    thresholds = geometry._residue_thresholds(name_for_res, res_for_column,
+                                                atoms_in_res, residues)
+
+    chunks = []
+    for start in [0] + list(range(0, len(probes), chunk_size)):
+        chunk = probes[start:] if not chunks else probes[start:start+chunk_size]
+        _, coordinations, discarded = biometall._test_chunk(chunk, alphas,
+                        betas, carbons, nitrogens, oxygens, side_chains,
+                        alpha_beta_distances, oxygen_carbon_distances,
+                        name_for_res, column_for_res, res_for_column,
+                        atoms_in_res, consider_backbone_residues,
+                        data.DIST_PROBE_ALPHA, data.DIST_PROBE_BETA,
+                        data.ANGLE_PAB, 1.0, 0.0, 'dense', None, thresholds)
+        chunks.append((start, chunk, coordinations, discarded))
+
+    results = []
+    #The whole grid in a single chunk, and in several chunks in reverse order
+    for ordered_chunks in (chunks[:1], chunks[:0:-1]):
+        centers, _ = biometall.clustering(ordered_chunks, residues, None,
+                        min_coordinators, min_sidechain, consider_backbone_residues,
+                        None, 0.0, file_name, name_for_res, res_for_column, atoms_in_res)
+        results.append(centers)
+
+    #Same environments, in the same order and with the same probes
+    single, chunked = results
+    assert len(chunks) > 2
+    assert len(single) > 0 and len(single) == len(chunked)
+    for center1, center2 in zip(single, chunked):
+        assert center1[0] == center2[0]
+        assert center1[2] == center2[2]
+        assert np.array_equal(center1[4], center2[4])
@@ -0,0 +1,21 @@
+import pytest
+import numpy as np
+
+from biometall import biometall
+from biometall.modules import data
+
+testdata = [
+    ([], [], [], []),
+    ([('BCK', [0, 3], [5, 1]), ('SC', [], []), ('HIS', np.array([2]), np.array([7]))],
+        [0, 3, 2], [5, 1, 7], ['BCK', 'BCK', 'HIS']),
+]
+@pytest.mark.parametrize("coordinations,probe_idx,res_idx,types", testdata)
+
+def test_coordination_table(coordinations, probe_idx, res_idx, types):
+    coordinations = [(data.COORDINATION_TYPES.index(name), probes, columns)
+                        for name, probes, columns in coordinations]
+    table = biometall._coordination_table(coordinations)
+    assert [column.dtype for column in table] == [np.int32, np.int32, np.int8]
+    assert table[0].tolist() == probe_idx
+    assert table[1].tolist() == res_idx
+    assert [data.COORDINATION_TYPES[code] for code in table[2]] == types
@@ -0,0 +1,20 @@
+import pytest
+
+from biometall import biometall
+
+testdata = [
+    ((0, 1, 2), 3, 2, [(0, 0b111)]),
+    ((0, 4, 1), 2, 1, [(0, 0b10001), (1, 0b11), (2, 0b10010), (3, 0b10011)]),
+    ((0, 4, 1), 2, 2, [(1, 0b11), (3, 0b10011)]),
+    ((0, 1), 3, 1, []),
+]
+@pytest.mark.parametrize("coordinators,min_coordinators,min_sidechain,expected", testdata)
+
+def test_coordinator_subsets(coordinators, min_coordinators, min_sidechain, expected):
+    subsets = biometall._coordinator_subsets(coordinators, min_coordinators, min_sidechain, 3)
+    assert subsets == expected
+
+def test_environment_residues():
+    labels = ['5:A', '12:A', '7:B', '5:A_BCK', '12:A_BCK', '7:B_BCK']
+    assert biometall._environment_residues(0b010011, labels) == ('12:A', '12:A_BCK', '5:A')
+    assert biometall._environment_residues(0, labels) == ()
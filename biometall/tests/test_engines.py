@@ -0,0 +1,53 @@
+import pytest
+from pathlib import Path
+import numpy as np
+import os
+
+from biometall import biometall
+from biometall.modules import data, geometry, grid, pdb, neighbors
+
+TEST_DATA_DIR = os.path.join(Path(__file__).resolve().parent, 'data')
+
+testdata = [
+    ('1oi0.pdb', None, 1.0, None, 1.0, 0.0, None),
+    ('1oi0.pdb', 15.0, 1.0, 'ALL', 1.5, 1.5, None),
+    ('1oi0.pdb', 12.0, 0.7, ['HIS'], 0.0, 0.0, None),
+    ('1oi0.pdb', None, 1.0, ['HIS'], 1.0, 0.0, ['ASP', 'HIS', 'GLU', 'CYS']),
+]
+@pytest.mark.parametrize("file_name,grid_radius,grid_step, \
+                            consider_backbone_residues,bck_clashes, \
+                            sc_clashes,residues", testdata)
+
+def test_engines(file_name, grid_radius, grid_step, consider_backbone_residues,
+                    bck_clashes, sc_clashes, residues):
+    with open(os.path.join(TEST_DATA_DIR, file_name), "r") as f:
+        lines = f.read().splitlines()
+    centroid, radius, alphas, betas, carbons, nitrogens, oxygens, \
+        column_for_res, res_for_column, name_for_res, atoms_in_res, \
+        side_chains = pdb._parse_molecule(lines, '.pdb')
+    probes = grid._grid(centroid, grid_radius or radius, grid_step)
+    alpha_beta_distances = np.sqrt((np.square(betas-alphas).sum(axis=1)))
+    oxygen_carbon_distances = np.sqrt((np.square(carbons-oxygens).sum(axis=1)))
+
+    if residues:
+        thresholds = geometry._residue_thresholds(name_for_res, res_for_column,
+                                                    atoms_in_res, residues)
+    else:
+        thresholds = None
+
+    results = []
+    for engine in data.ENGINES:
+        cells = neighbors._backbone_cells(alphas, carbons, nitrogens, oxygens, bck_clashes)
+        results.append(biometall._test_chunk(probes, alphas, betas, carbons,
+                        nitrogens, oxygens, side_chains, alpha_beta_distances,
+                        oxygen_carbon_distances, name_for_res, column_for_res,
+                        res_for_column, atoms_in_res, consider_backbone_residues,
+                        data.DIST_PROBE_ALPHA, data.DIST_PROBE_BETA,
+                        data.ANGLE_PAB, bck_clashes, sc_clashes, engine, cells,
+                        thresholds))
+
+    dense, cells = results
+    for column1, column2 in zip(dense[1], cells[1]):
+        assert column1.dtype == column2.dtype
+        assert np.array_equal(column1, column2)
+    assert np.array_equal(dense[2], cells[2])
@@ -0,0 +1,52 @@
+import pytest
+from pathlib import Path
+import numpy as np
+import os
+
+from biometall import biometall
+from biometall.modules import data, geometry, grid, pdb
+
+TEST_DATA_DIR = os.path.join(Path(__file__).resolve().parent, 'data')
+
+# Same structures, grids and thresholds as the full calculation tests
+testdata = [
+    ('1oi0.pdb', 1.0, None, 1.0, 0.0, ['ASP', 'HIS', 'GLU', 'CYS']),
+    ('1oi0.pdb', 1.0, None, 1.0, 0.0, None),
+    ('1oi0.pdb', 1.0, ['HIS'], 1.0, 0.0, ['ASP', 'HIS', 'GLU', 'CYS']),
+    ('1oi0.pdb', 1.0, None, 1.5, 1.5, ['ASP', 'HIS', 'GLU', 'CYS']),
+    ('1oi0.pdb', 1.0, 'ALL', 1.0, 0.0, list(data.DIST_PROBE_ALPHA)),
+]
+@pytest.mark.parametrize("file_name,grid_step,consider_backbone_residues, \
+                            bck_clashes,sc_clashes,residues", testdata)
+
+def test_kernels(file_name, grid_step, consider_backbone_residues, bck_clashes,
+                    sc_clashes, residues):
+    with open(os.path.join(TEST_DATA_DIR, file_name), "r") as f:
+        lines = f.read().splitlines()
+    centroid, radius, alphas, betas, carbons, nitrogens, oxygens, \
+        column_for_res, res_for_column, name_for_res, atoms_in_res, \
+        side_chains = pdb._parse_molecule(lines, '.pdb')
+    probes = grid._grid(centroid, radius, grid_step)
+    alpha_beta_distances = np.sqrt((np.square(betas-alphas).sum(axis=1)))
+    oxygen_carbon_distances = np.sqrt((np.square(carbons-oxygens).sum(axis=1)))
+    if residues:
+        thresholds = geometry._residue_thresholds(name_for_res, res_for_column,
+                                                    atoms_in_res, residues)
+    else:
+        thresholds = None
+
+    results = []
+    for kernel in data.KERNELS:
+        results.append(biometall._test_chunk(probes, alphas, betas, carbons,
+                        nitrogens, oxygens, side_chains, alpha_beta_distances,
+                        oxygen_carbon_distances, name_for_res, column_for_res,
+                        res_for_column, atoms_in_res, consider_backbone_residues,
+                        data.DIST_PROBE_ALPHA, data.DIST_PROBE_BETA,
+                        data.ANGLE_PAB, bck_clashes, sc_clashes, 'dense', None,
+                        thresholds, kernel))
+
+    squared, sqrt = results
+    for column1, column2 in zip(squared[1], sqrt[1]):
+        assert column1.dtype == column2.dtype
+        assert np.array_equal(column1, column2)
+    assert np.array_equal(squared[2], sqrt[2])
@@ -0,0 +1,47 @@
+import pytest
+from shutil import copyfile
+from pathlib import Path
+import numpy as np
+import os
+
+import biometall
+
+TEST_DATA_DIR = os.path.join(Path(__file__).resolve().parent, 'data')
+
+def test_maximal_environments(tmp_path):
+    inputfile = os.path.join(tmp_path, '1oi0.pdb')
+    copyfile(os.path.join(TEST_DATA_DIR, '1oi0.pdb'), inputfile)
+    options = dict(consider_backbone_residues='ALL', min_sidechain=1, use_cache=False)
+    sites = biometall.search(inputfile, **options)
+    sizes = set(len(site.residues) for site in sites)
+    assert max(sizes) > 3
+
+    #Only the subsets up to max_subset_size coordinators are considered
+    capped_sites = biometall.search(inputfile, max_subset_size=3, **options)
+    assert [(site.residues, site.num_probes) for site in capped_sites] == \
+            [(site.residues, site.num_probes) for site in sites if len(site.residues) <= 3]
+
+    #Every probe only belongs to the site of all its coordinators
+    maximal_sites = biometall.search(inputfile, maximal_only=True, **options)
+    probes = np.concatenate([site.probes for site in maximal_sites])
+    assert len(np.unique(probes, axis=0)) == len(probes)
+    assert len(probes) == len(np.unique(np.concatenate([site.probes for site in sites]), axis=0))
+    residues = {site.residues: site.num_probes for site in sites}
+    for site in maximal_sites:
+        assert site.num_probes <= residues[site.residues]
+
+    #The sub-sites derived from the maximal sites are the sites found without
+    #maximal_only
+    subsites = biometall.biometall._subsite_counts(maximal_sites, 3, 1)
+    assert {coord_residues: num_probes for coord_residues, names, num_probes in subsites} == residues
+    assert {coord_residues: names for coord_residues, names, num_probes in subsites} == \
+            {site.residues: site.names for site in sites}
+    capped_subsites = biometall.biometall._subsite_counts(maximal_sites, 3, 1, 3)
+    assert {coord_residues: num_probes for coord_residues, names, num_probes in capped_subsites} == \
+            {site.residues: site.num_probes for site in capped_sites}
+
+    with pytest.raises(Exception, match="max_subset_size"):
+        biometall.search(inputfile, max_subset_size=2, **options)
+    #The maximal sites can not be capped
+    with pytest.raises(Exception, match="max_subset_size can not be used with maximal_only"):
+        biometall.search(inputfile, maximal_only=True, max_subset_size=3, **options)
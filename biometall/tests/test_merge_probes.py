@@ -0,0 +1,18 @@
+import pytest
+import numpy as np
+
+from biometall import biometall
+
+def test_merge_probes():
+    dict_cluster, environment_keys = {}, {}
+    environment = ('1:A', '2:A', '3:A')
+    first = (1, np.array([7, 2]), np.array([[7., 0., 0.], [2., 0., 0.]]))
+    second = (0, np.array([9]), np.array([[9., 0., 0.]]))
+    biometall._add_probes(dict_cluster, environment_keys, environment, first, (1, 2), 3)
+    biometall._add_probes(dict_cluster, environment_keys, environment, second, (0, 9), 5)
+
+    #The environment gets the smallest key of its groups
+    assert environment_keys[environment] == ((0, 9), 5)
+    #Probes sorted by their residue type position and then by their position in the grid
+    probes = biometall._merge_probes(dict_cluster[environment])
+    assert probes.tolist() == [[9., 0., 0.], [2., 0., 0.], [7., 0., 0.]]
@@ -0,0 +1,44 @@
+import pytest
+from pathlib import Path
+import numpy as np
+import gzip
+import os
+
+from biometall.modules import pdb
+
+TEST_DATA_DIR = os.path.join(Path(__file__).resolve().parent, 'data')
+
+testdata = [('1oi0.pdb', '.pdb.gz'), ('1oi0.cif', '.cif.gz')]
+@pytest.mark.parametrize("file_name,extension", testdata)
+
+def test_open_structure(file_name, extension, tmp_path):
+    file_path = os.path.join(TEST_DATA_DIR, file_name)
+    compressed_path = os.path.join(tmp_path, '1oi0' + extension)
+    with open(file_path, "rb") as f, gzip.open(compressed_path, "wb") as g:
+        g.write(f.read())
+    assert pdb._split_extension(compressed_path) == (os.path.join(tmp_path, '1oi0'), extension)
+
+    #The compressed file is parsed as the uncompressed one
+    with open(file_path, "r") as f:
+        expected = pdb._parse_molecule(f.read().splitlines(), extension[:-3])
+    with pdb._open_structure(compressed_path, extension) as f:
+        result = pdb._parse_molecule(f, extension)
+    assert len(result) == len(expected)
+    for item, expected_item in zip(result, expected):
+        if isinstance(expected_item, dict):
+            assert list(item.items()) == list(expected_item.items())
+        else:
+            assert np.array_equal(item, expected_item)
+
+def test_cif_quoted_values():
+    lines = ['data_TEST', 'loop_', '_atom_site.group_PDB', '_atom_site.label_atom_id',
+                '_atom_site.label_comp_id', '_atom_site.label_asym_id', '_atom_site.label_seq_id',
+                '_atom_site.Cartn_x', '_atom_site.Cartn_y', '_atom_site.Cartn_z',
+                "ATOM CA ALA A 1 0.000 0.000 0.000",
+                "ATOM \"C1'\" ALA A 1 1.000 0.000 0.000",
+                "ATOM 'N B' ALA A 1 0.000 1.000 0.000",
+                "HETATM ZN ZN B . 0.000 0.000 1.000",
+                '#']
+    atoms = list(pdb._cif_atoms(lines))
+    assert [atom[:3] for atom in atoms] == [('CA', '1:A', 'ALA'), ("C1'", '1:A', 'ALA'), ('N B', '1:A', 'ALA')]
+    assert atoms[1][3:] == ('1.000', '0.000', '0.000')
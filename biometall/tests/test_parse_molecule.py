@@ -16,6 +16,14 @@ testdata = [
                 108, [6.498,56.855,-44.259],
                 108, 0, '1:A',
                 'GLY', {'C', 'CA', 'N', 'O'}),
+            ('1oi0.cif', '.cif', [-1.1658,39.4787,-46.2727], 29.3750, 
+                108, [4.701,58.174,-45.122],
+                108, [0,0,0],
+                108, [5.414,57.399,-44.034],
+                108, [5.422,58.076,-46.424],
+                108, [6.498,56.855,-44.259],
+                108, 0, '1:A',
+                'GLY', {'C', 'CA', 'N', 'O'}),
 ]
 
 @pytest.mark.parametrize("file_name,extension,centroid,max_distance, \
@@ -70,5 +78,5 @@ def test_parse_molecule_exception(file_name, extension):
     with open(file_path, "r") as f:
         lines = f.read().splitlines()
 
-    with pytest.raises(Exception):
+    with pytest.raises(Exception, match="Invalid or missing coordinate"):
         pdb._parse_molecule(lines, extension)
\ No newline at end of file
@@ -0,0 +1,41 @@
+import pytest
+from shutil import copyfile
+from pathlib import Path
+import os
+
+import biometall
+
+TEST_DATA_DIR = os.path.join(Path(__file__).resolve().parent, 'data')
+
+#Queries of test_full_calculation, searched in a single calculation
+testdata = [
+    ({}, '1oi0_output0.txt', 'results_biometall_1oi0_query1.txt',
+        '1oi0_output0.pdb', 'probes_1oi0_query1.pdb'),
+    ({'motif': '[GLU,GLU,ASP/TYR]', 'cluster_cutoff': 0.2}, '1oi0_output1.txt',
+        'results_biometall_1oi0_GLU_GLU_ASP-TYR_query2.txt',
+        '1oi0_output1.pdb', 'probes_1oi0_GLU_GLU_ASP-TYR_query2.pdb'),
+    ({'consider_backbone_residues': '[HIS]'}, '1oi0_output2.txt',
+        'results_biometall_1oi0_query3.txt',
+        '1oi0_output2.pdb', 'probes_1oi0_query3.pdb'),
+]
+
+def test_queries(tmp_path):
+    inputfile_path = os.path.join(TEST_DATA_DIR, '1oi0.pdb')
+    tmp_inputfile = os.path.join(tmp_path, '1oi0.pdb')
+    copyfile(inputfile_path, tmp_inputfile)
+
+    biometall.run(tmp_inputfile, pdb=True,
+                    queries=[query for query, *outputs in testdata])
+
+    for query, output_text, output_text_name, output_pdb, output_pdb_name in testdata:
+        with open(os.path.join(TEST_DATA_DIR, output_text), "r") as output_file, \
+             open(os.path.join(tmp_path, output_text_name), "r") as result_file:
+            assert output_file.readlines()[0:-1] == result_file.readlines()[2:-1]
+        with open(os.path.join(TEST_DATA_DIR, output_pdb), "r") as output_pdb, \
+             open(os.path.join(tmp_path, output_pdb_name), "r") as result_pdb:
+            assert output_pdb.readlines() == result_pdb.readlines()
+
+def test_queries_invalid_option(tmp_path):
+    inputfile_path = os.path.join(TEST_DATA_DIR, '1oi0.pdb')
+    with pytest.raises(Exception, match="The options of a query"):
+        biometall.run(inputfile_path, queries=[{'grid_step': 0.5}])
@@ -0,0 +1,26 @@
+import pytest
+import numpy as np
+from biometall.modules import grid
+
+testdata = [
+    ([-4.3311, -6.3593, 15.3793], 12.0, 0.5, 997, 1.0),
+    ([12.8607, 37.3031, 18.2772], 8.3, 0.7, 101, 2.1),
+    ([0.0, 0.0, 0.0], 5.0, 0.25, 13, 0.3),
+]
+@pytest.mark.parametrize("centroid,radius,step,every,distance", testdata)
+
+def test_refined_grid(centroid, radius, step, every, distance):
+    centroid = np.array(centroid)
+    points = grid._grid(centroid, radius, step)
+    seeds = points[::every] + 0.1
+    refined = grid._refined_grid(centroid, radius, step, seeds, distance)
+
+    #Same probes than the full grid, in the same order, around the seeds
+    is_refined = np.zeros(len(points), dtype=bool)
+    for seed in seeds:
+        is_refined |= np.all(np.abs(points - seed) <= distance, axis=1)
+    assert np.array_equal(refined, points[is_refined])
+
+def test_refined_grid_no_seeds():
+    refined = grid._refined_grid(np.zeros(3), 5.0, 1.0, np.zeros((0, 3)), 1.0)
+    assert refined.shape == (0, 3)
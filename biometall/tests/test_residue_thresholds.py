@@ -0,0 +1,34 @@
+import pytest
+import numpy as np
+from biometall.modules import geometry
+from biometall.modules.data import DIST_PROBE_ALPHA, DIST_PROBE_BETA, ANGLE_PAB
+
+testdata = [
+    ({'1:A': 'GLY', '2:A': 'HIS', '3:A': 'ASP', '4:A': 'HIS'},
+        {0: '1:A', 1: '2:A', 2: '3:A', 3: '4:A'},
+        {'1:A': {'CA', 'C', 'N', 'O'}, '2:A': {'CA', 'CB', 'C', 'N', 'O'},
+         '3:A': {'CA', 'CB', 'C', 'N', 'O'}, '4:A': {'CA', 'C', 'N', 'O'}},
+        ['HIS', 'GLU'],
+        [None, 'HIS', None, None]),
+    ({'10:B': 'CYS', '11:B': 'GLU'},
+        {0: '10:B', 1: '11:B'},
+        {'10:B': {'CA', 'CB'}, '11:B': {'CA', 'CB'}},
+        ['ASP', 'HIS', 'GLU', 'CYS'],
+        ['CYS', 'GLU']),
+]
+@pytest.mark.parametrize("name_for_res,res_for_column,atoms_in_res,residues, \
+                            types", testdata)
+
+def test_residue_thresholds(name_for_res, res_for_column, atoms_in_res,
+                            residues, types):
+    alpha_limits, beta_limits, pab_limits = geometry._residue_thresholds(
+                        name_for_res, res_for_column, atoms_in_res, residues)
+    for column, res_type in enumerate(types):
+        if res_type is None:
+            assert not geometry._sidechain_mask(np.arange(20.0), np.arange(20.0),
+                        np.linspace(0, np.pi, 20), alpha_limits[:,column],
+                        beta_limits[:,column], pab_limits[:,column]).any()
+        else:
+            assert tuple(alpha_limits[:,column]) == DIST_PROBE_ALPHA[res_type]
+            assert tuple(beta_limits[:,column]) == DIST_PROBE_BETA[res_type]
+            assert tuple(pab_limits[:,column]) == ANGLE_PAB[res_type]
@@ -0,0 +1,54 @@
+import pytest
+from shutil import copyfile
+from pathlib import Path
+import numpy as np
+import os
+
+import biometall
+from biometall.modules import cache
+
+TEST_DATA_DIR = os.path.join(Path(__file__).resolve().parent, 'data')
+
+def test_result_cache(cache_dir, tmp_path, monkeypatch):
+    inputfile = os.path.join(tmp_path, '1oi0.pdb')
+    copyfile(os.path.join(TEST_DATA_DIR, '1oi0.pdb'), inputfile)
+    result_path = os.path.join(tmp_path, 'results_biometall_1oi0.txt')
+    pdb_path = os.path.join(tmp_path, 'probes_1oi0.pdb')
+
+    biometall.run(inputfile, pdb=True)
+    with open(result_path) as result_file, open(pdb_path) as pdb_file:
+        expected_text, expected_pdb = result_file.readlines(), pdb_file.readlines()
+    os.remove(result_path)
+    os.remove(pdb_path)
+
+    #The sites are not searched again with the same file and parameters
+    def search_queries(*args, **kwargs):
+        raise AssertionError("Results not read from the cache")
+    monkeypatch.setattr(biometall.biometall, '_search_queries', search_queries)
+    biometall.run(inputfile, pdb=True)
+    with open(result_path) as result_file, open(pdb_path) as pdb_file:
+        assert result_file.readlines()[2:-1] == expected_text[2:-1]
+        assert pdb_file.readlines() == expected_pdb
+
+    #Other parameters (or a disabled cache) search the sites
+    with pytest.raises(AssertionError, match="Results not read"):
+        biometall.run(inputfile, cluster_cutoff=0.5)
+    with pytest.raises(AssertionError, match="Results not read"):
+        biometall.run(inputfile, use_cache=False)
+
+def test_result_cache_eviction(cache_dir):
+    results = [([(('1:A', '2:A'), np.zeros(3), 1, 0.0, np.zeros((1, 3)))], {})]
+    for i, key in enumerate(('a', 'b', 'c')):
+        cache._store_results(str(cache_dir), key, results)
+        os.utime(os.path.join(cache_dir, key + '.pkl'), (i, i))
+    entry_size = os.path.getsize(os.path.join(cache_dir, 'a.pkl'))
+
+    #Reading an entry marks it as the most recently used
+    loaded = cache._load_results(str(cache_dir), 'a')
+    center, expected_center = loaded[0][0][0], results[0][0][0]
+    assert center[0] == expected_center[0]
+    assert np.array_equal(center[4], expected_center[4])
+
+    cache._store_results(str(cache_dir), 'd', results, max_size=2.5*entry_size)
+    assert sorted(os.listdir(cache_dir)) == ['a.pkl', 'd.pkl']
+    assert cache._load_results(str(cache_dir), 'b') is None
@@ -0,0 +1,36 @@
+import pytest
+from shutil import copyfile
+from pathlib import Path
+import os
+
+import biometall
+
+TEST_DATA_DIR = os.path.join(Path(__file__).resolve().parent, 'data')
+
+def test_run_many(tmp_path):
+    inputfiles = []
+    for name in ('first', 'second'):
+        inputfile = os.path.join(tmp_path, name + '.pdb')
+        copyfile(os.path.join(TEST_DATA_DIR, '1oi0.pdb'), inputfile)
+        inputfiles.append(inputfile)
+    invalid_file = os.path.join(tmp_path, 'invalid.txt')
+    open(invalid_file, "w").close()
+    summary_file = os.path.join(tmp_path, 'summary.txt')
+
+    outcomes = biometall.run_many([inputfiles[0], invalid_file, inputfiles[1]],
+                                    summary_file=summary_file, use_cache=False)
+
+    assert [inputfile for inputfile, results in outcomes] == [inputfiles[0], invalid_file, inputfiles[1]]
+    assert isinstance(outcomes[1][1], Exception)
+    with open(os.path.join(TEST_DATA_DIR, '1oi0_output0.txt'), "r") as output_file:
+        expected = output_file.readlines()[0:-1]
+    for name in ('first', 'second'):
+        with open(os.path.join(tmp_path, 'results_biometall_%s.txt' % name), "r") as result_file:
+            assert result_file.readlines()[2:-1] == expected
+
+    with open(summary_file, "r") as f:
+        lines = f.readlines()[4:]
+    assert len(lines) == 3
+    sites = outcomes[0][1]
+    assert lines[0].split('|')[2].strip() == str(len(sites))
+    assert lines[1].split('|')[2].strip() == 'Error'
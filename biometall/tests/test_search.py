@@ -0,0 +1,81 @@
+import pytest
+from shutil import copyfile
+from pathlib import Path
+import numpy as np
+import os
+import gzip
+
+import biometall
+
+TEST_DATA_DIR = os.path.join(Path(__file__).resolve().parent, 'data')
+
+def test_search(tmp_path, capsys, cache_dir):
+    d = Path(os.path.join(tmp_path, "search"))
+    d.mkdir()
+    inputfile = os.path.join(d, '1oi0.pdb')
+    copyfile(os.path.join(TEST_DATA_DIR, '1oi0.pdb'), inputfile)
+    received = []
+    sites = biometall.search(inputfile, motif='[GLU,GLU,ASP/TYR]', cluster_cutoff=0.2,
+                                sinks=[lambda *args: received.append(args)])
+
+    #No output is printed nor written, not even in the cache
+    assert capsys.readouterr().out == ''
+    assert os.listdir(d) == ['1oi0.pdb']
+    assert not os.path.exists(cache_dir)
+    assert len(received) == 1 and received[0][1] is sites
+
+    with open(os.path.join(TEST_DATA_DIR, '1oi0_output1.txt'), "r") as f:
+        expected = [line.split('|') for line in f.readlines()[2:-1]]
+    assert len(sites) == len(expected)
+    for site, line in zip(sites, expected):
+        assert isinstance(site, biometall.Site)
+        assert ' '.join(name + ':' + res for name, res in zip(site.names, site.residues)) == line[1].strip()
+        assert ' '.join(format(r, '.3f') for r in site.center) == line[2].strip()
+        assert site.num_probes == int(line[3]) == len(site.probes)
+        assert format(site.radius, '.3f') == line[4].strip()
+        assert site.mutations == []
+        assert isinstance(site.probes, np.ndarray) and site.probes.shape == (site.num_probes, 3)
+
+    #The results files are written by a sink
+    biometall.search(inputfile, motif='[GLU,GLU,ASP/TYR]', cluster_cutoff=0.2,
+                        sinks=[biometall.results_sink()])
+    with open(os.path.join(TEST_DATA_DIR, '1oi0_output1.txt'), "r") as output_file, \
+         open(os.path.join(d, 'results_biometall_1oi0_GLU_GLU_ASP-TYR.txt'), "r") as result_file:
+        assert output_file.readlines()[0:-1] == result_file.readlines()[2:-1]
+
+def test_search_no_sites(tmp_path):
+    inputfile = os.path.join(tmp_path, '1oi0.pdb')
+    copyfile(os.path.join(TEST_DATA_DIR, '1oi0.pdb'), inputfile)
+    assert biometall.search(inputfile, motif='[CYS,CYS,CYS,CYS]') == []
+
+def test_search_compressed_cif(tmp_path):
+    inputfile = os.path.join(tmp_path, '1oi0.pdb')
+    copyfile(os.path.join(TEST_DATA_DIR, '1oi0.pdb'), inputfile)
+    compressed = os.path.join(tmp_path, '1oi0.cif.gz')
+    with open(os.path.join(TEST_DATA_DIR, '1oi0.cif'), "rb") as f, gzip.open(compressed, "wb") as g:
+        g.write(f.read())
+    expected = biometall.search(inputfile, motif='[GLU,GLU,ASP/TYR]', cluster_cutoff=0.2, use_cache=False)
+    sites = biometall.search(compressed, motif='[GLU,GLU,ASP/TYR]', cluster_cutoff=0.2, use_cache=False)
+    assert [site.residues for site in sites] == [site.residues for site in expected]
+    assert all(np.array_equal(site.probes, expected_site.probes) for site, expected_site in zip(sites, expected))
+
+@pytest.mark.parametrize("cluster_cutoff", [0.0, 0.2])
+def test_search_coarse(cluster_cutoff):
+    inputfile = os.path.join(TEST_DATA_DIR, '1oi0.pdb')
+    options = dict(motif='[GLU,GLU,ASP/TYR]', grid_step=0.5, use_cache=False, cores_number=2)
+    uniform = biometall.search(inputfile, cluster_cutoff=cluster_cutoff, **options)
+    coarse = biometall.search(inputfile, cluster_cutoff=cluster_cutoff, coarse_step=1.0, **options)
+
+    #The sites found with the coarse grid are the ones of the whole fine grid
+    assert [site.residues for site in coarse] == [site.residues for site in uniform]
+    for site, uniform_site in zip(coarse, uniform):
+        assert np.array_equal(site.probes, uniform_site.probes)
+        assert np.array_equal(site.center, uniform_site.center)
+
+    #With a coarser grid some sites are missed, and the cutoff is applied once,
+    #relative to the largest site found
+    all_sites = biometall.search(inputfile, cluster_cutoff=0.0, coarse_step=2.0, **options)
+    sites = biometall.search(inputfile, cluster_cutoff=cluster_cutoff, coarse_step=2.0, **options)
+    max_probes = max(site.num_probes for site in all_sites)
+    assert [site.residues for site in sites] == \
+            [site.residues for site in all_sites if site.num_probes >= max_probes*cluster_cutoff]
@@ -0,0 +1,128 @@
+import pytest
+from shutil import copyfile
+from pathlib import Path
+import numpy as np
+import os
+
+import biometall
+from biometall.modules import pdb
+from biometall.modules.pdb import _split_models
+
+TEST_DATA_DIR = os.path.join(Path(__file__).resolve().parent, 'data')
+
+def _write_models(path, n_models):
+    with open(os.path.join(TEST_DATA_DIR, '1oi0.pdb'), "r") as f:
+        atoms = [line for line in f if line.startswith(('ATOM', 'HETATM'))]
+    with open(path, "w") as f:
+        for i in range(n_models):
+            f.write("MODEL     %4d\n" % (i + 1))
+            f.writelines(atoms)
+            f.write("ENDMDL\n")
+        f.write("END\n")
+
+def test_split_models():
+    lines = ['HEADER', 'MODEL 1', 'ATOM 1', 'ATOM 2', 'ENDMDL', 'MODEL 2', 'ATOM 3', 'ENDMDL', 'END']
+    assert _split_models(lines) == [['ATOM 1', 'ATOM 2'], ['ATOM 3']]
+    assert _split_models(['ATOM 1', 'ATOM 2', 'END']) == [['ATOM 1', 'ATOM 2', 'END']]
+
+def _write_cif_models(path, n_models):
+    with open(os.path.join(TEST_DATA_DIR, '1oi0.cif'), "r") as f:
+        lines = f.read().splitlines()
+    rows = [i for i, line in enumerate(lines) if line.startswith(('ATOM', 'HETATM'))]
+    with open(path, "w") as f:
+        f.write('\n'.join(lines[:rows[0]]) + '\n')
+        for i in range(n_models):
+            #The model number is the last field of every row
+            f.writelines(lines[row].rsplit(' ', 1)[0] + ' %d\n' % (i + 1) for row in rows)
+        f.write('\n'.join(lines[rows[-1]+1:]) + '\n')
+
+def test_split_cif_models(tmp_path):
+    ensemble = os.path.join(tmp_path, 'ensemble.cif')
+    _write_cif_models(ensemble, 3)
+    with open(ensemble, "r") as f:
+        models = _split_models(f, '.cif')
+    assert len(models) == 3
+    with open(os.path.join(TEST_DATA_DIR, '1oi0.cif'), "r") as f:
+        expected = pdb._parse_molecule(f, '.cif')
+    for model in models:
+        result = pdb._parse_molecule(model, '.cif')
+        assert np.array_equal(result[2], expected[2]) and np.array_equal(result[11], expected[11])
+        assert result[8] == expected[8]
+    with open(os.path.join(TEST_DATA_DIR, '1oi0.cif'), "r") as f:
+        assert len(_split_models(f, '.cif')) == 1
+
+def test_search_ensemble(tmp_path):
+    inputfile = os.path.join(tmp_path, '1oi0.pdb')
+    copyfile(os.path.join(TEST_DATA_DIR, '1oi0.pdb'), inputfile)
+    expected = biometall.search(inputfile, motif='[GLU,GLU,ASP/TYR]', cluster_cutoff=0.2,
+                                use_cache=False)
+
+    #Identical models find the same sites, in all of them
+    ensemble = os.path.join(tmp_path, 'ensemble.pdb')
+    _write_models(ensemble, 3)
+    sites = biometall.search_ensemble(ensemble, motif='[GLU,GLU,ASP/TYR]', cluster_cutoff=0.2,
+                                        cores_number=2)
+    assert len(sites) == len(expected)
+    assert {site.residues for site in sites} == {site.residues for site in expected}
+    by_residues = {site.residues: site for site in expected}
+    for site in sites:
+        assert isinstance(site, biometall.EnsembleSite)
+        assert site.frames == (0, 1, 2) and site.occupancy == 1.0
+        assert site.num_probes == by_residues[site.residues].num_probes
+        np.testing.assert_allclose(site.center, by_residues[site.residues].center)
+
+    #Models of mmCIF files are split by their model number
+    cif_ensemble = os.path.join(tmp_path, 'ensemble.cif')
+    _write_cif_models(cif_ensemble, 3)
+    cif_sites = biometall.search_ensemble(cif_ensemble, motif='[GLU,GLU,ASP/TYR]', cluster_cutoff=0.2,
+                                            cores_number=2)
+    assert [(site.residues, site.frames, site.num_probes) for site in cif_sites] == \
+            [(site.residues, site.frames, site.num_probes) for site in sites]
+
+    #The models can also be given as a list of files, and selected by index
+    sites = biometall.search_ensemble([inputfile, inputfile], motif='[GLU,GLU,ASP/TYR]',
+                                        cluster_cutoff=0.2, frames=[1], cores_number=2)
+    assert {site.residues for site in sites} == {site.residues for site in expected}
+    assert all(site.frames == (0,) for site in sites)
+
+def test_search_ensemble_different_models(tmp_path):
+    ensemble = os.path.join(tmp_path, 'ensemble.pdb')
+    _write_models(ensemble, 2)
+    with open(ensemble, "r") as f:
+        lines = f.readlines()
+    #A beta carbon of the second model is removed
+    del lines[max(i for i, line in enumerate(lines) if line[12:16] == ' CB ')]
+    with open(ensemble, "w") as f:
+        f.writelines(lines)
+    with pytest.raises(Exception):
+        biometall.search_ensemble(ensemble, cores_number=2)
+
+def test_run_ensemble(tmp_path, monkeypatch):
+    ensemble = os.path.join(tmp_path, 'ensemble.pdb')
+    _write_models(ensemble, 2)
+    sites = biometall.run(ensemble, motif='[GLU,GLU,ASP/TYR]', cluster_cutoff=0.2, pdb=True,
+                            cores_number=2, ensemble=True, frames=slice(0, 2))
+    with open(os.path.join(tmp_path, 'results_biometall_ensemble_GLU_GLU_ASP-TYR_ensemble.txt'), "r") as f:
+        lines = f.readlines()
+    assert len(lines) == len(sites) + 5
+    assert 'Occupancy' in lines[2] and lines[4].split('|')[3].strip() == '2/2'
+
+    #The probes of every site are written with its mean center
+    with open(os.path.join(tmp_path, 'probes_ensemble_GLU_GLU_ASP-TYR_ensemble.pdb'), "r") as f:
+        atoms = [line[12:16].strip() for line in f if line.startswith('ATOM')]
+    assert atoms.count('HE') == len(sites)
+    assert atoms.count('XE') == sum(site.num_probes for site in sites)
+
+    #The sites are not searched again with the same models and parameters
+    def search_frame(*args, **kwargs):
+        raise AssertionError("Results not read from the cache")
+    monkeypatch.setattr(biometall.biometall, '_search_frame', search_frame)
+    cached_sites = biometall.run(ensemble, motif='[GLU,GLU,ASP/TYR]', cluster_cutoff=0.2,
+                                    cores_number=2, ensemble=True, frames=slice(0, 2))
+    assert [site.residues for site in cached_sites] == [site.residues for site in sites]
+    with pytest.raises(AssertionError, match="Results not read"):
+        biometall.run(ensemble, motif='[GLU,GLU,ASP/TYR]', cluster_cutoff=0.2,
+                        cores_number=2, ensemble=True, frames=slice(0, 1))
+    with pytest.raises(AssertionError, match="Results not read"):
+        biometall.run(ensemble, motif='[GLU,GLU,ASP/TYR]', cluster_cutoff=0.2,
+                        cores_number=2, ensemble=True, use_cache=False)
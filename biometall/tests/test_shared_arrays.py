@@ -0,0 +1,24 @@
+import pytest
+import numpy as np
+from biometall.modules import shared
+
+testdata = [
+    {'grid': np.arange(30.0).reshape(10, 3), 'columns': np.arange(7),
+     'empty': np.array([]), 'scalar': np.asarray(2.5)},
+    {'thresholds': np.ones((3, 2, 5))},
+]
+@pytest.mark.parametrize("arrays", testdata)
+
+def test_shared_arrays(arrays):
+    block, description = shared._share_arrays(arrays)
+    try:
+        attached = shared._attach_arrays(description)
+        assert list(attached) == list(arrays)
+        for key, array in arrays.items():
+            assert attached[key].dtype == array.dtype
+            assert np.array_equal(attached[key], array)
+            assert not attached[key].flags.writeable
+        assert shared._attach_arrays(description) is attached
+    finally:
+        shared._detach_arrays()
+        shared._release_arrays(block)
@@ -0,0 +1,23 @@
+import pytest
+import numpy as np
+from biometall.modules import grid
+
+testdata = [
+    (0, 50, 7.0, 1000),
+    (1, 300, 3.0, 333),
+    (2, 1, 10.0, 100000),
+    (3, 0, 7.0, 100000),
+]
+@pytest.mark.parametrize("seed,n_atoms,max_cutoff,block_size", testdata)
+
+def test_shell(seed, n_atoms, max_cutoff, block_size):
+    rng = np.random.RandomState(seed)
+    atoms = rng.uniform(-15, 15, (n_atoms, 3))
+    cutoffs = rng.uniform(-1, max_cutoff, n_atoms)
+    cutoffs[::7] = -np.inf
+    points = grid._grid(np.zeros(3), 25.0, 1.0)
+    shell = grid._shell(points, atoms, cutoffs, block_size)
+
+    distances = np.linalg.norm(points[:,np.newaxis] - atoms, axis=-1)
+    expected = points[np.any(distances <= cutoffs + grid._CANDIDATE_MARGIN, axis=1)]
+    assert np.array_equal(shell, expected)
@@ -0,0 +1,47 @@
+import pytest
+from pathlib import Path
+from shutil import copyfile
+import numpy as np
+import os
+
+from biometall.modules import cache, pdb
+
+TEST_DATA_DIR = os.path.join(Path(__file__).resolve().parent, 'data')
+
+testdata = [('1oi0.pdb', '.pdb'), ('1oi0.cif', '.cif')]
+@pytest.mark.parametrize("file_name,extension", testdata)
+
+def test_structure_cache(file_name, extension, cache_dir, tmp_path):
+    file_path = os.path.join(TEST_DATA_DIR, file_name)
+    with open(file_path, "r") as f:
+        expected = pdb._parse_molecule(f.read().splitlines(), extension)
+
+    parsed = cache._load_structure(file_path, extension, str(cache_dir))
+    assert len(os.listdir(cache_dir)) == 1
+    cached = cache._load_structure(file_path, extension, str(cache_dir))
+    assert isinstance(cached[2], np.memmap)
+
+    for result in (parsed, cached):
+        assert len(result) == len(expected)
+        for item, expected_item in zip(result, expected):
+            if isinstance(expected_item, dict):
+                assert list(item.items()) == list(expected_item.items())
+            else:
+                assert np.array_equal(item, expected_item)
+
+    #A modified file gets its own entry
+    modified_path = os.path.join(tmp_path, file_name)
+    copyfile(file_path, modified_path)
+    with open(modified_path, "a") as f:
+        f.write("END\n")
+    cache._load_structure(modified_path, extension, str(cache_dir))
+    assert len(os.listdir(cache_dir)) == 2
+
+def test_structure_cache_corrupted(cache_dir):
+    file_path = os.path.join(TEST_DATA_DIR, '1oi0.pdb')
+    expected = cache._load_structure(file_path, '.pdb', None)
+    cache._load_structure(file_path, '.pdb', str(cache_dir))
+    entry = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+    os.remove(os.path.join(entry, 'alphas.npy'))
+    result = cache._load_structure(file_path, '.pdb', str(cache_dir))
+    assert np.array_equal(result[2], expected[2])